@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""attention.py
+
+The additive (Bahdanau) attention of the attention models. self.attn acts on
+cat(decoder hidden, encoder output), so its weight splits into a decoder part
+and an encoder part. The encoder part (the keys) does not change across
+decoder steps: project_keys computes it once per batch, and forward only
+projects the decoder state and broadcasts it against the keys instead of
+repeating it src len times and concatenating.
+
+    keys = self.decoder.attention.project_keys(encoder_outputs)
+    for t in range(1, trg_len):
+        output, hidden = self.decoder(input, hidden, encoder_outputs, keys, mask)
+
+Decoding without gradients can reuse one energy buffer across steps:
+
+    with self.decoder.attention.decoding():
+        trgs = beam_search(self.decoder, hidden, encoder_out, TRG, max_len, beam_width, keys, mask)
+
+The notebooks subclass AdditiveAttention with the constructor arguments of
+their models (the encoder output is twice the encoder hidden size for a
+bidirectional encoder), so checkpoints keep their attn and v parameters.
+"""
+
+import contextlib
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+class AdditiveAttention(nn.Module):
+    def __init__(self, enc_dim, dec_hid_dim, attn_dim = None):
+        super().__init__()
+        attn_dim = attn_dim or dec_hid_dim
+        self.dec_hid_dim = dec_hid_dim
+        self.attn = nn.Linear(enc_dim + dec_hid_dim, attn_dim)
+        self.v = nn.Linear(attn_dim, 1, bias = False)
+        self.energy = None
+        self.reuse_energy = False
+
+    # Inside decoding(), forward passes without gradients reuse one energy
+    # buffer across decoder steps instead of allocating a new [batch, src len,
+    # dim] tensor at every step. The buffer is freed when the block ends, so it
+    # does not keep the memory of the largest decode or miss a later .to()
+    @contextlib.contextmanager
+    def decoding(self):
+        self.reuse_energy = True
+        try:
+            yield
+        finally:
+            self.reuse_energy, self.energy = False, None
+
+    def energy_buffer(self, keys):
+        if (self.energy is None or self.energy.shape[0] < keys.shape[0]
+                or self.energy.shape[1:] != keys.shape[1:]
+                or self.energy.dtype != keys.dtype or self.energy.device != keys.device):
+            self.energy = torch.empty_like(keys)
+        return self.energy[:keys.shape[0]]
+
+    # The encoder part of self.attn applied to encoder_outputs [src len, batch,
+    # enc dim], as [batch, src len, attn dim]
+    def project_keys(self, encoder_outputs):
+        encoder_outputs = encoder_outputs.permute(1, 0, 2)
+        return F.linear(encoder_outputs, self.attn.weight[:, self.dec_hid_dim:], self.attn.bias)
+
+    # Attention weights [batch, src len] of the decoder state hidden. keys are
+    # computed from encoder_outputs if not given; mask is False at the padding
+    # of encoder_outputs
+    def forward(self, hidden, encoder_outputs, keys = None, mask = None):
+        if keys is None:
+            keys = self.project_keys(encoder_outputs)
+        query = F.linear(hidden, self.attn.weight[:, :self.dec_hid_dim])
+        if torch.is_grad_enabled() or not self.reuse_energy:
+            energy = torch.tanh(keys + query.unsqueeze(1))
+        else:
+            energy = torch.add(keys, query.unsqueeze(1), out = self.energy_buffer(keys)).tanh_()
+        attention = self.v(energy).squeeze(2)
+        # padding gets no attention
+        if mask is not None:
+            attention = attention.masked_fill(~mask, -1e10)
+        return F.softmax(attention, dim = 1, dtype = torch.float)
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""attention_benchmark.py
+
+Micro-benchmark for one decoder step of the Bahdanau attention used by the
+search models. Compares the original implementation, which repeats the decoder
+hidden state src_len times and concatenates it with the encoder outputs, with
+AdditiveAttention (attention.py), which broadcasts a projected query against
+keys computed once per sentence and reuses an energy buffer during inference.
+"""
+
+import time
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.profiler import profile, ProfilerActivity
+from attention import AdditiveAttention
+
+BATCH_SIZE = 80
+SRC_LEN = 50
+HID_DIM = 600
+STEPS = 100
+
+# Attention as it was before the keys were cached
+class ConcatAttentionBi(nn.Module):
+    def __init__(self, enc_hid_dim, dec_hid_dim):
+        super().__init__()
+
+        self.attn = nn.Linear(2 * enc_hid_dim + dec_hid_dim, dec_hid_dim)
+        self.v = nn.Linear(dec_hid_dim, 1, bias = False)
+
+    def forward(self, hidden, encoder_outputs):
+        batch_size = encoder_outputs.shape[1]
+        src_len = encoder_outputs.shape[0]
+
+        hidden = hidden.unsqueeze(1).repeat(1, src_len, 1)
+        encoder_outputs = encoder_outputs.permute(1, 0, 2)
+
+        energy = torch.tanh(self.attn(torch.cat((hidden, encoder_outputs), dim = 2)))
+        attention = self.v(energy).squeeze(2)
+
+        return F.softmax(attention, dim=1)
+
+def allocated_bytes(step):
+    # Bytes allocated (not net usage) by one call of step
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        step()
+    return sum(e.self_cpu_memory_usage for e in prof.events() if e.self_cpu_memory_usage > 0)
+
+def time_per_step(step, steps=STEPS):
+    step()
+    start_time = time.time()
+    for _ in range(steps):
+        step()
+    return (time.time() - start_time) / steps
+
+old = ConcatAttentionBi(HID_DIM, HID_DIM)
+new = AdditiveAttention(2 * HID_DIM, HID_DIM)
+new.load_state_dict(old.state_dict())
+
+encoder_outputs = torch.randn(SRC_LEN, BATCH_SIZE, 2 * HID_DIM)
+hidden = torch.randn(BATCH_SIZE, HID_DIM)
+
+with torch.no_grad(), new.decoding():
+    keys = new.project_keys(encoder_outputs)
+    assert torch.allclose(old(hidden, encoder_outputs), new(hidden, encoder_outputs, keys), atol=1e-6)
+
+    steps = [('repeat + cat', lambda: old(hidden, encoder_outputs)),
+             ('cached keys', lambda: new(hidden, encoder_outputs, keys))]
+    # Warm up so the energy buffer already exists, as it does from the second step on
+    new(hidden, encoder_outputs, keys)
+
+    print(f'batch {BATCH_SIZE}, src len {SRC_LEN}, hidden {HID_DIM}')
+    for name, step in steps:
+        print(f'{name:>14}: {allocated_bytes(step) / 2**20:8.2f} MiB allocated per step, '
+              f'{time_per_step(step) * 1000:7.3f} ms per step')
@@ -13,6 +13,9 @@ import torch.optim as optim
 import torch.nn.functional as F
 from torchtext.datasets import TranslationDataset, Multi30k, IWSLT, WMT14
 from torchtext.data import Field, BucketIterator, Iterator
+from corpus import download_iwslt, prepare_iwslt, MappedCorpus, MappedIterator, save_vocab
+from checkpoint import CheckpointWriter, TrainingState
+from precision import autocast, mixed_precision
 import spacy
 import numpy as np
 import random
@@ -59,24 +62,35 @@ SRC = Field(init_token=sos_token,
             pad_token=pad_token, 
             unk_token=unk_token)
 
+# IWSLT extracted to .data/iwslt/de-en, for the validation set below
+download_iwslt()
+
 # Commented out IPython magic to ensure Python compatibility.
 # %%capture
-# train_data, valid_data, test_data = IWSLT.splits(exts = ('.de', '.en'), 
-#                         fields = (SRC, TRG),
-#                         filter_pred=lambda x: len(x.__dict__['src']) <= 50)
+# valid_data, test_data = TranslationDataset.splits(path = '.data/iwslt/de-en', train = None,
+#                                                   validation = 'IWSLT16.TED.tst2013.de-en',
+#                                                   test = 'IWSLT16.TED.tst2014.de-en',
+#                                                   exts = ('.de', '.en'), 
+#                                                   fields = (SRC, TRG),
+#                                                   filter_pred=lambda x: len(x.__dict__['src']) <= 50)
+
+# The training set is tokenized once and kept on Drive as memory-mapped token
+# ids. The first run downloads and preprocesses it, see corpus.py
+prepare_iwslt("/content/drive/My Drive/data/iwslt-de-en.bin")
+train_data = MappedCorpus("/content/drive/My Drive/data/iwslt-de-en.bin", 'train', max_len = 50)
 
-SRC.build_vocab(train_data, max_size=10000)
-TRG.build_vocab(train_data, max_size=10000)
+train_data.build_vocab(SRC, 0, max_size=10000)
+train_data.build_vocab(TRG, 1, max_size=10000)
 
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
-BATCH_SIZE = 80
+MAX_TOKENS = 4000
 
-train_iterator, valid_iterator, test_iterator = BucketIterator.splits(
-    (train_data, valid_data, test_data), 
-    sort_key=lambda x: len(x.__dict__['src']),
-    batch_size = BATCH_SIZE, 
-    device = device)
+train_iterator = MappedIterator(
+    train_data, SRC, TRG,
+    batch_size = MAX_TOKENS, 
+    device = device,
+    num_workers = 2) # padded batches are built in background processes
 
 class Encoder(nn.Module):
     def __init__(self, input_dim, emb_dim, hid_dim):
@@ -85,8 +99,11 @@ class Encoder(nn.Module):
         self.embedding = nn.Embedding(input_dim, emb_dim)
         self.rnn = nn.GRU(emb_dim, hid_dim, bidirectional = True)
         
-    def forward(self, src):
+    def forward(self, src, src_len = None):
         embedded = self.embedding(src)
+        if src_len is not None:
+            # Packing skips the <pad> positions at the end of shorter sentences
+            embedded = nn.utils.rnn.pack_padded_sequence(embedded, src_len.cpu(), enforce_sorted = False)
         outputs, hidden = self.rnn(embedded)
         return hidden[-1,:,:].unsqueeze(0)
 
@@ -121,9 +138,10 @@ class EncoderDecoder(nn.Module):
         batch_size = trg.shape[1]
         trg_len = trg.shape[0]
         trg_vocab_size = self.decoder.output_dim
-        outputs = torch.zeros(trg_len, batch_size, trg_vocab_size).to(self.device)
-        context = self.encoder(src)
+        src_len = (src != SRC.vocab.stoi[SRC.pad_token]).sum(0)
+        context = self.encoder(src, src_len)
         hidden = context
+        outputs = torch.zeros(trg_len, batch_size, trg_vocab_size).to(self.device)
         input = trg[0,:]
         
         for t in range(1, trg_len):
@@ -156,14 +174,19 @@ def init_weights(m):
 
 enc_dec.apply(init_weights)
 ed_optimizer = optim.Adam(enc_dec.parameters())
+
+# Forward passes in bfloat16 autocast, for CPUs with AVX512-BF16 or AMX. The
+# weights and the loss stay float32, see precision.py. CPU training only
+BF16 = False
+enc_dec = mixed_precision(enc_dec)
 TRG_PAD_IDX = TRG.vocab.stoi[TRG.pad_token]
 criterion = nn.CrossEntropyLoss(ignore_index = TRG_PAD_IDX)
 
-def train(model, iterator, optimizer, criterion, clip):
+def train(model, iterator, optimizer, criterion, clip, state = None):
     
     model.train()
     
-    epoch_loss = 0
+    epoch_loss = 0 if state is None else state.epoch_loss
     
     for i, batch in enumerate(iterator):
         src = batch.src
@@ -171,7 +194,8 @@ def train(model, iterator, optimizer, criterion, clip):
         
         optimizer.zero_grad()
         
-        output = model(src, trg)
+        with autocast(BF16):
+            output = model(src, trg)
         
         #trg = [trg len, batch size]
         #output = [trg len, batch size, output dim]
@@ -193,6 +217,7 @@ def train(model, iterator, optimizer, criterion, clip):
         optimizer.step()
         
         epoch_loss += loss.item()
+        if state is not None: state.step(epoch_loss)
         
     return epoch_loss / len(iterator)
 
@@ -205,21 +230,35 @@ def epoch_time(start_time, end_time):
 N_EPOCHS = 10
 CLIP = 1
 
-for epoch in range(N_EPOCHS):
-    torch.save(enc_dec.state_dict(), f'/content/drive/My Drive/ml-mini-project/bidirectional-control/epoch-{epoch}.pt')
-    enc_dec.load_state_dict(torch.load(f'/content/drive/My Drive/ml-mini-project/bidirectional-control/epoch-{epoch}.pt'))
+save_vocab('/content/drive/My Drive/ml-mini-project/bidirectional-control/vocab.json', src=SRC, trg=TRG)
+
+# Epoch checkpoints are written to Drive in the background, see checkpoint.py
+checkpoints = CheckpointWriter()
+
+# Full training state (optimizer, random generators, place in the epoch),
+# saved every CHECKPOINT_STEPS batches and after every epoch, so that a run
+# that was stopped continues where it was, see checkpoint.py
+CHECKPOINT_STEPS = 1000
+state = TrainingState('/content/drive/My Drive/ml-mini-project/bidirectional-control/training-state.pt',
+                      enc_dec, ed_optimizer, train_iterator,
+                      every = CHECKPOINT_STEPS, writer = checkpoints)
+
+for epoch in range(state.resume(), N_EPOCHS):
+    if not state.mid_epoch():
+        checkpoints.save(enc_dec.state_dict(), f'/content/drive/My Drive/ml-mini-project/bidirectional-control/epoch-{epoch}.pt')
 
     start_time = time.time()
-    train_loss = train(enc_dec, train_iterator, ed_optimizer, criterion, CLIP)
+    train_loss = train(enc_dec, train_iterator, ed_optimizer, criterion, CLIP, state = state)
     end_time = time.time()
     
     epoch_mins, epoch_secs = epoch_time(start_time, end_time)
 
     print(f'Epoch: {epoch+1:02} | Time: {epoch_mins}m {epoch_secs}s')
     print(f'\tTrain Loss: {train_loss:.3f}')
+    state.end_epoch()
 
-torch.save(enc_dec.state_dict(), f'/content/drive/My Drive/ml-mini-project/bidirectional-control/epoch-{N_EPOCHS}.pt')
-enc_dec.load_state_dict(torch.load(f'/content/drive/My Drive/ml-mini-project/bidirectional-control/epoch-{N_EPOCHS}.pt'))
+checkpoints.save(enc_dec.state_dict(), f'/content/drive/My Drive/ml-mini-project/bidirectional-control/epoch-{N_EPOCHS}.pt')
+checkpoints.wait()
 
 def evaluate_bleu(model, datasets):
     overall_size = sum([len(d) for d in datasets])
@@ -13,6 +13,10 @@ import torch.optim as optim
 import torch.nn.functional as F
 from torchtext.datasets import TranslationDataset, Multi30k, IWSLT
 from torchtext.data import Field, BucketIterator, Iterator
+from corpus import load_vocab
+from hypotheses import HypothesisCache
+from sweep import Job, sweep, format_table
+from attention import AdditiveAttention
 import spacy
 import numpy as np
 import random
@@ -61,10 +65,6 @@ SRC = Field(init_token=sos_token,
 
 # Commented out IPython magic to ensure Python compatibility.
 # %%capture
-# train_data, _, _ = IWSLT.splits(exts = ('.de', '.en'), 
-#                         fields = (SRC, TRG),
-#                         filter_pred=lambda x: len(x.__dict__['src']) <= 50)
-# 
 # test_10, valid_10, valid_12 = IWSLT.splits(exts = ('.de', '.en'), 
 #                                 fields = (SRC, TRG),
 #                                 train='IWSLT16.TED.tst2010',
@@ -89,8 +89,8 @@ SRC = Field(init_token=sos_token,
 # valid_data = [valid_10, valid_12]
 # test_data = [test_10, test_11, test_12, test_13, test_13x, test_14x, test_14]
 
-SRC.build_vocab(train_data, max_size=10000)
-TRG.build_vocab(train_data, max_size=10000)
+# Vocabulary the models were trained with, saved by the training notebook
+load_vocab('/content/drive/My Drive/ml-mini-project/bidirectional-attention/vocab.json', src=SRC, trg=TRG)
 
 class Encoder(nn.Module):
     def __init__(self, input_dim, emb_dim, hid_dim):
@@ -99,8 +99,11 @@ class Encoder(nn.Module):
         self.embedding = nn.Embedding(input_dim, emb_dim)
         self.rnn = nn.GRU(emb_dim, hid_dim, bidirectional = True)
         
-    def forward(self, src):
+    def forward(self, src, src_len = None):
         embedded = self.embedding(src)
+        if src_len is not None:
+            # Packing skips the <pad> positions at the end of shorter sentences
+            embedded = nn.utils.rnn.pack_padded_sequence(embedded, src_len.cpu(), enforce_sorted = False)
         outputs, hidden = self.rnn(embedded)
         return hidden[-1,:,:].unsqueeze(0)
 
@@ -136,7 +139,8 @@ class EncoderDecoder(nn.Module):
         trg_len = trg.shape[0]
         trg_vocab_size = self.decoder.output_dim
         outputs = torch.zeros(trg_len, batch_size, trg_vocab_size).to(self.device)
-        context = self.encoder(src)
+        src_len = (src != SRC.vocab.stoi[SRC.pad_token]).sum(0)
+        context = self.encoder(src, src_len)
         hidden = context
         input = trg[0,:]
         
@@ -181,29 +185,19 @@ class EncoderAttn(nn.Module):
         self.embedding = nn.Embedding(input_dim, emb_dim)
         self.rnn = nn.GRU(emb_dim, enc_hid_dim, bidirectional = True)
         
-    def forward(self, src):
+    def forward(self, src, src_len = None):
         embedded = self.embedding(src)
+        if src_len is not None:
+            # Packing skips the <pad> positions at the end of shorter sentences
+            embedded = nn.utils.rnn.pack_padded_sequence(embedded, src_len.cpu(), enforce_sorted = False)
         outputs, hidden = self.rnn(embedded)
+        if src_len is not None:
+            outputs, _ = nn.utils.rnn.pad_packed_sequence(outputs, total_length = src.shape[0])
         return outputs, hidden[1]
 
-class Attention(nn.Module):
+class Attention(AdditiveAttention):
     def __init__(self, enc_hid_dim, dec_hid_dim):
-        super().__init__()
-        
-        self.attn = nn.Linear(2 * enc_hid_dim + dec_hid_dim, dec_hid_dim)
-        self.v = nn.Linear(dec_hid_dim, 1, bias = False)
-        
-    def forward(self, hidden, encoder_outputs):
-        batch_size = encoder_outputs.shape[1]
-        src_len = encoder_outputs.shape[0]
-        
-        hidden = hidden.unsqueeze(1).repeat(1, src_len, 1)
-        encoder_outputs = encoder_outputs.permute(1, 0, 2)
-        
-        energy = torch.tanh(self.attn(torch.cat((hidden, encoder_outputs), dim = 2))) 
-        attention = self.v(energy).squeeze(2)
-        
-        return F.softmax(attention, dim=1)
+        super().__init__(2 * enc_hid_dim, dec_hid_dim)
 
 class DecoderAttn(nn.Module):
     def __init__(self, output_dim, emb_dim, enc_hid_dim, dec_hid_dim, attention):
@@ -214,10 +208,10 @@ class DecoderAttn(nn.Module):
         self.rnn = nn.GRU((enc_hid_dim * 2) + emb_dim, dec_hid_dim)
         self.fc_out = nn.Linear((enc_hid_dim * 2) + dec_hid_dim + emb_dim, output_dim)
         
-    def forward(self, input, hidden, encoder_outputs):
+    def forward(self, input, hidden, encoder_outputs, keys = None, mask = None):
         input = input.unsqueeze(0)
         embedded = self.embedding(input)
-        a = self.attention(hidden, encoder_outputs)
+        a = self.attention(hidden, encoder_outputs, keys, mask)
         a = a.unsqueeze(1)
         encoder_outputs = encoder_outputs.permute(1, 0, 2)
         weighted = torch.bmm(a, encoder_outputs)
@@ -244,11 +238,13 @@ class Search(nn.Module):
         trg_vocab_size = self.decoder.output_dim
         
         outputs = torch.zeros(trg_len, batch_size, trg_vocab_size).to(self.device)
-        encoder_outputs, hidden = self.encoder(src)
+        mask = (src != SRC.vocab.stoi[SRC.pad_token]).permute(1, 0)
+        encoder_outputs, hidden = self.encoder(src, mask.sum(1))
+        keys = self.decoder.attention.project_keys(encoder_outputs)
         input = trg[0,:]
         
         for t in range(1, trg_len):
-            output, hidden = self.decoder(input, hidden, encoder_outputs)
+            output, hidden = self.decoder(input, hidden, encoder_outputs, keys, mask)
             outputs[t] = output
             teacher_force = random.random() < teacher_forcing_ratio
             top1 = output.argmax(1)
@@ -261,6 +257,7 @@ class Search(nn.Module):
         self.eval()
         src = SRC.process([sentence]).to(device)
         encoder_out, hidden = self.encoder(src)
+        keys = self.decoder.attention.project_keys(encoder_out)
         beams = [(0.0, [TRG.vocab.stoi[TRG.init_token]], hidden)]
         done = False
         log_smax = nn.LogSoftmax(dim=0).to(device)
@@ -272,7 +269,7 @@ class Search(nn.Module):
                     beams += [(p, sent, hidden)]
                     continue
                 trg = torch.ones(1, dtype=torch.int64).to(device) * sent[-1]
-                pred, hidden = self.decoder(trg, hidden, encoder_out)
+                pred, hidden = self.decoder(trg, hidden, encoder_out, keys)
                 ll = log_smax(pred[0])
                 top_ll, top_t = torch.topk(ll, k=beam_width)
                 beams += [(p + ll, sent + [t], hidden) for ll, t in zip(top_ll, top_t)]
@@ -300,14 +297,30 @@ enc = EncoderAttn(INPUT_DIM, ENC_EMB_DIM, HID_DIM, HID_DIM)
 dec = DecoderAttn(OUTPUT_DIM, DEC_EMB_DIM, HID_DIM, HID_DIM, att)
 search = Search(enc, dec, device).to(device)
 
+# Translations already made with the same weights and beam settings, kept on
+# Drive so that reruns of the notebook do not decode them again
+hypotheses = HypothesisCache('/content/drive/My Drive/ml-mini-project/hypotheses.db')
+
+# Translates every sentence with model.translate, except those found in the
+# hypothesis cache
+def translate_sentences(model, sentences, max_len=50, beam_width=3):
+    keys = hypotheses.keys(model, sentences, max_len, beam_width)
+    preds = hypotheses.get(keys)
+    todo = [i for i, pred in enumerate(preds) if pred is None]
+    for n, i in enumerate(todo):
+        preds[i] = model.translate(sentences[i], max_len, beam_width)
+        if n % 200 == 199: print('.', end='')
+    print('')
+    hypotheses.put([keys[i] for i in todo], [preds[i] for i in todo])
+    return preds
+
 def evaluate_bleu(model, datasets):
     overall_size = sum([len(d) for d in datasets])
     total = 0.0
-    for i, example in enumerate(itertools.chain(*datasets)):
-        pred = model.translate(example.src)[1:-2]
-        total += sentence_bleu([example.trg], pred, smoothing_function=SmoothingFunction().method1)
-        if i % 200 == 199: print('.', end='')
-    print('')
+    examples = list(itertools.chain(*datasets))
+    preds = translate_sentences(model, [example.src for example in examples])
+    for example, pred in zip(examples, preds):
+        total += sentence_bleu([example.trg], pred[1:-2], smoothing_function=SmoothingFunction().method1)
     return total / overall_size
     
 def bleu_summary(model, datasets):
@@ -315,13 +328,12 @@ def bleu_summary(model, datasets):
     lengths = np.zeros(overall_examples, dtype=np.int32)
     scores = np.zeros(overall_examples)
 
-    for i, example in enumerate(itertools.chain(*datasets)):
-        pred = model.translate(example.src)
+    examples = list(itertools.chain(*datasets))
+    preds = translate_sentences(model, [example.src for example in examples])
+    for i, (example, pred) in enumerate(zip(examples, preds)):
         scores[i] = sentence_bleu([example.trg], pred, smoothing_function=SmoothingFunction().method1)
         lengths[i] = len(example.src)
-        if i % 900 == 899: print('.', end='')
         
-    print('')
     means, up, lo = {}, {}, {}
     uniq_lengths, counts = np.unique(lengths, return_counts=True)
     for l, c in zip(uniq_lengths, counts):
@@ -333,15 +345,27 @@ def bleu_summary(model, datasets):
     uniq_lengths = [l for l in sorted(uniq_lengths)]
     return uniq_lengths, [means[l] for l in uniq_lengths], [up[l] for l in uniq_lengths], [lo[l] for l in uniq_lengths]
 
-ctrl_valid_bleu = []
-attn_valid_bleu = []
-
-for i in range(11):
-    print(f'Epoch {i}')
-    enc_dec.load_state_dict(torch.load(f'/content/drive/My Drive/ml-mini-project/bidirectional-control/epoch-{i}.pt'))
-    search.load_state_dict(torch.load(f'/content/drive/My Drive/ml-mini-project/bidirectional-attention/epoch-{i}.pt'))
-    ctrl_valid_bleu.append(evaluate_bleu(enc_dec, valid_data))
-    attn_valid_bleu.append(evaluate_bleu(search, valid_data))
+# The checkpoints are evaluated in parallel CPU processes, see sweep.py
+def use_cpu():
+    global device
+    device = torch.device('cpu')
+
+def make_enc_dec():
+    return EncoderDecoder(Encoder(INPUT_DIM, ENC_EMB_DIM, HID_DIM),
+                          Decoder(OUTPUT_DIM, DEC_EMB_DIM, HID_DIM), device)
+
+def make_search():
+    return Search(EncoderAttn(INPUT_DIM, ENC_EMB_DIM, HID_DIM, HID_DIM),
+                  DecoderAttn(OUTPUT_DIM, DEC_EMB_DIM, HID_DIM, HID_DIM, Attention(HID_DIM, HID_DIM)), device)
+
+jobs = [Job(('control', i), make_enc_dec, f'/content/drive/My Drive/ml-mini-project/bidirectional-control/epoch-{i}.pt', valid_data)
+        for i in range(11)]
+jobs += [Job(('attention', i), make_search, f'/content/drive/My Drive/ml-mini-project/bidirectional-attention/epoch-{i}.pt', valid_data)
+         for i in range(11)]
+rows = sweep(jobs, lambda model, data: {'bleu': evaluate_bleu(model, data)}, init=use_cpu, caches=[hypotheses])
+print(format_table(rows))
+ctrl_valid_bleu = [row['bleu'] for row in rows[:11]]
+attn_valid_bleu = [row['bleu'] for row in rows[11:]]
 
 np.argmax(ctrl_valid_bleu), np.argmax(attn_valid_bleu)
 
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""bleu.py
+
+Sentence and corpus BLEU on integer token ids, for the evaluation notebooks.
+Gives the same scores as nltk's sentence_bleu and corpus_bleu with a single
+reference, the default 4-gram weights and SmoothingFunction().method1, but
+counts the n-grams of all sentences at once with NumPy instead of one Counter
+per sentence and order.
+
+Sentences are passed like the arrays corpus.py writes: one flat array of ids
+and offsets, sentence i is ids[offsets[i]:offsets[i + 1]]. encode turns lists
+of token strings (what translate_sentences returns) into that form.
+"""
+
+from collections import namedtuple
+import numpy as np
+
+MAX_N = 4
+EPSILON = 0.1
+
+Bleu = namedtuple('Bleu', ['sentences', 'corpus', 'buckets'])
+Buckets = namedtuple('Buckets', ['lengths', 'means', 'up', 'lo'])
+
+# Flat ids and offsets of lists of tokens. Tokens are numbered in first-seen
+# order in index, so pass the same dict for hypotheses and references
+def encode(sentences, index):
+    offsets = np.zeros(len(sentences) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(sentence) for sentence in sentences])
+    ids = np.fromiter((index.setdefault(token, len(index))
+                       for sentence in sentences for token in sentence),
+                      dtype=np.int64, count=offsets[-1])
+    return ids, offsets
+
+# Clipped n-gram matches of every hypothesis for n = 1..max_n, shape
+# (max_n, sentences). The n-grams of both sides are numbered together: an
+# n-gram is an (n-1)-gram followed by one token, and np.unique renumbers the
+# pairs so the keys stay below the token count for any n
+def clipped_matches(hyp_ids, hyp_offsets, ref_ids, ref_offsets, max_n=MAX_N):
+    n_sentences = len(hyp_offsets) - 1
+    ids = np.concatenate((hyp_ids, ref_ids))
+    lengths = np.concatenate((np.diff(hyp_offsets), np.diff(ref_offsets)))
+    sentence = np.repeat(np.tile(np.arange(n_sentences), 2), lengths)
+    end = np.repeat(np.concatenate((hyp_offsets[1:], ref_offsets[1:] + len(hyp_ids))), lengths)
+    is_hyp = np.arange(len(ids)) < len(hyp_ids)
+
+    matches = np.zeros((max_n, n_sentences), dtype=np.int64)
+    if len(ids) == 0:
+        return matches
+    tokens = np.unique(ids, return_inverse=True)[1].reshape(-1)
+    keys = tokens
+    for n in range(1, max_n + 1):
+        if n > 1:
+            keys = keys[:-1] * (tokens.max() + 1) + tokens[n - 1:]
+            keys = np.unique(keys, return_inverse=True)[1].reshape(-1)
+        # n-grams that do not run past the end of their sentence
+        valid = np.flatnonzero(np.arange(len(keys)) + n <= end[:len(keys)])
+        if len(valid) == 0:
+            break
+        codes = sentence[valid] * (keys.max() + 1) + keys[valid]
+        hyp_codes, hyp_counts = np.unique(codes[is_hyp[valid]], return_counts=True)
+        ref_codes, ref_counts = np.unique(codes[~is_hyp[valid]], return_counts=True)
+        # count of every hypothesis n-gram in its reference, 0 if missing
+        found = np.minimum(np.searchsorted(ref_codes, hyp_codes), len(ref_codes) - 1)
+        in_ref = ref_codes[found] == hyp_codes if len(ref_codes) else False
+        clipped = np.where(in_ref, np.minimum(hyp_counts, ref_counts[found] if len(ref_codes) else 0), 0)
+        matches[n - 1] = np.bincount(hyp_codes // (keys.max() + 1), weights=clipped,
+                                     minlength=n_sentences)
+    return matches
+
+# BLEU from matches and n-gram counts (at least 1) as nltk computes it:
+# precisions of orders without matches are smoothed to EPSILON / count
+# (method1), the score is 0 without unigram matches and the brevity penalty
+# uses the hypothesis and reference lengths. Works elementwise on arrays of
+# sentences
+def combine(matches, totals, hyp_len, ref_len):
+    precisions = np.where(matches == 0, EPSILON, matches) / totals
+    log_mean = np.log(precisions).mean(axis=0)
+    with np.errstate(divide='ignore'):
+        penalty = np.where(hyp_len > ref_len, 1.0,
+                           np.exp(1 - ref_len / np.maximum(hyp_len, 1)))
+    return np.where((matches[0] == 0) | (hyp_len == 0), 0.0, penalty * np.exp(log_mean))
+
+# Mean score per source length with the 1.65 standard error band, as plotted
+# by bleu_summary
+def length_buckets(scores, lengths):
+    uniq_lengths, inverse, counts = np.unique(lengths, return_inverse=True, return_counts=True)
+    means = np.bincount(inverse, weights=scores) / counts
+    var = np.bincount(inverse, weights=(scores - means[inverse]) ** 2) / counts
+    err = np.sqrt(var / counts) * 1.65
+    return Buckets(list(uniq_lengths), list(means), list(means + err), list(means - err))
+
+# Sentence scores, corpus BLEU and, given the source length of every sentence,
+# the per-length buckets of hypotheses against single references
+def bleu(hyp_ids, hyp_offsets, ref_ids, ref_offsets, lengths=None, max_n=MAX_N):
+    hyp_len = np.diff(hyp_offsets)
+    ref_len = np.diff(ref_offsets)
+    matches = clipped_matches(hyp_ids, hyp_offsets, ref_ids, ref_offsets, max_n)
+    totals = np.maximum(hyp_len - np.arange(max_n)[:, None], 1)
+    sentences = combine(matches, totals, hyp_len, ref_len)
+    corpus = float(combine(matches.sum(axis=1), totals.sum(axis=1), hyp_len.sum(), ref_len.sum()))
+    buckets = None if lengths is None else length_buckets(sentences, np.asarray(lengths))
+    return Bleu(sentences, corpus, buckets)
+
+# bleu on lists of tokens
+def bleu_tokens(hyps, refs, lengths=None, max_n=MAX_N):
+    index = {}
+    return bleu(*encode(hyps, index), *encode(refs, index), lengths, max_n)
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""checkpoint.py
+
+Epoch checkpoints written in the background, so training does not wait for
+Drive. save() copies the state dict to CPU memory and returns; a writer
+thread serializes the copy, writes it to a temporary file next to the
+checkpoint and renames it into place, so a checkpoint path only ever holds a
+complete file. With verify=True the temporary file is read back and its
+SHA-256 compared with the serialized bytes before the rename.
+
+    checkpoints = CheckpointWriter()
+    for epoch in range(N_EPOCHS):
+        checkpoints.save(model.state_dict(), f'{folder}/epoch-{epoch}.pt')
+        train(...)
+    checkpoints.wait()
+
+The model keeps training on its own weights; there is no need to load the
+checkpoint back. At most one snapshot waits while another is written, and an
+error of the writer is raised by the next save or wait.
+
+TrainingState saves everything needed to resume training mid-epoch through
+the same writer.
+"""
+
+import io
+import os
+import copy
+import random
+import queue
+import hashlib
+import threading
+import numpy as np
+import torch
+
+# A CPU copy of a state dict that later training steps cannot change. Nested
+# states (optimizer, training state) are copied all the way down, and the
+# _metadata that load_state_dict uses for older checkpoint versions is kept
+def snapshot(state):
+    if isinstance(state, torch.Tensor):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        copied = type(state)((key, snapshot(value)) for key, value in state.items())
+        if hasattr(state, '_metadata'):
+            copied._metadata = state._metadata
+        return copied
+    if isinstance(state, (list, tuple)):
+        return type(state)(snapshot(value) for value in state)
+    return copy.deepcopy(state)
+
+def write_atomic(data, path, verify=False):
+    tmp_path = f'{path}.tmp'
+    digest = hashlib.sha256(data).digest() if verify else None
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    if verify:
+        with open(tmp_path, 'rb') as f:
+            if hashlib.sha256(f.read()).digest() != digest:
+                os.remove(tmp_path)
+                raise IOError(f'checkpoint {path} does not match what was written')
+    os.replace(tmp_path, path)
+
+class CheckpointWriter:
+    def __init__(self, verify=False):
+        self.verify = verify
+        self.error = None
+        self.queue = queue.Queue(maxsize=1)
+        self.thread = threading.Thread(target=self.write, daemon=True)
+        self.thread.start()
+
+    def save(self, state_dict, path):
+        self.check()
+        self.queue.put((snapshot(state_dict), path))
+
+    # Blocks until every checkpoint saved so far is on disk
+    def wait(self):
+        self.queue.join()
+        self.check()
+
+    def check(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def write(self):
+        while True:
+            state_dict, path = self.queue.get()
+            try:
+                buffer = io.BytesIO()
+                torch.save(state_dict, buffer)
+                write_atomic(buffer.getvalue(), path, self.verify)
+            except Exception as error:
+                self.error = error
+            finally:
+                self.queue.task_done()
+
+# States of all random number generators, in plain Python types and tensors
+# so that torch.load can read them back without unpickling arbitrary objects
+def rng_state():
+    name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    return {'python': random.getstate(),
+            'numpy': (name, keys.tolist(), pos, has_gauss, cached_gaussian),
+            'torch': torch.get_rng_state(),
+            'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else []}
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    name, keys, pos, has_gauss, cached_gaussian = state['numpy']
+    np.random.set_state((name, np.array(keys, dtype=np.uint32), pos, has_gauss, cached_gaussian))
+    torch.set_rng_state(state['torch'])
+    if state['cuda']:
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+# Everything needed to continue training where it stopped: model, optimizer,
+# random number generators, the place of the iterator in the epoch and the
+# loss summed so far in that epoch. train calls step after every batch, which
+# saves the state every `every` batches, and the epoch loop calls end_epoch.
+# After a restart resume loads the last state, and with a MappedIterator
+# training continues with the same batches, dropout masks and optimizer
+# moments as if it had not stopped. A StreamingIterator cannot continue inside
+# an epoch (its state has position 0); a run with one resumes at the start of
+# the unfinished epoch, with the weights it had reached, and that epoch's
+# loss is summed afresh.
+#
+#     state = TrainingState(f'{folder}/training-state.pt', model, optimizer,
+#                           train_iterator, every = 1000, writer = checkpoints)
+#     for epoch in range(state.resume(), N_EPOCHS):
+#         train_loss = train(model, train_iterator, optimizer, criterion, state = state)
+#         state.end_epoch()
+class TrainingState:
+    def __init__(self, path, model, optimizer, iterator, every=None, writer=None):
+        self.path = path
+        self.model = model
+        self.optimizer = optimizer
+        self.iterator = iterator
+        self.every = every
+        self.writer = writer if writer is not None else CheckpointWriter()
+        self.epoch = 0
+        self.epoch_step = 0
+        self.epoch_loss = 0.0
+
+    # The epoch to continue with: the saved one, or start_epoch when nothing
+    # was saved yet
+    def resume(self, start_epoch=0):
+        if not os.path.exists(self.path):
+            self.epoch = start_epoch
+            return self.epoch
+        state = torch.load(self.path, map_location='cpu')
+        self.model.load_state_dict(state['model'])
+        self.optimizer.load_state_dict(state['optimizer'])
+        self.iterator.load_state_dict(state['iterator'])
+        set_rng_state(state['rng'])
+        self.epoch, self.epoch_step, self.epoch_loss = state['epoch'], state['epoch_step'], state['epoch_loss']
+        if state['iterator']['position'] == 0:
+            # the iterator starts the epoch over
+            self.epoch_step, self.epoch_loss = 0, 0.0
+        return self.epoch
+
+    # True after resuming in the middle of an epoch
+    def mid_epoch(self):
+        return self.epoch_step > 0
+
+    def step(self, epoch_loss):
+        self.epoch_step += 1
+        self.epoch_loss = epoch_loss
+        if self.every and self.epoch_step % self.every == 0:
+            self.save()
+
+    def end_epoch(self):
+        self.epoch += 1
+        self.epoch_step = 0
+        self.epoch_loss = 0.0
+        self.save()
+
+    def save(self):
+        self.writer.save({'model': self.model.state_dict(), 'optimizer': self.optimizer.state_dict(),
+                          'iterator': self.iterator.state_dict(), 'rng': rng_state(),
+                          'epoch': self.epoch, 'epoch_step': self.epoch_step,
+                          'epoch_loss': float(self.epoch_loss)}, self.path)
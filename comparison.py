@@ -13,6 +13,11 @@ import torch.optim as optim
 import torch.nn.functional as F
 from torchtext.datasets import TranslationDataset, Multi30k, IWSLT, WMT14
 from torchtext.data import Field, BucketIterator, Iterator
+from corpus import CompactExamples, dice_candidates, load_vocab
+from hypotheses import HypothesisCache, state_hash
+from search import beam_search, source_batch, translate_batches, translate_sentences
+from precision import autocast, autocast_dtype, mixed_precision
+from attention import AdditiveAttention
 import spacy
 import numpy as np
 import random
@@ -20,7 +25,7 @@ import math
 import time
 from collections import defaultdict
 from matplotlib import pyplot as plt
-from nltk.translate.bleu_score import sentence_bleu, SmoothingFunction
+from bleu import bleu, encode, length_buckets
 import itertools
 
 # Commented out IPython magic to ensure Python compatibility.
@@ -61,10 +66,6 @@ SRC = Field(init_token=sos_token,
 
 # Commented out IPython magic to ensure Python compatibility.
 # %%capture
-# train_data, _, _ = IWSLT.splits(exts = ('.de', '.en'), 
-#                         fields = (SRC, TRG),
-#                         filter_pred=lambda x: len(x.__dict__['src']) <= 50)
-# 
 # test_10, valid_10, valid_12 = IWSLT.splits(exts = ('.de', '.en'), 
 #                                 fields = (SRC, TRG),
 #                                 train='IWSLT16.TED.tst2010',
@@ -89,11 +90,41 @@ SRC = Field(init_token=sos_token,
 # valid_data = [valid_10, valid_12]
 # test_data = [test_10, test_11, test_12, test_13, test_13x, test_14x, test_14]
 
-SRC.build_vocab(train_data, max_size=10000)
-TRG.build_vocab(train_data, max_size=10000)
+# Vocabulary the models were trained with, saved by the training notebook
+load_vocab('/content/drive/My Drive/ml-mini-project/bidirectional-attention/vocab.json', src=SRC, trg=TRG)
+
+# The evaluation sets as token id arrays (see corpus.py). Examples give back
+# their token lists on demand, and src_unk tells whether the source has words
+# outside the vocabulary.
+valid_data = [CompactExamples.from_examples(d, SRC) for d in valid_data]
+test_data = [CompactExamples.from_examples(d, SRC) for d in test_data]
 
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
+# Translations already made with the same weights and beam settings, kept on
+# Drive so that reruns of the notebook do not decode them again
+hypotheses = HypothesisCache('/content/drive/My Drive/ml-mini-project/hypotheses.db')
+
+# Target vocabulary shortlist for decoding. A source batch gets the top_n most
+# frequent target words (which include the special tokens) plus, for each of
+# its words, the top_k target words that co-occur with it most strongly in the
+# training pairs (Dice coefficient, see corpus.dice_candidates). Enable it on
+# a search model with model.shortlist = Shortlist(train_corpus).to(device),
+# where train_corpus is the preprocessed training set the vocabulary was built
+# from, MappedCorpus("/content/drive/My Drive/data/iwslt-de-en.bin", 'train',
+# max_len = 50). The buffers are not persistent, so checkpoints are unaffected.
+class Shortlist(nn.Module):
+    def __init__(self, corpus, top_k=20, top_n=1000):
+        super().__init__()
+        words, scores = dice_candidates(corpus, SRC, TRG, top_k)
+        # source words never seen in training have no candidates of their own
+        table = torch.from_numpy(words).masked_fill(torch.from_numpy(scores == 0), TRG.vocab.stoi[TRG.eos_token])
+        self.register_buffer('table', table, persistent=False)
+        self.register_buffer('frequent', torch.arange(min(top_n, len(TRG.vocab))), persistent=False)
+
+    def forward(self, src):
+        return torch.unique(torch.cat((self.frequent, self.table[src].view(-1))))
+
 class Encoder(nn.Module):
     def __init__(self, input_dim, emb_dim, hid_dim):
         super().__init__()
@@ -101,8 +132,11 @@ class Encoder(nn.Module):
         self.embedding = nn.Embedding(input_dim, emb_dim)
         self.rnn = nn.GRU(emb_dim, hid_dim)
         
-    def forward(self, src):
+    def forward(self, src, src_len = None):
         embedded = self.embedding(src)
+        if src_len is not None:
+            # Packing skips the <pad> positions at the end of shorter sentences
+            embedded = nn.utils.rnn.pack_padded_sequence(embedded, src_len.cpu(), enforce_sorted = False)
         outputs, hidden = self.rnn(embedded)
         return hidden
 
@@ -138,7 +172,8 @@ class EncoderDecoder(nn.Module):
         trg_len = trg.shape[0]
         trg_vocab_size = self.decoder.output_dim
         outputs = torch.zeros(trg_len, batch_size, trg_vocab_size).to(self.device)
-        context = self.encoder(src)
+        src_len = (src != SRC.vocab.stoi[SRC.pad_token]).sum(0)
+        context = self.encoder(src, src_len)
         hidden = context
         input = trg[0,:]
         
@@ -152,30 +187,14 @@ class EncoderDecoder(nn.Module):
         return outputs
         
     def translate(self, sentence, max_len=50, beam_width=3):
+        return self.translate_batch([sentence], max_len, beam_width)[0]
+
+    def translate_batch(self, sentences, max_len=50, beam_width=3):
         self.eval()
-        src = SRC.process([sentence]).to(device)
-        context = self.encoder(src)
-        hidden = context
-        beams = [(0.0, [TRG.vocab.stoi[TRG.init_token]], hidden)]
-        done = False
-        log_smax = nn.LogSoftmax(dim=0).to(device)
-
-        while not done:
-            for i in range(len(beams)):
-                p, sent, hidden = beams.pop(0)
-                if len(sent) >= max_len or sent[-1] == TRG.vocab.stoi[TRG.eos_token]:
-                    beams += [(p, sent, hidden)]
-                    continue
-                trg = torch.ones(1, dtype=torch.int64).to(device) * sent[-1]
-                pred, hidden = self.decoder(trg, hidden, context)
-                ll = log_smax(pred[0])
-                top_ll, top_t = torch.topk(ll, k=beam_width)
-                beams += [(p + ll, sent + [t], hidden) for ll, t in zip(top_ll, top_t)]
-            beams = sorted(beams, reverse=True)[:beam_width]
-            done = all([b[1][-1] == TRG.vocab.stoi[TRG.eos_token] or len(b[1]) >= max_len for b in beams])
-
-        trgs = beams.pop(0)[1]
-        return [TRG.vocab.itos[i] for i in trgs]
+        src, src_len, _ = source_batch(SRC, sentences, device)
+        context = self.encoder(src, src_len)
+        trgs = beam_search(self.decoder, context, context, TRG, max_len, beam_width)
+        return [[TRG.vocab.itos[i] for i in t] for t in trgs]
 
 class EncoderBi(nn.Module):
     def __init__(self, input_dim, emb_dim, hid_dim):
@@ -184,8 +203,11 @@ class EncoderBi(nn.Module):
         self.embedding = nn.Embedding(input_dim, emb_dim)
         self.rnn = nn.GRU(emb_dim, hid_dim, bidirectional = True)
         
-    def forward(self, src):
+    def forward(self, src, src_len = None):
         embedded = self.embedding(src)
+        if src_len is not None:
+            # Packing skips the <pad> positions at the end of shorter sentences
+            embedded = nn.utils.rnn.pack_padded_sequence(embedded, src_len.cpu(), enforce_sorted = False)
         outputs, hidden = self.rnn(embedded)
         return hidden[-1,:,:].unsqueeze(0)
 
@@ -221,7 +243,8 @@ class EncoderDecoderBi(nn.Module):
         trg_len = trg.shape[0]
         trg_vocab_size = self.decoder.output_dim
         outputs = torch.zeros(trg_len, batch_size, trg_vocab_size).to(self.device)
-        context = self.encoder(src)
+        src_len = (src != SRC.vocab.stoi[SRC.pad_token]).sum(0)
+        context = self.encoder(src, src_len)
         hidden = context
         input = trg[0,:]
         
@@ -235,30 +258,14 @@ class EncoderDecoderBi(nn.Module):
         return outputs
         
     def translate(self, sentence, max_len=50, beam_width=3):
+        return self.translate_batch([sentence], max_len, beam_width)[0]
+
+    def translate_batch(self, sentences, max_len=50, beam_width=3):
         self.eval()
-        src = SRC.process([sentence]).to(device)
-        context = self.encoder(src)
-        hidden = context
-        beams = [(0.0, [TRG.vocab.stoi[TRG.init_token]], hidden)]
-        done = False
-        log_smax = nn.LogSoftmax(dim=0).to(device)
-
-        while not done:
-            for i in range(len(beams)):
-                p, sent, hidden = beams.pop(0)
-                if len(sent) >= max_len or sent[-1] == TRG.vocab.stoi[TRG.eos_token]:
-                    beams += [(p, sent, hidden)]
-                    continue
-                trg = torch.ones(1, dtype=torch.int64).to(device) * sent[-1]
-                pred, hidden = self.decoder(trg, hidden, context)
-                ll = log_smax(pred[0])
-                top_ll, top_t = torch.topk(ll, k=beam_width)
-                beams += [(p + ll, sent + [t], hidden) for ll, t in zip(top_ll, top_t)]
-            beams = sorted(beams, reverse=True)[:beam_width]
-            done = all([b[1][-1] == TRG.vocab.stoi[TRG.eos_token] or len(b[1]) >= max_len for b in beams])
-
-        trgs = beams.pop(0)[1]
-        return [TRG.vocab.itos[i] for i in trgs]
+        src, src_len, _ = source_batch(SRC, sentences, device)
+        context = self.encoder(src, src_len)
+        trgs = beam_search(self.decoder, context, context, TRG, max_len, beam_width)
+        return [[TRG.vocab.itos[i] for i in t] for t in trgs]
 
 class EncoderAttn(nn.Module):
     def __init__(self, input_dim, emb_dim, enc_hid_dim, dec_hid_dim):
@@ -266,29 +273,19 @@ class EncoderAttn(nn.Module):
         self.embedding = nn.Embedding(input_dim, emb_dim)
         self.rnn = nn.GRU(emb_dim, enc_hid_dim)
 
-    def forward(self, src):
+    def forward(self, src, src_len = None):
         embedded = self.embedding(src)
+        if src_len is not None:
+            # Packing skips the <pad> positions at the end of shorter sentences
+            embedded = nn.utils.rnn.pack_padded_sequence(embedded, src_len.cpu(), enforce_sorted = False)
         outputs, hidden = self.rnn(embedded)
+        if src_len is not None:
+            outputs, _ = nn.utils.rnn.pad_packed_sequence(outputs, total_length = src.shape[0])
         return outputs, hidden.squeeze(0)
 
-class Attention(nn.Module):
+class Attention(AdditiveAttention):
     def __init__(self, enc_hid_dim, dec_hid_dim):
-        super().__init__()
-        
-        self.attn = nn.Linear(enc_hid_dim + dec_hid_dim, dec_hid_dim)
-        self.v = nn.Linear(dec_hid_dim, 1, bias = False)
-        
-    def forward(self, hidden, encoder_outputs):
-        batch_size = encoder_outputs.shape[1]
-        src_len = encoder_outputs.shape[0]
-        
-        hidden = hidden.unsqueeze(1).repeat(1, src_len, 1)
-        encoder_outputs = encoder_outputs.permute(1, 0, 2)
-        
-        energy = torch.tanh(self.attn(torch.cat((hidden, encoder_outputs), dim = 2))) 
-        attention = self.v(energy).squeeze(2)
-        
-        return F.softmax(attention, dim=1)
+        super().__init__(enc_hid_dim, dec_hid_dim)
 
 class DecoderAttn(nn.Module):
     def __init__(self, output_dim, emb_dim, enc_hid_dim, dec_hid_dim, attention):
@@ -299,10 +296,10 @@ class DecoderAttn(nn.Module):
         self.rnn = nn.GRU(enc_hid_dim + emb_dim, dec_hid_dim)
         self.fc_out = nn.Linear(enc_hid_dim + dec_hid_dim + emb_dim, output_dim)
         
-    def forward(self, input, hidden, encoder_outputs):
+    def forward(self, input, hidden, encoder_outputs, keys = None, mask = None):
         input = input.unsqueeze(0)
         embedded = self.embedding(input)
-        a = self.attention(hidden, encoder_outputs)
+        a = self.attention(hidden, encoder_outputs, keys, mask)
         a = a.unsqueeze(1)
         encoder_outputs = encoder_outputs.permute(1, 0, 2)
         weighted = torch.bmm(a, encoder_outputs)
@@ -329,11 +326,13 @@ class Search(nn.Module):
         trg_vocab_size = self.decoder.output_dim
         
         outputs = torch.zeros(trg_len, batch_size, trg_vocab_size).to(self.device)
-        encoder_outputs, hidden = self.encoder(src)
+        mask = (src != SRC.vocab.stoi[SRC.pad_token]).permute(1, 0)
+        encoder_outputs, hidden = self.encoder(src, mask.sum(1))
+        keys = self.decoder.attention.project_keys(encoder_outputs)
         input = trg[0,:]
         
         for t in range(1, trg_len):
-            output, hidden = self.decoder(input, hidden, encoder_outputs)
+            output, hidden = self.decoder(input, hidden, encoder_outputs, keys, mask)
             outputs[t] = output
             teacher_force = random.random() < teacher_forcing_ratio
             top1 = output.argmax(1)
@@ -343,29 +342,16 @@ class Search(nn.Module):
 
         
     def translate(self, sentence, max_len=50, beam_width=3):
+        return self.translate_batch([sentence], max_len, beam_width)[0]
+
+    def translate_batch(self, sentences, max_len=50, beam_width=3):
         self.eval()
-        src = SRC.process([sentence]).to(device)
-        encoder_out, hidden = self.encoder(src)
-        beams = [(0.0, [TRG.vocab.stoi[TRG.init_token]], hidden)]
-        done = False
-        log_smax = nn.LogSoftmax(dim=0).to(device)
-
-        while not done:
-            for i in range(len(beams)):
-                p, sent, hidden = beams.pop(0)
-                if len(sent) >= max_len or sent[-1] == TRG.vocab.stoi[TRG.eos_token]:
-                    beams += [(p, sent, hidden)]
-                    continue
-                trg = torch.ones(1, dtype=torch.int64).to(device) * sent[-1]
-                pred, hidden = self.decoder(trg, hidden, encoder_out)
-                ll = log_smax(pred[0])
-                top_ll, top_t = torch.topk(ll, k=beam_width)
-                beams += [(p + ll, sent + [t], hidden) for ll, t in zip(top_ll, top_t)]
-            beams = sorted(beams, reverse=True)[:beam_width]
-            done = all([b[1][-1] == TRG.vocab.stoi[TRG.eos_token] or len(b[1]) >= max_len for b in beams])
-
-        trgs = beams.pop(0)[1]
-        return [TRG.vocab.itos[i] for i in trgs]
+        src, src_len, mask = source_batch(SRC, sentences, device)
+        encoder_out, hidden = self.encoder(src, src_len)
+        keys = self.decoder.attention.project_keys(encoder_out)
+        with self.decoder.attention.decoding():
+            trgs = beam_search(self.decoder, hidden, encoder_out, TRG, max_len, beam_width, keys, mask)
+        return [[TRG.vocab.itos[i] for i in t] for t in trgs]
 
 class EncoderAttnBi(nn.Module):
     def __init__(self, input_dim, emb_dim, enc_hid_dim, dec_hid_dim):
@@ -373,29 +359,19 @@ class EncoderAttnBi(nn.Module):
         self.embedding = nn.Embedding(input_dim, emb_dim)
         self.rnn = nn.GRU(emb_dim, enc_hid_dim, bidirectional = True)
         
-    def forward(self, src):
+    def forward(self, src, src_len = None):
         embedded = self.embedding(src)
+        if src_len is not None:
+            # Packing skips the <pad> positions at the end of shorter sentences
+            embedded = nn.utils.rnn.pack_padded_sequence(embedded, src_len.cpu(), enforce_sorted = False)
         outputs, hidden = self.rnn(embedded)
+        if src_len is not None:
+            outputs, _ = nn.utils.rnn.pad_packed_sequence(outputs, total_length = src.shape[0])
         return outputs, hidden[1]
 
-class AttentionBi(nn.Module):
+class AttentionBi(AdditiveAttention):
     def __init__(self, enc_hid_dim, dec_hid_dim):
-        super().__init__()
-        
-        self.attn = nn.Linear(2 * enc_hid_dim + dec_hid_dim, dec_hid_dim)
-        self.v = nn.Linear(dec_hid_dim, 1, bias = False)
-        
-    def forward(self, hidden, encoder_outputs):
-        batch_size = encoder_outputs.shape[1]
-        src_len = encoder_outputs.shape[0]
-        
-        hidden = hidden.unsqueeze(1).repeat(1, src_len, 1)
-        encoder_outputs = encoder_outputs.permute(1, 0, 2)
-        
-        energy = torch.tanh(self.attn(torch.cat((hidden, encoder_outputs), dim = 2))) 
-        attention = self.v(energy).squeeze(2)
-        
-        return F.softmax(attention, dim=1)
+        super().__init__(2 * enc_hid_dim, dec_hid_dim)
 
 class DecoderAttnBi(nn.Module):
     def __init__(self, output_dim, emb_dim, enc_hid_dim, dec_hid_dim, attention):
@@ -406,10 +382,12 @@ class DecoderAttnBi(nn.Module):
         self.rnn = nn.GRU((enc_hid_dim * 2) + emb_dim, dec_hid_dim)
         self.fc_out = nn.Linear((enc_hid_dim * 2) + dec_hid_dim + emb_dim, output_dim)
         
-    def forward(self, input, hidden, encoder_outputs):
+    def forward(self, input, hidden, encoder_outputs, keys = None, mask = None, fc_out = None):
+        if fc_out is None:
+            fc_out = self.fc_out
         input = input.unsqueeze(0)
         embedded = self.embedding(input)
-        a = self.attention(hidden, encoder_outputs)
+        a = self.attention(hidden, encoder_outputs, keys, mask)
         a = a.unsqueeze(1)
         encoder_outputs = encoder_outputs.permute(1, 0, 2)
         weighted = torch.bmm(a, encoder_outputs)
@@ -420,7 +398,7 @@ class DecoderAttnBi(nn.Module):
         output = output.squeeze(0)
         weighted = weighted.squeeze(0)
         
-        prediction = self.fc_out(torch.cat((output, weighted, embedded), dim = 1))
+        prediction = fc_out(torch.cat((output, weighted, embedded), dim = 1))
         return prediction, hidden.squeeze(0)
 
 class SearchBi(nn.Module):
@@ -429,6 +407,7 @@ class SearchBi(nn.Module):
         self.encoder = encoder
         self.decoder = decoder
         self.device = device
+        self.shortlist = None
         
     def forward(self, src, trg, teacher_forcing_ratio = 0.5):
         batch_size = src.shape[1]
@@ -436,11 +415,13 @@ class SearchBi(nn.Module):
         trg_vocab_size = self.decoder.output_dim
         
         outputs = torch.zeros(trg_len, batch_size, trg_vocab_size).to(self.device)
-        encoder_outputs, hidden = self.encoder(src)
+        mask = (src != SRC.vocab.stoi[SRC.pad_token]).permute(1, 0)
+        encoder_outputs, hidden = self.encoder(src, mask.sum(1))
+        keys = self.decoder.attention.project_keys(encoder_outputs)
         input = trg[0,:]
         
         for t in range(1, trg_len):
-            output, hidden = self.decoder(input, hidden, encoder_outputs)
+            output, hidden = self.decoder(input, hidden, encoder_outputs, keys, mask)
             outputs[t] = output
             teacher_force = random.random() < teacher_forcing_ratio
             top1 = output.argmax(1)
@@ -450,29 +431,17 @@ class SearchBi(nn.Module):
 
         
     def translate(self, sentence, max_len=50, beam_width=3):
+        return self.translate_batch([sentence], max_len, beam_width)[0]
+
+    def translate_batch(self, sentences, max_len=50, beam_width=3):
         self.eval()
-        src = SRC.process([sentence]).to(device)
-        encoder_out, hidden = self.encoder(src)
-        beams = [(0.0, [TRG.vocab.stoi[TRG.init_token]], hidden)]
-        done = False
-        log_smax = nn.LogSoftmax(dim=0).to(device)
-
-        while not done:
-            for i in range(len(beams)):
-                p, sent, hidden = beams.pop(0)
-                if len(sent) >= max_len or sent[-1] == TRG.vocab.stoi[TRG.eos_token]:
-                    beams += [(p, sent, hidden)]
-                    continue
-                trg = torch.ones(1, dtype=torch.int64).to(device) * sent[-1]
-                pred, hidden = self.decoder(trg, hidden, encoder_out)
-                ll = log_smax(pred[0])
-                top_ll, top_t = torch.topk(ll, k=beam_width)
-                beams += [(p + ll, sent + [t], hidden) for ll, t in zip(top_ll, top_t)]
-            beams = sorted(beams, reverse=True)[:beam_width]
-            done = all([b[1][-1] == TRG.vocab.stoi[TRG.eos_token] or len(b[1]) >= max_len for b in beams])
-
-        trgs = beams.pop(0)[1]
-        return [TRG.vocab.itos[i] for i in trgs]
+        src, src_len, mask = source_batch(SRC, sentences, device)
+        encoder_out, hidden = self.encoder(src, src_len)
+        keys = self.decoder.attention.project_keys(encoder_out)
+        vocab = None if self.shortlist is None else self.shortlist(src)
+        with self.decoder.attention.decoding():
+            trgs = beam_search(self.decoder, hidden, encoder_out, TRG, max_len, beam_width, keys, mask, vocab)
+        return [[TRG.vocab.itos[i] for i in t] for t in trgs]
 
 INPUT_DIM = len(SRC.vocab)
 OUTPUT_DIM = len(TRG.vocab)
@@ -499,48 +468,52 @@ enc = EncoderAttnBi(INPUT_DIM, ENC_EMB_DIM, HID_DIM, HID_DIM)
 dec = DecoderAttnBi(OUTPUT_DIM, DEC_EMB_DIM, HID_DIM, HID_DIM, att)
 search_bi = SearchBi(enc, dec, device).to(device)
 
+# Lets every model run in bfloat16 inside autocast(), see precision.py
+for model in [enc_dec, search, enc_dec_bi, search_bi]:
+    mixed_precision(model)
+
+# Every example of datasets decoded once by model and scored against its
+# reference. evaluate_bleu scores the hypotheses without <sos> and the last
+# two tokens, bleu_summary the whole output, and both can leave out the
+# examples with an unknown source word, so all of them are kept here. preds
+# are hypotheses decoded already, one per example
+class Evaluation:
+    def __init__(self, model, datasets, preds=None):
+        examples = list(itertools.chain(*datasets))
+        if preds is None:
+            preds = translate_sentences(model, [example.src for example in examples], hypotheses)
+        index = {}
+        refs = encode([example.trg for example in examples], index)
+        self.scores = bleu(*encode([pred[1:-2] for pred in preds], index), *refs).sentences
+        self.summary_scores = bleu(*encode(preds, index), *refs).sentences
+        self.lengths = np.array([len(example.src) for example in examples])
+        self.src_unk = np.array([bool(example.src_unk) for example in examples])
+
+    def mean(self, ignore_unk=False):
+        return self.scores[~(ignore_unk & self.src_unk)].mean()
+
+    # mean BLEU per source length with its 1.65 standard error band
+    def summary(self, ignore_unk=False):
+        keep = ~(ignore_unk & self.src_unk) & (self.lengths != 0)
+        return length_buckets(self.summary_scores[keep], self.lengths[keep])
+
+# Evaluations by the model's weights (hashed as for the hypothesis cache), the
+# autocast dtype and the datasets, so that a model is decoded only once for
+# all the plots and loading other weights gives a new evaluation. The datasets
+# are kept with their evaluation, so their ids cannot be reused
+evaluations = {}
+
+def evaluation(model, datasets):
+    key = (state_hash(model), autocast_dtype(), tuple(id(d) for d in datasets))
+    if key not in evaluations:
+        evaluations[key] = (list(datasets), Evaluation(model, datasets))
+    return evaluations[key][1]
+
 def evaluate_bleu(model, datasets, ignore_unk=False):
-    total = 0.0
-    count = 0.0
-    for i, example in enumerate(itertools.chain(*datasets)):
-        sent = SRC.process([example.src])
-        if ignore_unk and SRC.vocab.stoi[SRC.unk_token] in sent:
-            continue
-        pred = model.translate(example.src)[1:-2]
-        total += sentence_bleu([example.trg], pred, smoothing_function=SmoothingFunction().method1)
-        count += 1
-        if i % 200 == 199: print('.', end='')
-    print('')
-    return total / count
+    return evaluation(model, datasets).mean(ignore_unk)
     
 def bleu_summary(model, datasets, ignore_unk=False):
-    overall_examples = sum([len(d) for d in datasets])
-    lengths = np.zeros(overall_examples, dtype=np.int32)
-    scores = np.zeros(overall_examples)
-
-    for i, example in enumerate(itertools.chain(*datasets)):
-        sent = SRC.process([example.src])
-        if ignore_unk and SRC.vocab.stoi[SRC.unk_token] in sent:
-            continue
-        pred = model.translate(example.src)
-        scores[i] = sentence_bleu([example.trg], pred, smoothing_function=SmoothingFunction().method1)
-        lengths[i] = len(example.src)
-        if i % 900 == 899: print('.', end='')
-      
-    scores = scores[lengths != 0.0]    
-    lengths = lengths[lengths != 0.0]
-
-    print('')
-    means, up, lo = {}, {}, {}
-    uniq_lengths, counts = np.unique(lengths, return_counts=True)
-    for l, c in zip(uniq_lengths, counts):
-        s = scores[lengths == l]
-        means[l] = s.mean()
-        up[l] = means[l] + (np.sqrt(s.var() / c) * 1.65)
-        lo[l] = means[l] - (np.sqrt(s.var() / c) * 1.65)
-
-    uniq_lengths = [l for l in sorted(uniq_lengths)]
-    return uniq_lengths, [means[l] for l in uniq_lengths], [up[l] for l in uniq_lengths], [lo[l] for l in uniq_lengths]
+    return evaluation(model, datasets).summary(ignore_unk)
 
 enc_dec.load_state_dict(torch.load('/content/drive/My Drive/ml-mini-project/unidirectional-control/epoch-9.pt'))
 search.load_state_dict(torch.load('/content/drive/My Drive/ml-mini-project/unidirectional-attention/epoch-6.pt'))
@@ -715,3 +688,52 @@ plot_attention(src, pred, attention)
 
 pred
 
+# float32 against bfloat16 autocast (see precision.py) for the bidirectional
+# models on the validation sets: target tokens per second of decoding and of
+# training steps (forward and backward, no optimizer step), and the mean
+# validation BLEU of the bfloat16 hypotheses. Run on the CPU; bfloat16 only
+# pays off on CPUs with AVX512-BF16 or AMX
+criterion = nn.CrossEntropyLoss(ignore_index = TRG.vocab.stoi[TRG.pad_token])
+
+def valid_batches(batch_size=80):
+    examples = sorted(itertools.chain(*valid_data), key=lambda example: len(example.src))
+    chunks = [examples[i:i + batch_size] for i in range(0, len(examples), batch_size)]
+    return [(SRC.process([example.src for example in chunk]).to(device),
+             TRG.process([example.trg for example in chunk]).to(device)) for chunk in chunks]
+
+def training_rate(model, batches, bf16):
+    model.train()
+    n_tokens, elapsed = 0, 0.0
+    for k, (src, trg) in enumerate(batches):
+        start_time = time.time()
+        with autocast(bf16):
+            output = model(src, trg)
+        loss = criterion(output[1:].view(-1, output.shape[-1]), trg[1:].view(-1))
+        loss.backward()
+        model.zero_grad()
+        # the first batch warms up the kernels and is not counted
+        if k > 0:
+            elapsed += time.time() - start_time
+            n_tokens += (trg[1:] != criterion.ignore_index).sum().item()
+    return n_tokens / elapsed
+
+# Validation hypotheses, decoded without the hypothesis cache so that they are
+# timed, and the target tokens decoded per second
+def decoding_rate(model, bf16):
+    sentences = [example.src for example in itertools.chain(*valid_data)]
+    with autocast(bf16):
+        model.translate_batch(sentences[:10])
+        start_time = time.time()
+        preds = translate_batches(model, sentences)
+        elapsed = time.time() - start_time
+    return preds, sum(len(pred) - 1 for pred in preds) / elapsed
+
+if device.type == 'cpu':
+    batches = valid_batches()
+    for name, model in [('EncoderDecoderBi', enc_dec_bi), ('SearchBi', search_bi)]:
+        for bf16 in [False, True]:
+            preds, decode_rate = decoding_rate(model, bf16)
+            train_rate = training_rate(model, batches, bf16)
+            score = Evaluation(model, valid_data, preds).mean()
+            print(f'{name:>16} {"bfloat16" if bf16 else "float32":>8}: decoding {decode_rate:8.0f} tokens/s, '
+                  f'training {train_rate:8.0f} tokens/s, valid BLEU {100 * score:5.2f}')
@@ -13,6 +13,8 @@ import torch.optim as optim
 import torch.nn.functional as F
 from torchtext.datasets import TranslationDataset, Multi30k, IWSLT, WMT14
 from torchtext.data import Field, BucketIterator, Iterator
+from corpus import prepare_iwslt, MappedCorpus, MappedIterator, save_vocab
+from checkpoint import CheckpointWriter, TrainingState
 import spacy
 import numpy as np
 import random
@@ -59,24 +61,23 @@ SRC = Field(init_token=sos_token,
             pad_token=pad_token, 
             unk_token=unk_token)
 
-# Commented out IPython magic to ensure Python compatibility.
-# %%capture
-# train_data, valid_13, test_14 = IWSLT.splits(exts = ('.de', '.en'), 
-#                                             fields = (SRC, TRG),
-#                                             filter_pred=lambda x: len(x.__dict__['src']) <= 50)
+# The training set is tokenized once and kept on Drive as memory-mapped token
+# ids. The first run downloads and preprocesses it, see corpus.py
+prepare_iwslt("/content/drive/My Drive/data/iwslt-de-en.bin")
+train_data = MappedCorpus("/content/drive/My Drive/data/iwslt-de-en.bin", 'train', max_len = 50)
 
-SRC.build_vocab(train_data, max_size=10000)
-TRG.build_vocab(train_data, max_size=10000)
+train_data.build_vocab(SRC, 0, max_size=10000)
+train_data.build_vocab(TRG, 1, max_size=10000)
 
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
-BATCH_SIZE = 80
+MAX_TOKENS = 4000
 
-train_iterator, valid_iterator, test_iterator = BucketIterator.splits(
-    (train_data, valid_13, test_14), 
-    sort_key=lambda x: len(x.__dict__['src']),
-    batch_size = BATCH_SIZE, 
-    device = device)
+train_iterator = MappedIterator(
+    train_data, SRC, TRG,
+    batch_size = MAX_TOKENS, 
+    device = device,
+    num_workers = 2) # padded batches are built in background processes
 
 class Encoder(nn.Module):
     def __init__(self, input_dim, emb_dim, hid_dim):
@@ -86,8 +87,11 @@ class Encoder(nn.Module):
         self.rnn = nn.GRU(emb_dim, hid_dim, bidirectional = True)
         self.fc = nn.Linear(2 * hid_dim, hid_dim)
         
-    def forward(self, src):
+    def forward(self, src, src_len = None):
         embedded = self.embedding(src)
+        if src_len is not None:
+            # Packing skips the <pad> positions at the end of shorter sentences
+            embedded = nn.utils.rnn.pack_padded_sequence(embedded, src_len.cpu(), enforce_sorted = False)
         outputs, hidden = self.rnn(embedded)
         hidden = torch.tanh(self.fc(torch.cat((hidden[-2,:,:], hidden[-1,:,:]), dim = 1)))
         return hidden.unsqueeze(0)
@@ -123,9 +127,10 @@ class EncoderDecoder(nn.Module):
         batch_size = trg.shape[1]
         trg_len = trg.shape[0]
         trg_vocab_size = self.decoder.output_dim
-        outputs = torch.zeros(trg_len, batch_size, trg_vocab_size).to(self.device)
-        context = self.encoder(src)
+        src_len = (src != SRC.vocab.stoi[SRC.pad_token]).sum(0)
+        context = self.encoder(src, src_len)
         hidden = context
+        outputs = torch.zeros(trg_len, batch_size, trg_vocab_size).to(self.device)
         input = trg[0,:]
         
         for t in range(1, trg_len):
@@ -163,11 +168,11 @@ ed_optimizer = optim.Adam(enc_dec.parameters())
 TRG_PAD_IDX = TRG.vocab.stoi[TRG.pad_token]
 criterion = nn.CrossEntropyLoss(ignore_index = TRG_PAD_IDX)
 
-def train(model, iterator, optimizer, criterion, clip):
+def train(model, iterator, optimizer, criterion, clip, state = None):
     
     model.train()
     
-    epoch_loss = 0
+    epoch_loss = 0 if state is None else state.epoch_loss
     
     for i, batch in enumerate(iterator):
         src = batch.src
@@ -197,6 +202,7 @@ def train(model, iterator, optimizer, criterion, clip):
         optimizer.step()
         
         epoch_loss += loss.item()
+        if state is not None: state.step(epoch_loss)
         
     return epoch_loss / len(iterator)
 
@@ -209,17 +215,32 @@ def epoch_time(start_time, end_time):
 N_EPOCHS = 10
 CLIP = 1
 
-for epoch in range(N_EPOCHS):
-    torch.save(enc_dec.state_dict(), f'/content/drive/My Drive/concat-control/epoch-{epoch}.pt')
-    enc_dec.load_state_dict(torch.load(f'/content/drive/My Drive/concat-control/epoch-{epoch}.pt'))
+save_vocab('/content/drive/My Drive/concat-control/vocab.json', src=SRC, trg=TRG)
+
+# Epoch checkpoints are written to Drive in the background, see checkpoint.py
+checkpoints = CheckpointWriter()
+
+# Full training state (optimizer, random generators, place in the epoch),
+# saved every CHECKPOINT_STEPS batches and after every epoch, so that a run
+# that was stopped continues where it was, see checkpoint.py
+CHECKPOINT_STEPS = 1000
+state = TrainingState('/content/drive/My Drive/concat-control/training-state.pt',
+                      enc_dec, ed_optimizer, train_iterator,
+                      every = CHECKPOINT_STEPS, writer = checkpoints)
+
+for epoch in range(state.resume(), N_EPOCHS):
+    if not state.mid_epoch():
+        checkpoints.save(enc_dec.state_dict(), f'/content/drive/My Drive/concat-control/epoch-{epoch}.pt')
 
     start_time = time.time()
-    train_loss = train(enc_dec, train_iterator, ed_optimizer, criterion, CLIP)
+    train_loss = train(enc_dec, train_iterator, ed_optimizer, criterion, CLIP, state = state)
     end_time = time.time()
     
     epoch_mins, epoch_secs = epoch_time(start_time, end_time)
 
     print(f'Epoch: {epoch+1:02} | Time: {epoch_mins}m {epoch_secs}s')
     print(f'\tTrain Loss: {train_loss:.3f}')
+    state.end_epoch()
 
-torch.save(enc_dec.state_dict(), f'/content/drive/My Drive/concat-control/epoch-{N_EPOCHS}.pt')
\ No newline at end of file
+checkpoints.save(enc_dec.state_dict(), f'/content/drive/My Drive/concat-control/epoch-{N_EPOCHS}.pt')
+checkpoints.wait()
\ No newline at end of file
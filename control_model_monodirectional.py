@@ -13,6 +13,9 @@ import torch.optim as optim
 import torch.nn.functional as F
 from torchtext.datasets import TranslationDataset, IWSLT
 from torchtext.data import Field, Iterator
+from corpus import MappedCorpus, MappedIterator, save_vocab
+from checkpoint import CheckpointWriter, TrainingState
+from loss import sample_vocab, output_loss
 import spacy
 import numpy as np
 import random
@@ -62,17 +65,19 @@ sourceLanguage = targetLanguage = Field(sequential=True,
                                         pad_token=pad_token, 
                                         unk_token=unk_token)
 
+# The corpus is tokenized, lowercased and stored as token ids once by corpus.py
+# (run once, the result is kept next to the data):
+# !python3 corpus.py "/content/gdrive/My Drive/data/europarl-v7.fr-en.bin" --exts .en .fr --split "train=/content/gdrive/My Drive/data/europarl-v7.fr-en"
+# Loading only maps the id files into memory.
 # Filters out sentences longer than 50 in the training data.
-dataset = TranslationDataset("/content/gdrive/My Drive/data/europarl-v7.fr-en", 
-                             exts=('.en', '.fr'), 
-                             fields=(sourceLanguage, targetLanguage),
-                             filter_pred=lambda x: len(x.__dict__['src']) <= 50)
+dataset = MappedCorpus("/content/gdrive/My Drive/data/europarl-v7.fr-en.bin", 'train', max_len = 50)
 
-sourceLanguage.build_vocab(dataset, min_freq = 2, max_size = 30000)    
-targetLanguage.build_vocab(dataset, min_freq = 2, max_size = 30000)
+# sourceLanguage and targetLanguage are the same field, so its vocabulary is
+# built from both sides of the corpus.
+dataset.build_vocab(sourceLanguage, 0, 1, min_freq = 2, max_size = 30000)
 
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-BATCH_SIZE = 80
+MAX_TOKENS = 5000 # source + target tokens per batch
 INPUT_DIM  = len(sourceLanguage.vocab)
 OUTPUT_DIM = len(targetLanguage.vocab) 
 EMB_DIM = 256
@@ -81,13 +86,25 @@ MAXOUT_DIM = 400
 ATT_HID_DIM = 1000
 MAX_LENGTH = 50
 
-train_iterator = Iterator(
+train_iterator = MappedIterator(
     dataset, 
-    batch_size = BATCH_SIZE,
-    sort_key = lambda x: len(x.src),
-    device = device
+    sourceLanguage, 
+    targetLanguage, 
+    batch_size = MAX_TOKENS,
+    device = device,
+    num_workers = 2 # padded batches are built in background processes
 )
 
+# Corpora that are not preprocessed, e.g. the full WMT14 en-fr data, can be
+# streamed from their text files instead; memory then stays bounded by the
+# shuffle buffer and the vocabulary is counted in one pass over the files:
+# from corpus import StreamingCorpus, StreamingIterator
+# dataset = StreamingCorpus("/content/gdrive/My Drive/data/europarl-v7.fr-en", ('.en', '.fr'),
+#                           (sourceLanguage, targetLanguage), max_len = 50)
+# dataset.build_vocab(sourceLanguage, 0, 1, min_freq = 2, max_size = 30000)
+# train_iterator = StreamingIterator(dataset, sourceLanguage, targetLanguage,
+#                                    batch_size = MAX_TOKENS, device = device, num_workers = 2)
+
 """## ih"""
 
 class EncoderRNNEncDec(nn.Module):
@@ -98,8 +115,11 @@ class EncoderRNNEncDec(nn.Module):
         self.fc_out     = nn.Linear(hid_dim, hid_dim)
         self.activation = nn.Tanh()
         
-    def forward(self, input):
+    def forward(self, input, input_len=None):
         output          = self.embedding(input)
+        if input_len is not None:
+            # packing skips the <pad> positions at the end of shorter sentences
+            output      = nn.utils.rnn.pack_padded_sequence(output, input_len.cpu(), enforce_sorted=False)
         output, hidden  = self.rnn(output)
         output          = self.activation(self.fc_out(hidden.squeeze(0)))
         output          = output.unsqueeze(0)
@@ -128,19 +148,45 @@ class DecoderRNNEncDec(nn.Module):
         output          = self.out(output)
         return output, hidden
 
+    # Teacher forced decoding of a whole [trg len, batch] input. The context is
+    # constant, so the GRU runs once over the full sequence and the maxout and
+    # output layers run as single batched matmuls over all steps.
+    def forward_sequence(self, input, hidden, context):
+        output, hidden  = self.features_sequence(input, hidden, context)
+        output          = self.out(output)
+        return output, hidden
+
+    # forward_sequence up to the maxout layer, i.e. without the output layer
+    def features_sequence(self, input, hidden, context):
+        embedded        = self.embedding(input)
+        context         = context.expand(input.shape[0], -1, -1)
+        output          = torch.cat((embedded, context), dim = 2)
+        output, hidden  = self.rnn(output, hidden)
+        output          = torch.cat((embedded, output, context), dim = 2)
+        output          = self.max_out(output)
+        output          = output.view(input.shape[0], input.shape[1], self.max_dim, 2)
+        output, _       = torch.max(output, 3)
+        return output, hidden
+
 class Seq2Seq(nn.Module):
-    def __init__(self, input_dim, emb_dim, hid_dim, output_dim, max_dim):
+    def __init__(self, input_dim, emb_dim, hid_dim, output_dim, max_dim, n_samples=0):
         super(Seq2Seq, self).__init__()
         self.fc_in      = nn.Linear(hid_dim, hid_dim)
         self.fc_act     = nn.Tanh()
         self.encoder    = EncoderRNNEncDec(input_dim, emb_dim, hid_dim)
         self.decoder    = DecoderRNNEncDec(output_dim, emb_dim, hid_dim, max_dim)
         self.output_dim = output_dim
+        self.n_samples  = n_samples # words sampled per batch, 0 for the full softmax
     
     def forward(self, src, trg, is_train=False):
-        context         = self.encoder(src)
+        src_len         = (src != sourceLanguage.vocab.stoi[sourceLanguage.pad_token]).sum(0)
+        context         = self.encoder(src, src_len)
         decoder_hidden  = self.fc_in(context.squeeze(0))
         decoder_hidden  = self.fc_act(decoder_hidden).unsqueeze(0)
+        if is_train:
+            # outputs[0] is never predicted, a zero row keeps the usual shape
+            output, _   = self.decoder.forward_sequence(trg[:-1], decoder_hidden, context)
+            return torch.cat((output.new_zeros(1, *output.shape[1:]), output))
         outputs         = torch.zeros(trg.shape[0], 
                                       trg.shape[1], 
                                       self.output_dim).to(device)
@@ -153,25 +199,36 @@ class Seq2Seq(nn.Module):
             input = trg[t] if is_train else decoder_output.argmax(1)
         return outputs
 
+    # Teacher forced training loss of trg[1:]. With n_samples set the output
+    # layer is only evaluated on a sampled target vocabulary (see output_loss).
+    def loss(self, src, trg, criterion):
+        src_len         = (src != sourceLanguage.vocab.stoi[sourceLanguage.pad_token]).sum(0)
+        context         = self.encoder(src, src_len)
+        decoder_hidden  = self.fc_act(self.fc_in(context.squeeze(0))).unsqueeze(0)
+        if not self.n_samples:
+            outputs, _  = self.decoder.forward_sequence(trg[:-1], decoder_hidden, context)
+            return criterion(outputs.view(-1, self.output_dim), trg[1:].view(-1))
+        features, _     = self.decoder.features_sequence(trg[:-1], decoder_hidden, context)
+        candidates      = sample_vocab(trg, self.output_dim, self.n_samples)
+        n_tokens        = (trg[1:] != criterion.ignore_index).sum()
+        return output_loss(self.decoder.out, features, trg[1:], criterion.ignore_index, candidates) / n_tokens
+
 model       = Seq2Seq(INPUT_DIM, EMB_DIM, HID_DIM, OUTPUT_DIM, MAXOUT_DIM).to(device)
 optimizer   = optim.Adadelta(model.parameters(), rho=0.95, eps=1e-06)
 TRG_PAD_IDX = targetLanguage.vocab.stoi[targetLanguage.pad_token]
 criterion   = nn.CrossEntropyLoss(ignore_index = TRG_PAD_IDX)
 
-def train(model, iterator, optimizer, criterion):
+def train(model, iterator, optimizer, criterion, state = None):
     model.train()
-    epoch_loss = 0.0
+    epoch_loss = 0.0 if state is None else state.epoch_loss
     for i, batch in enumerate(iterator):
         optimizer.zero_grad()
         src, trg    = batch.src, batch.trg
-        outputs     = model(src, trg, is_train=True)
-        output_dim  = outputs.shape[-1]
-        outputs     = outputs[1:].view(-1, output_dim) # Reshape to match trg
-        trg         = trg[1:].view(-1) # Ignore the init token.
-        loss        = criterion(outputs, trg)
+        loss        = model.loss(src, trg, criterion)
         loss.backward()
         optimizer.step()
         epoch_loss += loss.item()
+        if state is not None: state.step(epoch_loss)
     return epoch_loss / len(iterator)
 
 # Convenience to get runtime for training.
@@ -186,17 +243,33 @@ model.eval()
 
 N_EPOCHS = 10
 
-for epoch in range(1, N_EPOCHS):
-    train_iterator.init_epoch() # Processes like shuffling that happen before epoch.
+# targetLanguage is the same field as sourceLanguage
+save_vocab('/content/gdrive/My Drive/data/control-model-monodirectional-vocab.json', src=sourceLanguage)
+
+# Epoch checkpoints are written to Drive in the background, see checkpoint.py
+checkpoints = CheckpointWriter()
+
+# Full training state (optimizer, random generators, place in the epoch),
+# saved every CHECKPOINT_STEPS batches and after every epoch, so that a run
+# that was stopped continues where it was, see checkpoint.py
+CHECKPOINT_STEPS = 1000
+state = TrainingState('/content/gdrive/My Drive/data/control-model-monodirectional-state.pt',
+                      model, optimizer, train_iterator,
+                      every = CHECKPOINT_STEPS, writer = checkpoints)
+
+for epoch in range(state.resume(1), N_EPOCHS):
+    if not state.mid_epoch():
+        train_iterator.init_epoch() # Processes like shuffling that happen before epoch.
     start_time = time.time()
-    train_loss = train(model, train_iterator, optimizer, criterion) 
+    train_loss = train(model, train_iterator, optimizer, criterion, state = state) 
     end_time = time.time()
     epoch_mins, epoch_secs = epoch_time(start_time, end_time)
     print(f'Epoch: {epoch+1:02} | Time: {epoch_mins}m {epoch_secs}s')
     print(f'\tTrain Loss: {train_loss: }')
+    state.end_epoch()
 
     # Checkpoint to ensure progrerss isn't lost.
-    torch.save(model.state_dict(), f'/content/gdrive/My Drive/data/control-model-monodirectional-{epoch}.pt')
-    model.load_state_dict(torch.load(f'/content/gdrive/My Drive/data/control-model-monodirectional-{epoch}.pt'))
+    checkpoints.save(model.state_dict(), f'/content/gdrive/My Drive/data/control-model-monodirectional-{epoch}.pt')
     model.eval()
+checkpoints.wait()
 
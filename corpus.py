@@ -0,0 +1,663 @@
+# -*- coding: utf-8 -*-
+"""corpus.py
+
+Preprocessed, memory-mapped parallel corpora for the Europarl and IWSLT
+notebooks. Running this file once tokenizes, lowercases and numericalizes a
+corpus and writes, for every split and language:
+
+    <split><ext>.ids      token ids of all sentences, one flat int32 array
+    <split><ext>.offsets  int64 index, sentence i is ids[offsets[i]:offsets[i + 1]]
+
+plus vocab<ext>.json (the corpus word list the ids refer to) and meta.json.
+The notebooks open these with np.memmap, so loading takes milliseconds and a
+sentence is a zero-copy slice. Field vocabularies are built from the token
+counts with the same rules as Field.build_vocab, and batches are numericalized
+by mapping corpus ids to Field ids with one lookup array.
+
+Tokenization runs in --workers processes (all cores by default) on chunks of
+--chunk-size sentence pairs; the output does not depend on the worker count.
+
+Corpora that are not preprocessed can instead be read lazily with
+StreamingCorpus and StreamingIterator, which batch them the same way.
+
+Europarl:
+    python corpus.py "/content/gdrive/My Drive/data/europarl-v7.fr-en.bin" \\
+        --exts .en .fr --tokenizers split split \\
+        --split "train=/content/gdrive/My Drive/data/europarl-v7.fr-en"
+
+IWSLT, from the text files torchtext extracts to .data/iwslt/de-en:
+    python corpus.py "/content/drive/My Drive/data/iwslt-de-en.bin" \\
+        --exts .de .en --tokenizers spacy:de spacy:en \\
+        --split train=.data/iwslt/de-en/train.de-en
+
+The IWSLT notebooks do this with prepare_iwslt(out), which first downloads
+and extracts IWSLT to .data (on the VM, so again on every new runtime) and
+does nothing once out holds the corpus.
+"""
+
+import os
+import json
+import argparse
+import multiprocessing
+from collections import Counter, OrderedDict, namedtuple
+import numpy as np
+import torch
+
+# Tokenizers by name: 'split' is str.split (Europarl), 'spacy:<model>' is the
+# tokenizer of that spaCy model (IWSLT uses spacy:de and spacy:en)
+def get_tokenizer(name):
+    if name == 'split':
+        return str.split
+    if name.startswith('spacy:'):
+        import spacy
+        nlp = spacy.load(name[len('spacy:'):])
+        return lambda text: [token.text for token in nlp.tokenizer(text)]
+    raise ValueError(f'unknown tokenizer {name}')
+
+# Sentence pairs of a parallel corpus as TranslationDataset reads them: lines
+# are stripped and pairs with an empty side are skipped
+def read_pairs(prefix, exts):
+    with open(prefix + exts[0], encoding='utf-8') as src_file, \
+         open(prefix + exts[1], encoding='utf-8') as trg_file:
+        for src_line, trg_line in zip(src_file, trg_file):
+            src_line, trg_line = src_line.strip(), trg_line.strip()
+            if src_line != '' and trg_line != '':
+                yield src_line, trg_line
+
+# Tokenizers of the current (worker) process, set by init_tokenizers
+tokenizers = None
+
+def init_tokenizers(names, lower):
+    global tokenizers
+    tokenizers = [(get_tokenizer(name), lower) for name in names]
+
+# Tokenizes a chunk of sentence pairs. For each side this returns the words of
+# the chunk in first-seen order, the token ids of the chunk as indices into
+# those words and the sentence lengths, so the result is compact to send back
+# to the main process and only the chunk's distinct words need a lookup there.
+def tokenize_chunk(pairs):
+    chunk = []
+    for k, (tokenize, lower) in enumerate(tokenizers):
+        words, ids, lengths = {}, [], []
+        for pair in pairs:
+            tokens = tokenize(pair[k])
+            if lower:
+                tokens = [token.lower() for token in tokens]
+            ids.extend(words.setdefault(token, len(words)) for token in tokens)
+            lengths.append(len(tokens))
+        chunk.append((list(words), np.array(ids, dtype=np.int32), np.array(lengths, dtype=np.int64)))
+    return chunk
+
+def chunked(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+# Tokenization is sharded across a pool of `workers` processes in chunks of
+# chunk_size sentence pairs. imap returns the chunks in order and the words of
+# each chunk are numbered in first-seen order, so the ids are the same for any
+# number of workers.
+def preprocess(out, splits, exts, tokenizer_names, lower=True, workers=1, chunk_size=1000):
+    os.makedirs(out, exist_ok=True)
+    stoi = [{} for _ in exts]
+    sizes = {}
+
+    if workers > 1:
+        pool = multiprocessing.Pool(workers, initializer=init_tokenizers, initargs=(tokenizer_names, lower))
+        tokenize_chunks = lambda chunks: pool.imap(tokenize_chunk, chunks)
+    else:
+        pool = None
+        init_tokenizers(tokenizer_names, lower)
+        tokenize_chunks = lambda chunks: map(tokenize_chunk, chunks)
+
+    try:
+        for split, prefix in splits.items():
+            ids_files = [open(os.path.join(out, split + ext + '.ids'), 'wb') for ext in exts]
+            lengths = [[] for _ in exts]
+
+            for chunk in tokenize_chunks(chunked(read_pairs(prefix, exts), chunk_size)):
+                for k, (words, ids, chunk_lengths) in enumerate(chunk):
+                    lookup = np.array([stoi[k].setdefault(word, len(stoi[k])) for word in words], dtype=np.int32)
+                    lookup[ids].tofile(ids_files[k])
+                    lengths[k].append(chunk_lengths)
+
+            for k, ext in enumerate(exts):
+                ids_files[k].close()
+                split_lengths = np.concatenate(lengths[k]) if lengths[k] else np.zeros(0, dtype=np.int64)
+                offsets = np.zeros(len(split_lengths) + 1, dtype=np.int64)
+                np.cumsum(split_lengths, out=offsets[1:])
+                offsets.tofile(os.path.join(out, split + ext + '.offsets'))
+            sizes[split] = len(offsets) - 1
+            print(f'{split}: {sizes[split]} sentence pairs')
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    for k, ext in enumerate(exts):
+        with open(os.path.join(out, 'vocab' + ext + '.json'), 'w', encoding='utf-8') as f:
+            json.dump(list(stoi[k]), f, ensure_ascii=False)
+    with open(os.path.join(out, 'meta.json'), 'w') as f:
+        json.dump({'exts': list(exts), 'splits': sizes, 'tokenizers': list(tokenizer_names), 'lower': lower}, f)
+
+# IWSLT 2016 downloaded and extracted to root/iwslt/<src>-<trg> as
+# IWSLT.splits does it, without reading the files into datasets. Returns the
+# directory of the text files
+def download_iwslt(root='.data', exts=('.de', '.en')):
+    from torchtext.datasets import IWSLT
+    src, trg = exts[0][1:], exts[1][1:]
+    IWSLT.dirname = IWSLT.base_dirname.format(src, trg)
+    IWSLT.urls = [IWSLT.base_url.format(src, trg, IWSLT.dirname)]
+    path = IWSLT.download(root, check=os.path.join(root, IWSLT.name, IWSLT.dirname))
+    if not os.path.exists(os.path.join(path, 'train.' + IWSLT.dirname + exts[0])):
+        IWSLT.clean(path)
+    return path
+
+# The preprocessed IWSLT de-en training set in out, downloaded and
+# preprocessed unless out already holds it
+def prepare_iwslt(out, root='.data', workers=None):
+    if os.path.exists(os.path.join(out, 'meta.json')):
+        return
+    path = download_iwslt(root)
+    preprocess(out, {'train': os.path.join(path, 'train.de-en')}, ('.de', '.en'), ('spacy:de', 'spacy:en'),
+               workers=workers or os.cpu_count())
+
+def open_array(path, dtype):
+    if os.path.getsize(path) == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r')
+
+# Special tokens of a field in the order Field.build_vocab puts them first
+def field_specials(field):
+    return list(OrderedDict.fromkeys(
+        token for token in [field.unk_token, field.pad_token, field.init_token, field.eos_token]
+        if token is not None))
+
+# One split of a preprocessed corpus. Sentences are kept as numpy views of the
+# memory-mapped id arrays; max_len drops pairs whose source is longer, as the
+# notebooks' filter_pred=lambda x: len(x.src) <= max_len did.
+class MappedCorpus:
+    def __init__(self, path, split, max_len=None):
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        self.path = path
+        self.exts = meta['exts']
+        self.ids = [open_array(os.path.join(path, split + ext + '.ids'), np.int32) for ext in self.exts]
+        self.offsets = [open_array(os.path.join(path, split + ext + '.offsets'), np.int64) for ext in self.exts]
+        self.itos = [None] * len(self.exts)
+        lengths = np.diff(self.offsets[0])
+        self.index = np.arange(len(lengths)) if max_len is None else np.flatnonzero(lengths <= max_len)
+
+    def __len__(self):
+        return len(self.index)
+
+    def sentence(self, k, i):
+        i = self.index[i]
+        return self.ids[k][self.offsets[k][i]:self.offsets[k][i + 1]]
+
+    def __getitem__(self, i):
+        return self.sentence(0, i), self.sentence(1, i)
+
+    def lengths(self, k):
+        return (self.offsets[k][self.index + 1] - self.offsets[k][self.index]).astype(np.int64)
+
+    # Corpus word list of side k (0 = source, 1 = target), loaded on first use
+    def words(self, k):
+        if self.itos[k] is None:
+            with open(os.path.join(self.path, 'vocab' + self.exts[k] + '.json'), encoding='utf-8') as f:
+                self.itos[k] = json.load(f)
+        return self.itos[k]
+
+    # Frequency of every corpus word over the kept sentences of side k
+    def counts(self, k):
+        keep = np.zeros(len(self.offsets[k]) - 1, dtype=bool)
+        keep[self.index] = True
+        ids = self.ids[k] if keep.all() else self.ids[k][np.repeat(keep, np.diff(self.offsets[k]))]
+        return np.bincount(ids, minlength=len(self.words(k)))
+
+    # Same result as field.build_vocab on a dataset of these sentences. With
+    # several sides (Europarl's shared source/target field) their counts add up.
+    def build_vocab(self, field, *sides, **kwargs):
+        counter = Counter()
+        for k in sides:
+            counter.update({word: count for word, count in zip(self.words(k), self.counts(k).tolist()) if count})
+        field.vocab = field.vocab_cls(counter, specials=field_specials(field), **kwargs)
+
+CompactExample = namedtuple('CompactExample', ['src', 'trg', 'src_unk'])
+
+# Sentence pairs of an evaluation set stored compactly: per side one int32
+# array of word ids with offsets into it and the list of distinct words,
+# instead of a Python list of strings per example. Indexing an example builds
+# its token lists on demand. With a source field the source lengths and
+# whether each source sentence contains a word outside the field's vocabulary
+# (src_unk) are computed once for the whole set.
+class CompactExamples:
+    def __init__(self, words, ids, offsets, src_field=None):
+        self.words = words
+        self.ids = ids
+        self.offsets = offsets
+        self.src_len = np.diff(offsets[0])
+        self.src_unk = np.zeros(len(self), dtype=bool)
+        if src_field is not None:
+            unk = vocab_map(words[0], src_field.vocab)[ids[0]] == src_field.vocab.stoi[src_field.unk_token]
+            unk_count = np.concatenate(([0], np.cumsum(unk)))
+            self.src_unk = unk_count[offsets[0][1:]] > unk_count[offsets[0][:-1]]
+
+    # From a torchtext dataset or any iterable of examples with src and trg
+    # token lists
+    @classmethod
+    def from_examples(cls, examples, src_field=None):
+        stoi, ids, lengths = [{}, {}], [[], []], [[], []]
+        for example in examples:
+            for k, tokens in enumerate((example.src, example.trg)):
+                ids[k].extend(stoi[k].setdefault(token, len(stoi[k])) for token in tokens)
+                lengths[k].append(len(tokens))
+        offsets = [np.concatenate(([0], np.cumsum(side_lengths, dtype=np.int64))) for side_lengths in lengths]
+        return cls([list(side_stoi) for side_stoi in stoi], [np.array(side_ids, dtype=np.int32) for side_ids in ids],
+                   offsets, src_field)
+
+    def __len__(self):
+        return len(self.offsets[0]) - 1
+
+    def tokens(self, k, i):
+        words = self.words[k]
+        return [words[j] for j in self.ids[k][self.offsets[k][i]:self.offsets[k][i + 1]].tolist()]
+
+    def __getitem__(self, i):
+        return CompactExample(self.tokens(0, i), self.tokens(1, i), bool(self.src_unk[i]))
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+# Field vocabularies saved next to the checkpoints, so that evaluation scripts
+# restore the exact vocabulary a model was trained with instead of counting the
+# training corpus again. Fields are passed by name, e.g.
+# save_vocab(folder + '/vocab.json', src=SRC, trg=TRG).
+def save_vocab(path, **fields):
+    artifact = {name: {'specials': field_specials(field),
+                       'itos': field.vocab.itos,
+                       'freqs': dict(field.vocab.freqs)}
+                for name, field in fields.items()}
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(artifact, f, ensure_ascii=False)
+
+# Only the words of itos are passed to the vocabulary class, so it sorts a few
+# thousand words instead of the whole corpus counter; their frequencies give
+# back the saved order, which is checked.
+def load_vocab(path, **fields):
+    with open(path, encoding='utf-8') as f:
+        artifact = json.load(f)
+    for name, field in fields.items():
+        saved = artifact[name]
+        if saved['specials'] != field_specials(field):
+            raise ValueError(f'{path}: special tokens of {name} do not match the field')
+        specials = set(saved['specials'])
+        counter = Counter({word: saved['freqs'][word] for word in saved['itos'] if word not in specials})
+        vocab = field.vocab_cls(counter, specials=saved['specials'])
+        if vocab.itos != saved['itos']:
+            raise ValueError(f'{path}: vocabulary of {name} could not be restored')
+        vocab.freqs = Counter(saved['freqs'])
+        field.vocab = vocab
+
+# Corpus id -> field vocabulary id (unknown words map to <unk>)
+def vocab_map(words, vocab):
+    return np.array([vocab.stoi[word] for word in words], dtype=np.int64)
+
+# The distinct field ids of every kept sentence of side k of a MappedCorpus,
+# as (sentence, id) pairs sorted by sentence
+def sentence_words(corpus, k, field):
+    keep = np.zeros(len(corpus.offsets[k]) - 1, dtype=bool)
+    keep[corpus.index] = True
+    ids = corpus.ids[k] if keep.all() else corpus.ids[k][np.repeat(keep, np.diff(corpus.offsets[k]))]
+    ids = vocab_map(corpus.words(k), field.vocab)[ids]
+    sentences = np.repeat(np.arange(len(corpus)), corpus.lengths(k))
+    keys = np.unique(sentences * len(field.vocab) + ids)
+    return keys // len(field.vocab), keys % len(field.vocab)
+
+# For every source word of src_field, the top_k target words of trg_field
+# that co-occur with it in the sentence pairs of a MappedCorpus most strongly
+# (Dice coefficient, 2 * pairs with both / (pairs with the source word + pairs
+# with the target word)). Returns [source vocab, top_k] arrays of target ids
+# and their scores. The co-occurrence counts are never held for the whole
+# vocabulary: source words are taken in blocks of at most block_size words
+# and about max_pairs co-occurrences, counted and reduced to their top_k.
+def dice_candidates(corpus, src_field, trg_field, top_k=20, block_size=256, max_pairs=1 << 24):
+    src_vocab, trg_vocab = len(src_field.vocab), len(trg_field.vocab)
+    src_sentence, src_word = sentence_words(corpus, 0, src_field)
+    trg_sentence, trg_word = sentence_words(corpus, 1, trg_field)
+    src_count = np.bincount(src_word, minlength=src_vocab)
+    trg_count = np.bincount(trg_word, minlength=trg_vocab)
+    # target words of sentence i are trg_word[trg_start[i]:trg_start[i + 1]]
+    trg_start = np.searchsorted(trg_sentence, np.arange(len(corpus) + 1))
+    order = np.argsort(src_word, kind='stable')
+    src_sentence, src_word = src_sentence[order], src_word[order]
+    word_start = np.searchsorted(src_word, np.arange(src_vocab + 1))
+    pairs = np.diff(trg_start)[src_sentence]
+    pair_start = np.concatenate(([0], np.cumsum(pairs)))[word_start]
+
+    top_k = min(top_k, trg_vocab)
+    words = np.zeros((src_vocab, top_k), dtype=np.int64)
+    scores = np.zeros((src_vocab, top_k), dtype=np.float32)
+    start = 0
+    while start < src_vocab:
+        end = np.searchsorted(pair_start, pair_start[start] + max_pairs, side='right') - 1
+        end = min(max(end, start + 1), start + block_size, src_vocab)
+        lo, hi = word_start[start], word_start[end]
+        # every (source word, target word) pair of the block's sentences
+        n = np.diff(trg_start)[src_sentence[lo:hi]]
+        rows = np.repeat(src_word[lo:hi] - start, n)
+        first = np.repeat(trg_start[src_sentence[lo:hi]] - np.cumsum(n) + n, n)
+        cols = trg_word[first + np.arange(n.sum())]
+        cooc = np.bincount(rows * trg_vocab + cols, minlength=(end - start) * trg_vocab)
+        dice = 2 * cooc.reshape(end - start, trg_vocab) / np.maximum(src_count[start:end, None] + trg_count, 1)
+        score, word = torch.from_numpy(dice.astype(np.float32)).topk(top_k, dim=1)
+        words[start:end], scores[start:end] = word.numpy(), score.numpy()
+        start = end
+    return words, scores
+
+# Cuts a pool of sentences, given as indices sorted by source length, into
+# batches of at most max_tokens source + target tokens, counting padding,
+# <sos> and <eos>. Returns a list of index arrays.
+def cut_batches(src_len, trg_len, pool, max_tokens):
+    batches, start, max_src, max_trg = [], 0, 0, 0
+    for j, (s, t) in enumerate(zip((src_len[pool] + 2).tolist(), (trg_len[pool] + 2).tolist())):
+        s, t = max(max_src, s), max(max_trg, t)
+        if j > start and (j - start + 1) * (s + t) > max_tokens:
+            batches.append(pool[start:j])
+            start, s, t = j, src_len[pool[j]] + 2, trg_len[pool[j]] + 2
+        max_src, max_trg = s, t
+    if start < len(pool):
+        batches.append(pool[start:])
+    return batches
+
+# Token budget batching over sentence lengths. With an rng the sentences are
+# shuffled, sorted by source length within pools of about pool_size batches
+# and the batches of each pool shuffled; without one the whole set is sorted
+# by source length.
+def token_batches(src_len, trg_len, max_tokens, rng=None, pool_size=100):
+    if rng is None:
+        pools = [np.argsort(src_len, kind='stable')]
+    else:
+        order = rng.permutation(len(src_len))
+        tokens = np.cumsum(src_len[order] + trg_len[order] + 4)
+        bounds = np.searchsorted(tokens, np.arange(pool_size * max_tokens, tokens[-1] if len(tokens) else 0,
+                                                   pool_size * max_tokens), side='right')
+        pools = [pool[np.argsort(src_len[pool], kind='stable')] for pool in np.split(order, bounds)]
+
+    batches = []
+    for pool in pools:
+        pool_batches = cut_batches(src_len, trg_len, pool, max_tokens)
+        if rng is not None:
+            pool_batches = [pool_batches[i] for i in rng.permutation(len(pool_batches))]
+        batches += pool_batches
+    return batches
+
+Batch = namedtuple('Batch', ['src', 'trg'])
+
+# Padded [len, batch] array of sentences (field vocabulary ids) with <sos>
+# and <eos>
+def pad_sentences(sentences, field):
+    vocab = field.vocab.stoi
+    array = np.full((max(len(s) for s in sentences) + 2, len(sentences)), vocab[field.pad_token], dtype=np.int64)
+    array[0] = vocab[field.init_token]
+    for j, sentence in enumerate(sentences):
+        array[1:len(sentence) + 1, j] = sentence
+        array[len(sentence) + 1, j] = vocab[field.eos_token]
+    return array
+
+# Padded arrays of a batch on the host. Workers send numpy arrays back, which
+# pickle through the worker pipe about three times faster than tensors pass
+# through shared memory; the DataLoader's pinning thread calls pin_memory.
+class HostBatch:
+    def __init__(self, arrays):
+        self.arrays = arrays
+
+    def pin_memory(self):
+        return HostBatch([torch.from_numpy(array).pin_memory() for array in self.arrays])
+
+    def to(self, device):
+        return Batch(*(torch.as_tensor(array).to(device, non_blocking=True) for array in self.arrays))
+
+# Background batch loading for the iterators below. With num_workers > 0 the
+# padded arrays are built in DataLoader worker processes, each keeping
+# prefetch batches queued, and pinned when they go to a GPU so that the copy
+# to the device does not block the training step. The workers draw their
+# seeds from a generator of their own rather than the global torch one, so
+# starting them does not change the training run's dropout masks and a
+# resumed run draws the same numbers as one that was not stopped.
+def background_batches(dataset, num_workers, prefetch, pin_memory, sampler=None):
+    return torch.utils.data.DataLoader(dataset, batch_size=None, sampler=sampler, num_workers=num_workers,
+                                       prefetch_factor=prefetch, pin_memory=pin_memory, collate_fn=HostBatch,
+                                       generator=torch.Generator())
+
+def uses_cuda(device):
+    return device is not None and torch.device(device).type == 'cuda'
+
+# Batches of a MappedCorpus in the form of the torchtext iterators (batch.src
+# and batch.trg are [len, batch] tensors). batch_size is a token budget, see
+# token_batches. Training iterators reshuffle every epoch; an epoch's batches
+# are made by init_epoch, or when iterating again, and len() counts them.
+# The workers are handed the index arrays of the epoch as their sampler.
+# state_dict records the shuffling state the epoch started from and how many
+# of its batches were handed out; after load_state_dict the iterator remakes
+# the same batches and continues with the next one.
+class MappedIterator:
+    def __init__(self, corpus, src_field, trg_field, batch_size, device=None, train=True, seed=None,
+                 num_workers=0, prefetch=2):
+        self.corpus = corpus
+        self.fields = (src_field, trg_field)
+        self.maps = [vocab_map(corpus.words(k), field.vocab) for k, field in enumerate(self.fields)]
+        self.batch_size = batch_size
+        self.device = device
+        self.rng = np.random.default_rng(seed) if train else None
+        self.num_workers = num_workers
+        self.prefetch = prefetch
+        self.src_len, self.trg_len = corpus.lengths(0), corpus.lengths(1)
+        self.batches = None
+        self.started = False
+        self.position = 0
+        self.epoch_rng = None
+
+    def init_epoch(self):
+        self.epoch_rng = None if self.rng is None else self.rng.bit_generator.state
+        self.batches = token_batches(self.src_len, self.trg_len, self.batch_size, self.rng)
+        self.started = False
+        self.position = 0
+
+    def state_dict(self):
+        return {'epoch_rng': self.epoch_rng, 'has_epoch': self.batches is not None,
+                'position': self.position if self.started else 0}
+
+    def load_state_dict(self, state):
+        self.batches = None
+        self.started = False
+        self.position = 0
+        if state['has_epoch']:
+            if self.rng is not None:
+                self.rng.bit_generator.state = state['epoch_rng']
+            self.init_epoch()
+            self.position = state['position']
+            # an epoch that was iterated to the end is replaced on the next pass
+            self.started = self.position >= len(self.batches)
+
+    def __len__(self):
+        if self.batches is None:
+            self.init_epoch()
+        return len(self.batches)
+
+    # Padded arrays of the sentence pairs at indices
+    def __getitem__(self, indices):
+        pairs = [self.corpus[i] for i in indices]
+        return tuple(pad_sentences([self.maps[k][pair[k]] for pair in pairs], field)
+                     for k, field in enumerate(self.fields))
+
+    def __iter__(self):
+        if self.batches is None or self.started:
+            self.init_epoch()
+        self.started = True
+        remaining = self.batches[self.position:]
+        if self.num_workers == 0:
+            batches = (HostBatch(self[indices]) for indices in remaining)
+        else:
+            batches = background_batches(self, self.num_workers, self.prefetch, uses_cuda(self.device),
+                                         sampler=remaining)
+        for batch in batches:
+            self.position += 1
+            yield batch.to(self.device)
+
+# Sentence pairs read lazily from the text files of a parallel corpus, for
+# corpora that are not preprocessed (or too large to be). Lines are tokenized
+# with the fields' own preprocessing, pairs whose source is longer than
+# max_len are dropped, and iteration order is randomized with a shuffle buffer
+# of buffer_size pairs, so memory does not grow with the corpus. A shard of
+# n_shards only tokenizes every n_shards-th pair.
+class StreamingCorpus:
+    def __init__(self, prefix, exts, fields, max_len=None, buffer_size=100000, seed=None):
+        self.prefix = prefix
+        self.exts = exts
+        self.fields = fields
+        self.max_len = max_len
+        self.buffer_size = buffer_size
+        self.rng = np.random.default_rng(seed)
+
+    # Tokenized pairs in file order
+    def pairs(self, shard=0, n_shards=1):
+        for i, (src_line, trg_line) in enumerate(read_pairs(self.prefix, self.exts)):
+            if i % n_shards != shard:
+                continue
+            src, trg = self.fields[0].preprocess(src_line), self.fields[1].preprocess(trg_line)
+            if self.max_len is None or len(src) <= self.max_len:
+                yield src, trg
+
+    def shuffled(self, rng, shard=0, n_shards=1):
+        buffer, buffer_size = [], max(1, self.buffer_size // n_shards)
+        for pair in self.pairs(shard, n_shards):
+            if len(buffer) < buffer_size:
+                buffer.append(pair)
+            else:
+                i = rng.integers(len(buffer))
+                yield buffer[i]
+                buffer[i] = pair
+        rng.shuffle(buffer)
+        yield from buffer
+
+    def __iter__(self):
+        return self.shuffled(self.rng)
+
+    # Same result as field.build_vocab, counted in one pass over the files
+    def build_vocab(self, field, *sides, **kwargs):
+        counter = Counter()
+        for pair in self.pairs():
+            for k in sides:
+                counter.update(pair[k])
+        field.vocab = field.vocab_cls(counter, specials=field_specials(field), **kwargs)
+
+# Batches of a StreamingCorpus, made like those of MappedIterator: pools of
+# about pool_size * batch_size tokens are taken from the stream, sorted by
+# source length, cut with cut_batches and yielded in random order. The number
+# of batches is only known once an epoch has been read, so len() counts the
+# batches of the current epoch so far. With workers every worker reads its own
+# shard of the stream, with a seed drawn for the epoch. A shard is tokenized a
+# pool at a time, so by default each worker keeps a pool of batches queued.
+# The stream cannot be fast-forwarded, so state_dict only records the
+# shuffling state of the unfinished epoch, if any, and position 0: after
+# load_state_dict the iterator makes that epoch's batches again from the first.
+class StreamingIterator:
+    def __init__(self, corpus, src_field, trg_field, batch_size, device=None, seed=None, pool_size=100,
+                 num_workers=0, prefetch=None):
+        self.corpus = corpus
+        self.fields = (src_field, trg_field)
+        self.batch_size = batch_size
+        self.device = device
+        self.rng = np.random.default_rng(seed)
+        self.pool_size = pool_size
+        self.num_workers = num_workers
+        self.prefetch = pool_size if prefetch is None else prefetch
+        self.n_batches = 0
+        self.epoch_rng = None
+
+    def init_epoch(self):
+        self.n_batches = 0
+
+    def state_dict(self):
+        has_epoch = self.epoch_rng is not None
+        return {'rng': self.epoch_rng if has_epoch else self.rng.bit_generator.state,
+                'has_epoch': has_epoch, 'position': 0}
+
+    def load_state_dict(self, state):
+        self.rng.bit_generator.state = state['rng']
+        self.epoch_rng = None
+        self.n_batches = 0
+
+    def __len__(self):
+        return self.n_batches
+
+    def numericalize(self, tokens, k):
+        stoi = self.fields[k].vocab.stoi
+        return np.array([stoi[token] for token in tokens], dtype=np.int64)
+
+    def pool_batches(self, pool, rng):
+        src_len = np.array([len(pair[0]) for pair in pool])
+        trg_len = np.array([len(pair[1]) for pair in pool])
+        batches = cut_batches(src_len, trg_len, np.argsort(src_len, kind='stable'), self.batch_size)
+        for i in rng.permutation(len(batches)):
+            pairs = [pool[j] for j in batches[i]]
+            yield tuple(pad_sentences([self.numericalize(pair[k], k) for pair in pairs], field)
+                        for k, field in enumerate(self.fields))
+
+    # Padded arrays of the pairs of one shard of the stream
+    def host_batches(self, rng, shard=0, n_shards=1):
+        pool, tokens = [], 0
+        for pair in self.corpus.shuffled(rng, shard, n_shards):
+            pool.append(pair)
+            tokens += len(pair[0]) + len(pair[1]) + 4
+            if tokens >= self.pool_size * self.batch_size:
+                yield from self.pool_batches(pool, rng)
+                pool, tokens = [], 0
+        if pool:
+            yield from self.pool_batches(pool, rng)
+
+    def __iter__(self):
+        self.n_batches = 0
+        self.epoch_rng = self.rng.bit_generator.state
+        if self.num_workers == 0:
+            batches = map(HostBatch, self.host_batches(self.rng))
+        else:
+            shards = StreamShards(self, self.rng.integers(2 ** 32))
+            batches = background_batches(shards, self.num_workers, self.prefetch, uses_cuda(self.device))
+        for batch in batches:
+            self.n_batches += 1
+            yield batch.to(self.device)
+        self.epoch_rng = None
+
+# The stream of a StreamingIterator split over the DataLoader workers
+class StreamShards(torch.utils.data.IterableDataset):
+    def __init__(self, iterator, seed):
+        self.iterator = iterator
+        self.seed = seed
+
+    def __iter__(self):
+        info = torch.utils.data.get_worker_info()
+        shard, n_shards = (0, 1) if info is None else (info.id, info.num_workers)
+        return self.iterator.host_batches(np.random.default_rng([self.seed, shard]), shard, n_shards)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Preprocess a parallel corpus into memory-mapped token ids.')
+    parser.add_argument('out', help='output directory')
+    parser.add_argument('--exts', nargs=2, required=True, help='source and target extensions, e.g. .en .fr')
+    parser.add_argument('--tokenizers', nargs=2, default=['split', 'split'],
+                        help="source and target tokenizers: 'split' or 'spacy:<model>'")
+    parser.add_argument('--split', action='append', required=True, metavar='NAME=PREFIX',
+                        help='a split and the path its files start with (PREFIX + ext)')
+    parser.add_argument('--no-lower', dest='lower', action='store_false')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='tokenizer processes')
+    parser.add_argument('--chunk-size', type=int, default=1000, help='sentence pairs per worker task')
+    args = parser.parse_args()
+    splits = OrderedDict(split.split('=', 1) for split in args.split)
+    preprocess(args.out, splits, args.exts, args.tokenizers, lower=args.lower,
+               workers=args.workers, chunk_size=args.chunk_size)
@@ -13,6 +13,11 @@ import torch.optim as optim
 import torch.nn.functional as F
 from torchtext.datasets import TranslationDataset, Multi30k, IWSLT, WMT14
 from torchtext.data import Field, BucketIterator, Iterator
+from corpus import CompactExamples, MappedCorpus, MappedIterator, dice_candidates, load_vocab
+from hypotheses import HypothesisCache
+from search import beam_search, source_batch, translate_sentences
+from sweep import Job, sweep, format_table
+from attention import AdditiveAttention
 import spacy
 import numpy as np
 import random
@@ -20,7 +25,7 @@ import math
 import time
 from collections import defaultdict
 from matplotlib import pyplot as plt
-from nltk.translate.bleu_score import sentence_bleu, SmoothingFunction
+from bleu import bleu_tokens
 import itertools
 
 # Commented out IPython magic to ensure Python compatibility.
@@ -61,10 +66,6 @@ SRC = Field(init_token=sos_token,
 
 # Commented out IPython magic to ensure Python compatibility.
 # %%capture
-# train_data, _, _ = IWSLT.splits(exts = ('.de', '.en'), 
-#                         fields = (SRC, TRG),
-#                         filter_pred=lambda x: len(x.__dict__['src']) <= 50)
-# 
 # test_10, valid_10, valid_12 = IWSLT.splits(exts = ('.de', '.en'), 
 #                                 fields = (SRC, TRG),
 #                                 train='IWSLT16.TED.tst2010',
@@ -89,40 +90,60 @@ SRC = Field(init_token=sos_token,
 # valid_data = [valid_10, valid_12]
 # test_data = [test_10, test_11, test_12, test_13, test_13x, test_14x, test_14]
 
-SRC.build_vocab(train_data, max_size=10000)
-TRG.build_vocab(train_data, max_size=10000)
+# Vocabulary the models were trained with, saved by the training notebook
+load_vocab('/content/drive/My Drive/ml-mini-project/bidirectional-attention/vocab.json', src=SRC, trg=TRG)
+
+# The evaluation sets as token id arrays (see corpus.py). Examples give back
+# their token lists on demand, and src_unk tells whether the source has words
+# outside the vocabulary.
+valid_data = [CompactExamples.from_examples(d, SRC) for d in valid_data]
+test_data = [CompactExamples.from_examples(d, SRC) for d in test_data]
 
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
+# Translations already made with the same weights and beam settings, kept on
+# Drive so that reruns of the notebook do not decode them again
+hypotheses = HypothesisCache('/content/drive/My Drive/ml-mini-project/hypotheses.db')
+
+# Target vocabulary shortlist for decoding. A source batch gets the top_n most
+# frequent target words (which include the special tokens) plus, for each of
+# its words, the top_k target words that co-occur with it most strongly in the
+# training pairs (Dice coefficient, see corpus.dice_candidates). Enable it on
+# a search model with model.shortlist = Shortlist(train_corpus).to(device),
+# where train_corpus is the preprocessed training set the vocabulary was built
+# from, MappedCorpus("/content/drive/My Drive/data/iwslt-de-en.bin", 'train',
+# max_len = 50). The buffers are not persistent, so checkpoints are unaffected.
+class Shortlist(nn.Module):
+    def __init__(self, corpus, top_k=20, top_n=1000):
+        super().__init__()
+        words, scores = dice_candidates(corpus, SRC, TRG, top_k)
+        # source words never seen in training have no candidates of their own
+        table = torch.from_numpy(words).masked_fill(torch.from_numpy(scores == 0), TRG.vocab.stoi[TRG.eos_token])
+        self.register_buffer('table', table, persistent=False)
+        self.register_buffer('frequent', torch.arange(min(top_n, len(TRG.vocab))), persistent=False)
+
+    def forward(self, src):
+        return torch.unique(torch.cat((self.frequent, self.table[src].view(-1))))
+
 class EncoderAttnBi(nn.Module):
     def __init__(self, input_dim, emb_dim, enc_hid_dim, dec_hid_dim):
         super().__init__()
         self.embedding = nn.Embedding(input_dim, emb_dim)
         self.rnn = nn.GRU(emb_dim, enc_hid_dim, bidirectional = True)
         
-    def forward(self, src):
+    def forward(self, src, src_len = None):
         embedded = self.embedding(src)
+        if src_len is not None:
+            # Packing skips the <pad> positions at the end of shorter sentences
+            embedded = nn.utils.rnn.pack_padded_sequence(embedded, src_len.cpu(), enforce_sorted = False)
         outputs, hidden = self.rnn(embedded)
+        if src_len is not None:
+            outputs, _ = nn.utils.rnn.pad_packed_sequence(outputs, total_length = src.shape[0])
         return outputs, hidden[1]
 
-class AttentionBi(nn.Module):
+class AttentionBi(AdditiveAttention):
     def __init__(self, enc_hid_dim, dec_hid_dim):
-        super().__init__()
-        
-        self.attn = nn.Linear(2 * enc_hid_dim + dec_hid_dim, dec_hid_dim)
-        self.v = nn.Linear(dec_hid_dim, 1, bias = False)
-        
-    def forward(self, hidden, encoder_outputs):
-        batch_size = encoder_outputs.shape[1]
-        src_len = encoder_outputs.shape[0]
-        
-        hidden = hidden.unsqueeze(1).repeat(1, src_len, 1)
-        encoder_outputs = encoder_outputs.permute(1, 0, 2)
-        
-        energy = torch.tanh(self.attn(torch.cat((hidden, encoder_outputs), dim = 2))) 
-        attention = self.v(energy).squeeze(2)
-        
-        return F.softmax(attention, dim=1)
+        super().__init__(2 * enc_hid_dim, dec_hid_dim)
 
 class DecoderAttnBi(nn.Module):
     def __init__(self, output_dim, emb_dim, enc_hid_dim, dec_hid_dim, attention):
@@ -133,10 +154,12 @@ class DecoderAttnBi(nn.Module):
         self.rnn = nn.GRU((enc_hid_dim * 2) + emb_dim, dec_hid_dim)
         self.fc_out = nn.Linear((enc_hid_dim * 2) + dec_hid_dim + emb_dim, output_dim)
         
-    def forward(self, input, hidden, encoder_outputs):
+    def forward(self, input, hidden, encoder_outputs, keys = None, mask = None, fc_out = None):
+        if fc_out is None:
+            fc_out = self.fc_out
         input = input.unsqueeze(0)
         embedded = self.embedding(input)
-        a = self.attention(hidden, encoder_outputs)
+        a = self.attention(hidden, encoder_outputs, keys, mask)
         a = a.unsqueeze(1)
         encoder_outputs = encoder_outputs.permute(1, 0, 2)
         weighted = torch.bmm(a, encoder_outputs)
@@ -147,7 +170,7 @@ class DecoderAttnBi(nn.Module):
         output = output.squeeze(0)
         weighted = weighted.squeeze(0)
         
-        prediction = self.fc_out(torch.cat((output, weighted, embedded), dim = 1))
+        prediction = fc_out(torch.cat((output, weighted, embedded), dim = 1))
         return prediction, hidden.squeeze(0)
 
 class SearchBi(nn.Module):
@@ -156,6 +179,7 @@ class SearchBi(nn.Module):
         self.encoder = encoder
         self.decoder = decoder
         self.device = device
+        self.shortlist = None
         
     def forward(self, src, trg, teacher_forcing_ratio = 0.5):
         batch_size = src.shape[1]
@@ -163,11 +187,13 @@ class SearchBi(nn.Module):
         trg_vocab_size = self.decoder.output_dim
         
         outputs = torch.zeros(trg_len, batch_size, trg_vocab_size).to(self.device)
-        encoder_outputs, hidden = self.encoder(src)
+        mask = (src != SRC.vocab.stoi[SRC.pad_token]).permute(1, 0)
+        encoder_outputs, hidden = self.encoder(src, mask.sum(1))
+        keys = self.decoder.attention.project_keys(encoder_outputs)
         input = trg[0,:]
         
         for t in range(1, trg_len):
-            output, hidden = self.decoder(input, hidden, encoder_outputs)
+            output, hidden = self.decoder(input, hidden, encoder_outputs, keys, mask)
             outputs[t] = output
             teacher_force = random.random() < teacher_forcing_ratio
             top1 = output.argmax(1)
@@ -177,29 +203,17 @@ class SearchBi(nn.Module):
 
         
     def translate(self, sentence, max_len=50, beam_width=3):
+        return self.translate_batch([sentence], max_len, beam_width)[0]
+
+    def translate_batch(self, sentences, max_len=50, beam_width=3):
         self.eval()
-        src = SRC.process([sentence]).to(device)
-        encoder_out, hidden = self.encoder(src)
-        beams = [(0.0, [TRG.vocab.stoi[TRG.init_token]], hidden)]
-        done = False
-        log_smax = nn.LogSoftmax(dim=0).to(device)
-
-        while not done:
-            for i in range(len(beams)):
-                p, sent, hidden = beams.pop(0)
-                if len(sent) >= max_len or sent[-1] == TRG.vocab.stoi[TRG.eos_token]:
-                    beams += [(p, sent, hidden)]
-                    continue
-                trg = torch.ones(1, dtype=torch.int64).to(device) * sent[-1]
-                pred, hidden = self.decoder(trg, hidden, encoder_out)
-                ll = log_smax(pred[0])
-                top_ll, top_t = torch.topk(ll, k=beam_width)
-                beams += [(p + ll, sent + [t], hidden) for ll, t in zip(top_ll, top_t)]
-            beams = sorted(beams, reverse=True)[:beam_width]
-            done = all([b[1][-1] == TRG.vocab.stoi[TRG.eos_token] or len(b[1]) >= max_len for b in beams])
-
-        trgs = beams.pop(0)[1]
-        return [TRG.vocab.itos[i] for i in trgs]
+        src, src_len, mask = source_batch(SRC, sentences, device)
+        encoder_out, hidden = self.encoder(src, src_len)
+        keys = self.decoder.attention.project_keys(encoder_out)
+        vocab = None if self.shortlist is None else self.shortlist(src)
+        with self.decoder.attention.decoding():
+            trgs = beam_search(self.decoder, hidden, encoder_out, TRG, max_len, beam_width, keys, mask, vocab)
+        return [[TRG.vocab.itos[i] for i in t] for t in trgs]
 
 INPUT_DIM = len(SRC.vocab)
 OUTPUT_DIM = len(TRG.vocab)
@@ -214,71 +228,38 @@ dec = [DecoderAttnBi(OUTPUT_DIM, DEC_EMB_DIM, h, h, a) for h, a in zip(HID_DIM,
 search_bi = [SearchBi(e, d, device).to(device) for e, d in zip(enc, dec)]
 
 def evaluate_bleu(model, datasets, ignore_unk=False):
-    total = 0.0
-    count = 0.0
     scores = np.zeros(sum([len(d) for d in datasets]))
-    for i, example in enumerate(itertools.chain(*datasets)):
-        sent = SRC.process([example.src])
-        if ignore_unk and SRC.vocab.stoi[SRC.unk_token] in sent:
-            continue
-        pred = model.translate(example.src)[1:-2]
-        score = sentence_bleu([example.trg], pred, smoothing_function=SmoothingFunction().method1)
-        scores[i] = score
-        if i % 1000 == 999: print('.', end='')
-    print('')
+    examples = list(itertools.chain(*datasets))
+    keep = [i for i, example in enumerate(examples)
+            if not (ignore_unk and example.src_unk)]
+    preds = translate_sentences(model, [examples[i].src for i in keep], hypotheses)
+    scores[keep] = bleu_tokens([pred[1:-2] for pred in preds],
+                               [examples[i].trg for i in keep]).sentences
     return scores.mean()
     
 def bleu_summary(model, datasets, ignore_unk=False):
-    overall_examples = sum([len(d) for d in datasets])
-    lengths = np.zeros(overall_examples, dtype=np.int32)
-    scores = np.zeros(overall_examples)
-
-    for i, example in enumerate(itertools.chain(*datasets)):
-        sent = SRC.process([example.src])
-        if ignore_unk and SRC.vocab.stoi[SRC.unk_token] in sent:
-            continue
-        pred = model.translate(example.src)
-        scores[i] = sentence_bleu([example.trg], pred, smoothing_function=SmoothingFunction().method1)
-        lengths[i] = len(example.src)
-        if i % 900 == 899: print('.', end='')
-      
-    scores = scores[lengths != 0.0]    
-    lengths = lengths[lengths != 0.0]
-
-    print('')
-    means, up, lo = {}, {}, {}
-    uniq_lengths, counts = np.unique(lengths, return_counts=True)
-    for l, c in zip(uniq_lengths, counts):
-        s = scores[lengths == l]
-        means[l] = s.mean()
-        up[l] = means[l] + (np.sqrt(s.var() / c) * 1.65)
-        lo[l] = means[l] - (np.sqrt(s.var() / c) * 1.65)
-
-    uniq_lengths = [l for l in sorted(uniq_lengths)]
-    return uniq_lengths, [means[l] for l in uniq_lengths], [up[l] for l in uniq_lengths], [lo[l] for l in uniq_lengths]
+    examples = [example for example in itertools.chain(*datasets)
+                if not (ignore_unk and example.src_unk) and len(example.src) != 0]
+    preds = translate_sentences(model, [example.src for example in examples], hypotheses)
+    # mean BLEU per source length with its 1.65 standard error band
+    return bleu_tokens(preds, [example.trg for example in examples],
+                       [len(example.src) for example in examples]).buckets
 
 def get_lengths(datasets):
-    overall_examples = sum([len(d) for d in datasets])
-    lengths = np.zeros(overall_examples, dtype=np.int32)
-    for i, example in enumerate(itertools.chain(*datasets)):
-        lengths[i] = len(example.src)
-    return lengths
+    return np.concatenate([d.src_len for d in datasets]).astype(np.int32)
 
 TRG_PAD_IDX = TRG.vocab.stoi[TRG.pad_token]
 criterion = nn.CrossEntropyLoss(ignore_index = TRG_PAD_IDX)
 
-BATCH_SIZE = 80
+MAX_TOKENS = 4000
 
-train_iterator, valid_iterator, test_iterator = BucketIterator.splits(
-    (train_data, valid_12, test_13), 
-    sort_key=lambda x: len(x.__dict__['src']),
-    batch_size = BATCH_SIZE, 
-    device = device)
+# Training loss is measured on the preprocessed training set, see corpus.py
+train_corpus = MappedCorpus("/content/drive/My Drive/data/iwslt-de-en.bin", 'train', max_len = 50)
 
 def evaluate(model, iterator, criterion):
     model.eval()
     epoch_loss = 0
-    with torch.no_grad():
+    with torch.no_grad(), model.decoder.attention.decoding():
         for i, batch in enumerate(iterator):
             src = batch.src
             trg = batch.trg
@@ -295,11 +276,31 @@ valid_score = np.zeros((len(HID_DIM), 6))
 train_err = np.zeros((len(HID_DIM), 6))
 
 
-for i in range(len(HID_DIM)):
-    for epoch in range(6):
-        search_bi[i].load_state_dict(torch.load(f'/content/drive/My Drive/ml-mini-project/hidden/attention-model-{HID_DIM[i]}-{epoch}.pt'))
-        valid_score[i][epoch] = evaluate_bleu(search_bi[i], valid_data)
-        train_err[i][epoch] = evaluate(search_bi[i], train_iterator, criterion)
+# The checkpoints are evaluated in parallel CPU processes, see sweep.py
+def use_cpu():
+    global device
+    device = torch.device('cpu')
+
+def make_search_bi(h):
+    return lambda: SearchBi(EncoderAttnBi(INPUT_DIM, ENC_EMB_DIM, h, h),
+                            DecoderAttnBi(OUTPUT_DIM, DEC_EMB_DIM, h, h, AttentionBi(h, h)), device)
+
+# Each worker batches the training set itself; pool workers cannot start
+# batch processes of their own, so there are no num_workers here. The batches
+# are not shuffled, so every checkpoint's loss is taken over the same batches
+def evaluate_checkpoint(model, valid_data):
+    train_iterator = MappedIterator(train_corpus, SRC, TRG, batch_size = MAX_TOKENS, device = device, train = False)
+    return {'bleu': evaluate_bleu(model, valid_data), 'loss': evaluate(model, train_iterator, criterion)}
+
+jobs = [Job((i, epoch), make_search_bi(HID_DIM[i]),
+            f'/content/drive/My Drive/ml-mini-project/hidden/attention-model-{HID_DIM[i]}-{epoch}.pt', valid_data)
+        for i in range(len(HID_DIM)) for epoch in range(6)]
+rows = sweep(jobs, evaluate_checkpoint, init=use_cpu, caches=[hypotheses])
+print(format_table(rows))
+for row in rows:
+    i, epoch = row['name']
+    valid_score[i][epoch] = row['bleu']
+    train_err[i][epoch] = row['loss']
 
 valid_score
 
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""hypotheses.py
+
+On-disk cache of beam search translations, so that the checkpoint sweeps and
+plots of the experiment notebooks only decode what they have not decoded
+before. A hypothesis is stored under a hash of
+
+    the model: its class and every tensor of its state_dict and buffers
+    the decode settings: max_len, beam_width and the autocast dtype, if any
+    the source sentence tokens
+
+so loading another checkpoint, or changing a weight, gives new keys and
+stale translations are never returned. The cache is an SQLite file; when it
+grows past max_bytes the least recently used hypotheses are deleted.
+
+Only the process that opened the cache writes to it. The file is on Drive,
+whose mount does not have the file locking SQLite needs for several writers,
+so sweep workers (see sweep.py) read it but keep their puts in pending, and
+the sweep hands them to the notebook's cache with merge once it is done.
+
+translate_sentences in the notebooks uses it like this:
+
+    keys = hypotheses.keys(model, sentences, max_len, beam_width)
+    preds = hypotheses.get(keys)
+    ... translate the sentences whose pred is None ...
+    hypotheses.put(keys_of_those, their_preds)
+"""
+
+import os
+import json
+import urllib.parse
+import hashlib
+import sqlite3
+import torch
+from precision import autocast_dtype
+
+# Hash of the class and all tensors of a model. Non-persistent buffers (like a
+# decoding Shortlist) change the translations too, so they are included
+def state_hash(model):
+    tensors = dict(model.named_buffers())
+    tensors.update(model.state_dict())
+    digest = hashlib.sha1(type(model).__name__.encode())
+    for name in sorted(tensors):
+        tensor = tensors[name].detach().cpu().contiguous().reshape(-1)
+        digest.update(f'\n{name} {tensor.dtype} {tuple(tensors[name].shape)}\n'.encode())
+        digest.update(tensor.view(torch.uint8).numpy().tobytes())
+    return digest.hexdigest()
+
+class HypothesisCache:
+    def __init__(self, path, max_bytes=256 << 20):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.pid = None
+        self.owner = os.getpid()
+        self.pending = []
+        self.db.execute('CREATE TABLE IF NOT EXISTS hypotheses '
+                        '(key BLOB PRIMARY KEY, tokens BLOB NOT NULL, used INTEGER NOT NULL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS hypotheses_used ON hypotheses (used)')
+        # The size of the cache in bytes, kept up to date by put so that it is
+        # not summed over the whole table on every put
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS size (bytes INTEGER NOT NULL)')
+            if self.db.execute('SELECT 1 FROM size').fetchone() is None:
+                self.db.execute('INSERT INTO size SELECT COALESCE(SUM(LENGTH(key) + LENGTH(tokens)), 0) '
+                                'FROM hypotheses')
+
+    # A connection of this process. Forked sweep workers must not use the one
+    # of the notebook, they open their own, read-only
+    @property
+    def db(self):
+        if self.pid != os.getpid():
+            if self.writer():
+                self.connection = sqlite3.connect(self.path, timeout=60)
+            else:
+                self.connection = sqlite3.connect(f'file:{urllib.parse.quote(self.path)}?mode=ro',
+                                                  uri=True, timeout=60)
+            self.pid = os.getpid()
+        return self.connection
+
+    def writer(self):
+        return os.getpid() == self.owner
+
+    # Closes the connection of this process, before forking. The next use
+    # opens a new one
+    def close(self):
+        if self.pid == os.getpid():
+            self.connection.close()
+            self.pid = None
+
+    # Recency is a counter rather than a time, so it survives clock changes
+    def tick(self):
+        return self.db.execute('SELECT COALESCE(MAX(used), 0) + 1 FROM hypotheses').fetchone()[0]
+
+    # One key per sentence, hashing the model once. Translations made in
+    # bfloat16 autocast (see precision.py) are kept apart from float32 ones
+    def keys(self, model, sentences, max_len, beam_width):
+        dtype = autocast_dtype()
+        precision = '' if dtype is None else f' {dtype}'
+        prefix = f'{state_hash(model)} {max_len} {beam_width}{precision}\n'.encode()
+        return [hashlib.sha1(prefix + '\x1f'.join(sentence).encode()).digest()
+                for sentence in sentences]
+
+    # Cached hypotheses of keys, None where there is none
+    def get(self, keys, chunk_size=500):
+        found = {}
+        for i in range(0, len(keys), chunk_size):
+            chunk = keys[i:i + chunk_size]
+            rows = self.db.execute('SELECT key, tokens FROM hypotheses WHERE key IN '
+                                   f'({",".join("?" * len(chunk))})', chunk)
+            found.update((bytes(key), json.loads(bytes(tokens))) for key, tokens in rows)
+        self.touch(list(found))
+        return [found.get(key) for key in keys]
+
+    # Marks the hypotheses of keys as just used
+    def touch(self, keys):
+        if not self.writer():
+            self.pending.extend((key, None) for key in keys)
+        elif keys:
+            with self.db:
+                used = self.tick()
+                self.db.executemany('UPDATE hypotheses SET used = ? WHERE key = ?',
+                                    [(used, key) for key in keys])
+
+    def put(self, keys, preds, chunk_size=500):
+        if not self.writer():
+            self.pending.extend(zip(keys, preds))
+            return
+        rows = {key: json.dumps(pred).encode() for key, pred in zip(keys, preds)}
+        with self.db:
+            used = self.tick()
+            size = self.db.execute('SELECT bytes FROM size').fetchone()[0]
+            # hypotheses that are replaced no longer count
+            replaced = list(rows)
+            for i in range(0, len(replaced), chunk_size):
+                chunk = replaced[i:i + chunk_size]
+                size -= self.db.execute('SELECT COALESCE(SUM(LENGTH(key) + LENGTH(tokens)), 0) '
+                                        f'FROM hypotheses WHERE key IN ({",".join("?" * len(chunk))})',
+                                        chunk).fetchone()[0]
+            self.db.executemany('INSERT OR REPLACE INTO hypotheses VALUES (?, ?, ?)',
+                                [(key, tokens, used) for key, tokens in rows.items()])
+            size += sum(len(key) + len(tokens) for key, tokens in rows.items())
+            if size > self.max_bytes:
+                size = self.evict(size)
+            self.db.execute('UPDATE size SET bytes = ?', (size,))
+
+    # Deletes the least recently used hypotheses until the cache is down to
+    # 90% of max_bytes, so that eviction does not run on every put. Returns
+    # the size left
+    def evict(self, size):
+        target = self.max_bytes * 9 // 10
+        evicted = []
+        rows = self.db.execute('SELECT key, LENGTH(key) + LENGTH(tokens) FROM hypotheses '
+                               'ORDER BY used')
+        for key, length in rows:
+            if size <= target:
+                break
+            evicted.append((key,))
+            size -= length
+        self.db.executemany('DELETE FROM hypotheses WHERE key = ?', evicted)
+        return size
+
+    # The puts and uses of this process since the last take, to be merged
+    # into the cache by the process that opened it
+    def take(self):
+        pending, self.pending = self.pending, []
+        return pending
+
+    def merge(self, pending):
+        self.touch([key for key, pred in pending if pred is None])
+        puts = [(key, pred) for key, pred in pending if pred is not None]
+        self.put([key for key, pred in puts], [pred for key, pred in puts])
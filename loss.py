@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+"""loss.py
+
+Output layer loss of the training notebooks, with the full softmax or with a
+sampled softmax (Jean et al., 2015) for large target vocabularies. With
+sampling the softmax is taken over a per-batch target vocabulary: every word
+occurring in the batch's targets plus n_samples words drawn uniformly from the
+full vocabulary. Inference always uses the full softmax.
+
+    candidates = sample_vocab(trg, output_dim, n_samples) if n_samples else None
+    loss = output_loss(decoder.fc_out, features, trg, pad_idx, candidates)
+
+softmax_benchmark.py compares the training throughput of the two.
+"""
+
+import torch
+import torch.nn.functional as F
+
+# Sorted target ids of trg plus n_samples uniformly drawn ones
+def sample_vocab(trg, vocab_size, n_samples):
+    samples = torch.randint(vocab_size, (n_samples,), device = trg.device)
+    return torch.unique(torch.cat((trg.reshape(-1), samples)))
+
+# Summed cross entropy of fc_out(features) against trg. Given candidates (from
+# sample_vocab) only those rows of fc_out are evaluated and trg is remapped to
+# positions in candidates.
+def output_loss(fc_out, features, trg, ignore_index, candidates = None):
+    if candidates is None:
+        output = fc_out(features)
+    else:
+        output = F.linear(features, fc_out.weight[candidates], fc_out.bias[candidates])
+        trg = torch.searchsorted(candidates, trg.contiguous()).masked_fill(trg == ignore_index, -100)
+        ignore_index = -100
+    return F.cross_entropy(output.view(-1, output.shape[-1]), trg.reshape(-1),
+                           ignore_index = ignore_index, reduction = 'sum')
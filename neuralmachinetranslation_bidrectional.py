@@ -13,6 +13,10 @@ import torch.optim as optim
 import torch.nn.functional as F
 from torchtext.datasets import TranslationDataset
 from torchtext.data import Field, Iterator
+from corpus import MappedCorpus, MappedIterator, save_vocab
+from checkpoint import CheckpointWriter, TrainingState
+from attention import AdditiveAttention
+from loss import sample_vocab, output_loss
 import spacy
 import numpy as np
 import random
@@ -57,20 +61,22 @@ sourceLanguage = targetLanguage = Field(sequential = True,
                                         pad_token = pad_token, 
                                         unk_token = unk_token)
 
+# The corpus is tokenized, lowercased and stored as token ids once by corpus.py
+# (run once, the result is kept next to the data):
+# !python3 corpus.py "/content/gdrive/My Drive/data/europarl-v7.fr-en.bin" --exts .en .fr --split "train=/content/gdrive/My Drive/data/europarl-v7.fr-en"
+# Loading only maps the id files into memory.
 # Load data from Google Drive, use only training data with maximum lenght of 50
-train_data = TranslationDataset("/content/gdrive/My Drive/data/europarl-v7.fr-en", 
-                             exts=('.en', '.fr'), 
-                             fields=(sourceLanguage, targetLanguage),
-                             filter_pred=lambda x: len(x.__dict__['src']) <= 50)
+train_data = MappedCorpus("/content/gdrive/My Drive/data/europarl-v7.fr-en.bin", 'train', max_len = 50)
 
 # Build vocabulary for source and target languages using words
 # with at least 2 occurences in dataset and limit vocab size to 30000
-sourceLanguage.build_vocab(train_data, min_freq = 100)
-targetLanguage.build_vocab(train_data, min_freq = 100)
+# sourceLanguage and targetLanguage are the same field, so its vocabulary is
+# built from both sides of the corpus.
+train_data.build_vocab(sourceLanguage, 0, 1, min_freq = 100)
 # Use the cuda device if available
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
-BATCH_SIZE = 80
+MAX_TOKENS = 5000 # Source + target tokens per batch, padding included
 INPUT_DIM  = len(sourceLanguage.vocab) # Kx = Size of Source Vocabulary
 OUTPUT_DIM = len(targetLanguage.vocab) # Ky = Size of Target Vocabulary
 EMB_DIM = 256 # m = Dimension of Embedding
@@ -79,17 +85,29 @@ MAXOUT_DIM = 400 # l = Dimension of Maxout Hidden Layer
 ATT_HID_DIM = 1000 # n' = Number of Hidden Units in alignment model
 MAX_LENGTH = 50 # Maximum length of sentence used
 
-# Iterators that iterate through train, validation and test data
-train_iterator = Iterator(
+train_iterator = MappedIterator(
     train_data, 
-    batch_size = BATCH_SIZE,
-    sort_key = lambda x: len(x.src),
-    device = device
+    sourceLanguage, 
+    targetLanguage, 
+    batch_size = MAX_TOKENS,
+    device = device,
+    num_workers = 2 # padded batches are built in background processes
 )
 
+# Corpora that are not preprocessed, e.g. the full WMT14 en-fr data, can be
+# streamed from their text files instead; memory then stays bounded by the
+# shuffle buffer and the vocabulary is counted in one pass over the files:
+# from corpus import StreamingCorpus, StreamingIterator
+# train_data = StreamingCorpus("/content/gdrive/My Drive/data/europarl-v7.fr-en", ('.en', '.fr'),
+#                              (sourceLanguage, targetLanguage), max_len = 50)
+# train_data.build_vocab(sourceLanguage, 0, 1, min_freq = 100)
+# train_iterator = StreamingIterator(train_data, sourceLanguage, targetLanguage,
+#                                    batch_size = MAX_TOKENS, device = device, num_workers = 2)
+
 # Encoder Layer
 # Input:
 #   1) source: source sentence
+#   2) source_length: number of non-pad tokens in each sentence (optional)
 # Outputs: 
 #   1) encoder_outputs: the hidden states of the source sentence
 #   2) hidden: the input to the first GRU of the decoder
@@ -102,11 +120,16 @@ class Encoder(nn.Module):
         # self.rnn = nn.GRU(embedding_dimension, hidden_dimension, bidirectional = False)
         self.fc = nn.Linear(hidden_dimension, hidden_dimension)
 
-    def forward(self, source):  
+    def forward(self, source, source_length = None):  
         # Embedding Layer
         embedded = self.embedding(source)
+        # Pack the batch so the GRU skips the padding of shorter sentences
+        if source_length is not None:
+            embedded = nn.utils.rnn.pack_padded_sequence(embedded, source_length.cpu(), enforce_sorted = False)
         # Bidirectional GRU-based RNN
         encoder_outputs, hidden = self.rnn(embedded)
+        if source_length is not None:
+            encoder_outputs, _ = nn.utils.rnn.pad_packed_sequence(encoder_outputs, total_length = source.shape[0])
         # Hidden layer pased as input to decoder
         hidden = torch.tanh(self.fc(hidden[1,:,:]))
         # Monodirectional Implementation:
@@ -117,36 +140,22 @@ class Encoder(nn.Module):
 # Inputs: 
 #   1) hidden: previous hidden state of decoder
 #   2) encoder_outputs: hidden states from the encoder
+#   3) keys: encoder side of the alignment model, see project_keys (optional)
+#   4) mask: False at the padding of encoder_outputs, [batch, src len] (optional)
 # Ouput:
 #   1) Weights alpha_i_j
-class Attention(nn.Module):
+class Attention(AdditiveAttention):
     def __init__(self, hidden_dimension, attention_hidden_dimension):
-        super().__init__()
-        self.attn = nn.Linear((hidden_dimension * 2) + hidden_dimension, attention_hidden_dimension)
+        super().__init__(2 * hidden_dimension, hidden_dimension, attention_hidden_dimension)
         # Monodirectional Implementation:
-        # self.attn = nn.Linear(hidden_dimension + hidden_dimension, attention_hidden_dimension)
-        self.v = nn.Linear(attention_hidden_dimension, 1, bias = False)
-        
-    def forward(self, hidden, encoder_outputs):
-        batch_size = encoder_outputs.shape[1]
-        source_length = encoder_outputs.shape[0]
-        # Repeat decoder hidden state source_length times
-        # This is done to calculate the energy between the hidden state 
-        # and each of the encoder's source_length hidden states 
-        hidden = hidden.unsqueeze(1).repeat(1, source_length, 1)
-        encoder_outputs = encoder_outputs.permute(1, 0, 2)
-        # Calculate alignment model (also known as energy)
-        energy = torch.tanh(self.attn(torch.cat((hidden, encoder_outputs), dim = 2)))
-        # Single perceptron 
-        attention = self.v(energy).squeeze(2)
-        # Return softmax of alignment model
-        return F.softmax(attention, dim=1)
+        # super().__init__(hidden_dimension, hidden_dimension, attention_hidden_dimension)
 
 # Decoder Layer
 # Inputs:
 #   1) input: y_t-1 used to compute y_t
 #   2) hidden: s_t-1 used to in layer t
 #   3) encoder_outputs: hidden states from the encoder
+#   4) keys, mask: passed on to the attention layer (optional)
 # Outputs:
 #   1) prediction: y_t
 #   2) hidden: s_t
@@ -161,13 +170,21 @@ class Decoder(nn.Module):
         self.maxout = nn.Linear((hidden_dimension * 2) + hidden_dimension + embedding_dimension, 2 * maxout_dimension)
         self.fc_out = nn.Linear(maxout_dimension, output_dimension)
         
-    def forward(self, input, hidden, encoder_outputs):        
+    def forward(self, input, hidden, encoder_outputs, keys = None, mask = None):
+        t, hidden = self.features(input, hidden, encoder_outputs, keys, mask)
+        # FC layer
+        prediction = self.fc_out(t)
+        # Return prediciton y_t along with hidden state s_t
+        return prediction, hidden
+
+    # Decoder step up to the maxout layer, i.e. everything except fc_out
+    def features(self, input, hidden, encoder_outputs, keys = None, mask = None):        
         # Reshape Input
         input = input.unsqueeze(0)
         # Embedding Layer        
         embedded = self.embedding(input)
         # Attention Layer
-        a = self.attention(hidden, encoder_outputs)
+        a = self.attention(hidden, encoder_outputs, keys, mask)
         # Reshape attention output
         a = a.unsqueeze(1)
         
@@ -198,45 +215,49 @@ class Decoder(nn.Module):
         t_init = t_init.view(batch_size ,self.maxout_dimension, 2)
         t, _ = torch.max(t_init,2)  
         t = t.view(batch_size,t.shape[1])  # Size l
-        # FC layer
-        prediction = self.fc_out(t)
-        # Return prediciton y_t along with hidden state s_t
-        return prediction, hidden.squeeze(0)
+        # Return maxout output t along with hidden state s_t
+        return t, hidden.squeeze(0)
 
 # Model Encapsulating all Layers
 # Inputs: 
 #   1) src: source sentence
 #   2) trg: target sentence
 #   3) train: bool indicating if model currenlty used for training or evaluation
+#   4) return_scores: when evaluating, also return the log probability of each token
+# n_samples > 0 trains with a sampled softmax over that many extra words
 # Outputs:
-#   1) outputs_train/outputs_evaluate: All the y_ts predicted by the model
+#   1) train = 1: logits of all the y_ts, [target_length, batch_size, vocab]
+#   2) train = 0: greedy token ids [max_length, batch_size] (and their scores)
 class Seq2SeqBiDirectionalSearch(nn.Module):
-    def __init__(self, encoder, decoder, max_length, device):
+    def __init__(self, encoder, decoder, max_length, device, n_samples = 0):
         super().__init__()
         self.encoder = encoder
         self.decoder = decoder
         self.device = device
         self.max_length = max_length
+        self.n_samples = n_samples
     
-    def forward(self, src, trg, train):
+    def forward(self, src, trg, train, return_scores = False):
         batch_size = src.shape[1]
         target_length = trg.shape[0]
         target_vocab_size = self.decoder.output_dimension
-        # Output tensors used to hold predictions, if train = 1 then outputs_train is used
-        # with size target_length, however when evaluating (i.e. train = 0), outputs_evaluate
-        # is used with size max_length
-        outputs_train = torch.zeros(target_length, batch_size, target_vocab_size).to(self.device)
-        outputs_evaluate = torch.zeros(self.max_length, batch_size, target_vocab_size).to(self.device)
+        # Mask of the non-pad source positions, [batch_size, source length]
+        mask = (src != sourceLanguage.vocab.stoi[sourceLanguage.pad_token]).permute(1, 0)
         # Call encoder layer and get encoder_outputs and hidden
-        encoder_outputs, hidden = self.encoder(src)
+        encoder_outputs, hidden = self.encoder(src, mask.sum(1))
+        # Encoder side of the attention, computed once for all decoder steps
+        keys = self.decoder.attention.project_keys(encoder_outputs)
         
         input = trg[0,:] # SOS (Start-Of-Sentence) used as the first input y_1 
         
         # If in training phase, run decoder target_length times, with output
         # hidden used as s_t-1 to next stage t and decoder_output used as y_t-1
         if train == 1: # training 
+          # Logits for every target position, row 0 (SOS) is left at zero
+          outputs_train = torch.empty(target_length, batch_size, target_vocab_size, device=input.device)
+          outputs_train[0] = 0
           for t in range(1, target_length):
-              decoder_output, hidden = self.decoder(input, hidden, encoder_outputs)
+              decoder_output, hidden = self.decoder(input, hidden, encoder_outputs, keys, mask)
               outputs_train[t] = decoder_output
               input = decoder_output.argmax(1)
           # Return decoder predictions
@@ -244,20 +265,63 @@ class Seq2SeqBiDirectionalSearch(nn.Module):
         # If in evaluation phase, run decoder till EOS predicted or till max_length
         # of sentence
         elif train == 0: # evaluate
-          # Evaluate source sentences individually, i.e. batching not used
-          for batch_idx in range(batch_size):
-            input_temp = input[batch_idx].reshape(1)
-            hidden_temp = hidden[batch_idx, :].reshape(1, hidden.shape[1])
-            encoder_outputs_temp = encoder_outputs[:, batch_idx, :].reshape(encoder_outputs.shape[0], 1, encoder_outputs.shape[2])
-            for t in range(1, self.max_length):                
-                decoder_output, hidden_temp = self.decoder(input_temp, hidden_temp , encoder_outputs_temp )
-                outputs_evaluate[t, batch_idx]= decoder_output
-                input_temp = decoder_output.argmax(1)
-                # If y_t = EOS return
-                if targetLanguage.vocab.itos[input_temp] == targetLanguage.eos_token: 
-                  break
+          # Greedy decoding of the whole batch at once. A sentence is finished
+          # once it has predicted EOS. Positions without a prediction (row 0,
+          # after EOS, after an early stop) hold UNK with score 0, matching
+          # the argmax of the all-zero logits the full output tensor used to hold
+          eos = targetLanguage.vocab.stoi[targetLanguage.eos_token]
+          unk = targetLanguage.vocab.stoi[targetLanguage.unk_token]
+          tokens = torch.full((self.max_length, batch_size), unk, dtype=torch.long, device=input.device)
+          scores = torch.zeros(self.max_length, batch_size, device=input.device) if return_scores else None
+          finished = torch.zeros(batch_size, dtype=torch.bool, device=input.device)
+          for t in range(1, self.max_length):
+              decoder_output, hidden = self.decoder(input, hidden, encoder_outputs, keys, mask)
+              input = decoder_output.argmax(1)
+              tokens[t] = input.masked_fill(finished, unk)
+              if return_scores:
+                score = F.log_softmax(decoder_output, 1).gather(1, input.unsqueeze(1)).squeeze(1)
+                scores[t] = score.masked_fill(finished, 0)
+              finished |= input == eos
+              # Stop once every sentence has predicted EOS
+              if finished.all():
+                break
           # Return decoder predictions
-          return outputs_evaluate
+          return (tokens, scores) if return_scores else tokens
+
+    # Training loss without the [target_length, batch_size, target_vocab_size]
+    # logits: runs the same decoding as train = 1 but keeps only the maxout
+    # outputs, then applies fc_out and the loss chunk_size steps at a time,
+    # backpropagating each chunk on its own before backpropagating through the
+    # decoder. Returns the value of criterion(model(src, trg, 1)[1:], trg[1:]),
+    # or the sampled softmax loss when n_samples is set.
+    def backward_loss(self, src, trg, criterion, chunk_size = 8):
+        target_length = trg.shape[0]
+        mask = (src != sourceLanguage.vocab.stoi[sourceLanguage.pad_token]).permute(1, 0)
+        encoder_outputs, hidden = self.encoder(src, mask.sum(1))
+        keys = self.decoder.attention.project_keys(encoder_outputs)
+        input = trg[0,:]
+        features = []
+        for t in range(1, target_length):
+            feature, hidden = self.decoder.features(input, hidden, encoder_outputs, keys, mask)
+            features.append(feature)
+            with torch.no_grad():
+              input = self.decoder.fc_out(feature).argmax(1)
+
+        # Detach the maxout outputs so each chunk can be backpropagated alone
+        features = torch.stack(features)
+        detached = features.detach().requires_grad_()
+        trg = trg[1:]
+        n_tokens = (trg != criterion.ignore_index).sum()
+        candidates = sample_vocab(trg, self.decoder.output_dimension, self.n_samples) if self.n_samples else None
+        total = 0.0
+        for t in range(0, target_length - 1, chunk_size):
+            loss = output_loss(self.decoder.fc_out, detached[t:t + chunk_size], trg[t:t + chunk_size],
+                               criterion.ignore_index, candidates) / n_tokens
+            loss.backward()
+            total += loss.item()
+        # Backpropagate the accumulated gradient through the decoder and encoder
+        features.backward(detached.grad)
+        return total
 
 # Instantiate layers and model
 enc = Encoder(INPUT_DIM, EMB_DIM, HID_DIM)
@@ -286,10 +350,10 @@ TRG_PAD_IDX = targetLanguage.vocab.stoi[targetLanguage.pad_token]
 criterion = nn.CrossEntropyLoss(ignore_index = TRG_PAD_IDX)
 
 # Train the model and compute training loss
-def train(model, iterator, optimizer, criterion, clip):
+def train(model, iterator, optimizer, criterion, clip, state = None):
     
     model.train()
-    epoch_loss = 0
+    epoch_loss = 0 if state is None else state.epoch_loss
     
     # Loop through epoch
     for i, batch in enumerate(iterator):
@@ -297,21 +361,14 @@ def train(model, iterator, optimizer, criterion, clip):
       trg = batch.trg
       optimizer.zero_grad()
 
-      # Model with train = 1
-      output = model(src, trg, 1)
-      # Reshape Output and Target
-      output_dim = output.shape[-1]
-      output = output[1:].view(-1, output_dim)
-      trg = trg[1:].view(-1)
-
-      # Compute loss 
-      loss = criterion(output, trg)
-      # Backpropagation
-      loss.backward()
+      # Compute loss and backpropagate, as for model(src, trg, 1) but
+      # without holding the logits for every step at once
+      loss = model.backward_loss(src, trg, criterion)
       # Use gradient clipping
       torch.nn.utils.clip_grad_norm_(model.parameters(), clip)
       optimizer.step()
-      epoch_loss += loss.item()
+      epoch_loss += loss
+      if state is not None: state.step(epoch_loss)
 
     # Return average loss 
     return epoch_loss / len(iterator)
@@ -329,20 +386,19 @@ def evaluate(model, iterator):
     scores = defaultdict(float)
     epoch_bleu_score = 0
     
-    with torch.no_grad():
+    with torch.no_grad(), model.decoder.attention.decoding():
         # Loop through epoch
         for i, batch in enumerate(iterator):
             src = batch.src
             trg = batch.trg
 
-            # Model with train = 1
+            # Model with train = 0, greedy token ids
             output = model(src, trg, 0)
-            sentence_size, batch_size, vocab_size = output.shape
+            sentence_size, batch_size = output.shape
             
             # Compute Bleu Score for sentences in current batch
             for batch_idx in range(batch_size):
-                probs = F.softmax(output[:,batch_idx,:], 1)
-                _, sentence_by_idx = probs.max(axis=1)                      
+                sentence_by_idx = output[:, batch_idx]
                 score = sentence_bleu([one_hot_to_text(trg[:,batch_idx], targetLanguage)], one_hot_to_text(sentence_by_idx, targetLanguage))
                 length = len([1 for word in src[:,batch_idx] if word != targetLanguage.vocab.stoi[targetLanguage.unk_token]])
                 counts[length] += 1
@@ -366,17 +422,32 @@ CLIP = 1
 model.load_state_dict(torch.load(f'/content/gdrive/My Drive/models/attention-model-bidirectional-3.pt'))
 model.eval()
 
-for epoch in range(4, N_EPOCHS):
+# targetLanguage is the same field as sourceLanguage
+save_vocab('/content/gdrive/My Drive/models/attention-model-bidirectional-vocab.json', src=sourceLanguage)
+
+# Epoch checkpoints are written to Drive in the background, see checkpoint.py
+checkpoints = CheckpointWriter()
+
+# Full training state (optimizer, random generators, place in the epoch),
+# saved every CHECKPOINT_STEPS batches and after every epoch, so that a run
+# that was stopped continues where it was, see checkpoint.py
+CHECKPOINT_STEPS = 1000
+state = TrainingState('/content/gdrive/My Drive/models/attention-model-bidirectional-state.pt',
+                      model, optimizer, train_iterator,
+                      every = CHECKPOINT_STEPS, writer = checkpoints)
+
+for epoch in range(state.resume(4), N_EPOCHS):
     start_time = time.time()
-    train_loss = train(model, train_iterator, optimizer, criterion, CLIP) 
+    train_loss = train(model, train_iterator, optimizer, criterion, CLIP, state = state) 
     end_time = time.time()
     epoch_mins, epoch_secs = epoch_time(start_time, end_time)
 
     print(f'Epoch: {epoch+1:02} | Time: {epoch_mins}m {epoch_secs}s')
     print(f'\tTrain Loss: {train_loss: }')
-    torch.save(model.state_dict(), f'/content/gdrive/My Drive/models/attention-model-bidirectional-{epoch}.pt')
-    model.load_state_dict(torch.load(f'/content/gdrive/My Drive/models/attention-model-bidirectional-{epoch}.pt'))
+    state.end_epoch()
+    checkpoints.save(model.state_dict(), f'/content/gdrive/My Drive/models/attention-model-bidirectional-{epoch}.pt')
     model.eval()
+checkpoints.wait()
 
 # Plot Training Loss
 plt.title("Training Loss") 
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""precision.py
+
+Opt-in bfloat16 mixed precision for the GRU models on the CPU. Inside
+autocast() the matmuls of nn.Linear, F.linear and torch.bmm (attention
+energies and context, fc_out) run in bfloat16 on float32 weights. nn.Embedding
+and nn.GRU are not on the autocast op lists, so mixed_precision(model) hooks
+them: embeddings come out in bfloat16, which makes the GRUs run in bfloat16
+as well, and GRU inputs and hidden states are cast in case they were not.
+
+    search = mixed_precision(search)
+    with autocast(BF16):
+        output = search(src, trg)
+    loss = criterion(output[1:].view(-1, output.shape[-1]), trg[1:].view(-1))
+    loss.backward()
+
+Losses and softmaxes stay float32: cross_entropy is autocast to float32, and
+the models ask F.softmax and F.log_softmax for dtype=torch.float. Weights,
+gradients and optimizer state stay float32, so checkpoints do not depend on
+the mode and a model trained in one mode can be evaluated in the other. The
+hooks do nothing outside autocast. bfloat16 is only faster on CPUs with
+AVX512-BF16 or AMX; elsewhere it is emulated and slower than float32.
+"""
+
+import torch
+import torch.nn as nn
+
+DTYPE = torch.bfloat16
+
+# Runs the enclosed forward pass in bfloat16 where enabled. Backward passes
+# should be outside it
+def autocast(enabled=True):
+    return torch.autocast('cpu', dtype=DTYPE, enabled=enabled)
+
+# The dtype CPU autocast casts to, None outside autocast
+def autocast_dtype():
+    try:
+        enabled, dtype = torch.is_autocast_enabled('cpu'), torch.get_autocast_dtype('cpu')
+    except (TypeError, AttributeError):
+        # before torch 2.4
+        enabled, dtype = torch.is_autocast_cpu_enabled(), torch.get_autocast_cpu_dtype()
+    return dtype if enabled else None
+
+def cast_output(module, inputs, output):
+    dtype = autocast_dtype()
+    return output if dtype is None else output.to(dtype)
+
+def cast_inputs(module, inputs):
+    dtype = autocast_dtype()
+    if dtype is None:
+        return inputs
+    # the input may be a PackedSequence, which has its own to()
+    return tuple(x if x is None else x.to(dtype) for x in inputs)
+
+# Registers the casts of embedding outputs and GRU inputs on every
+# nn.Embedding and nn.GRU of model, and returns model
+def mixed_precision(model):
+    for module in model.modules():
+        if isinstance(module, nn.Embedding):
+            module.register_forward_hook(cast_output)
+        elif isinstance(module, nn.GRU):
+            module.register_forward_pre_hook(cast_inputs)
+    return model
@@ -13,6 +13,11 @@ import torch.optim as optim
 import torch.nn.functional as F
 from torchtext.datasets import TranslationDataset, Multi30k, IWSLT
 from torchtext.data import Field, BucketIterator, Iterator
+from corpus import load_vocab
+from hypotheses import HypothesisCache
+from search import beam_search, source_batch, translate_sentences
+from sweep import Job, sweep, format_table
+from attention import AdditiveAttention
 import spacy
 import numpy as np
 import random
@@ -20,7 +25,7 @@ import math
 import time
 from collections import defaultdict
 from matplotlib import pyplot as plt
-from nltk.translate.bleu_score import sentence_bleu, SmoothingFunction
+from bleu import bleu_tokens
 import itertools
 
 # Commented out IPython magic to ensure Python compatibility.
@@ -61,10 +66,6 @@ SRC = Field(init_token=sos_token,
 
 # Commented out IPython magic to ensure Python compatibility.
 # %%capture
-# train_data, _, _ = IWSLT.splits(exts = ('.de', '.en'), 
-#                         fields = (SRC, TRG),
-#                         filter_pred=lambda x: len(x.__dict__['src']) <= 50)
-# 
 # test_10, valid_10, valid_12 = IWSLT.splits(exts = ('.de', '.en'), 
 #                                 fields = (SRC, TRG),
 #                                 train='IWSLT16.TED.tst2010',
@@ -89,11 +90,15 @@ SRC = Field(init_token=sos_token,
 # valid_data = [valid_10, valid_12]
 # test_data = [test_10, test_11, test_12, test_13, test_13x, test_14x, test_14]
 
-SRC.build_vocab(train_data, max_size=10000)
-TRG.build_vocab(train_data, max_size=10000)
+# Vocabulary the models were trained with, saved by the training notebook
+load_vocab('/content/drive/My Drive/ml-mini-project/concat-attention/vocab.json', src=SRC, trg=TRG)
 
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
+# Translations already made with the same weights and beam settings, kept on
+# Drive so that reruns of the notebook do not decode them again
+hypotheses = HypothesisCache('/content/drive/My Drive/ml-mini-project/hypotheses.db')
+
 INPUT_DIM = len(SRC.vocab)
 OUTPUT_DIM = len(TRG.vocab)
 ENC_EMB_DIM = 300
@@ -108,8 +113,11 @@ class Encoder(nn.Module):
         self.rnn = nn.GRU(emb_dim, hid_dim, bidirectional = True)
         self.fc = nn.Linear(2 * hid_dim, hid_dim)
         
-    def forward(self, src):
+    def forward(self, src, src_len = None):
         embedded = self.embedding(src)
+        if src_len is not None:
+            # Packing skips the <pad> positions at the end of shorter sentences
+            embedded = nn.utils.rnn.pack_padded_sequence(embedded, src_len.cpu(), enforce_sorted = False)
         outputs, hidden = self.rnn(embedded)
         hidden = torch.tanh(self.fc(torch.cat((hidden[-2,:,:], hidden[-1,:,:]), dim = 1)))
         return hidden.unsqueeze(0)
@@ -146,7 +154,8 @@ class EncoderDecoder(nn.Module):
         trg_len = trg.shape[0]
         trg_vocab_size = self.decoder.output_dim
         outputs = torch.zeros(trg_len, batch_size, trg_vocab_size).to(self.device)
-        context = self.encoder(src)
+        src_len = (src != SRC.vocab.stoi[SRC.pad_token]).sum(0)
+        context = self.encoder(src, src_len)
         hidden = context
         input = trg[0,:]
         
@@ -160,30 +169,14 @@ class EncoderDecoder(nn.Module):
         return outputs
 
     def translate(self, sentence, max_len=50, beam_width=3):
+        return self.translate_batch([sentence], max_len, beam_width)[0]
+
+    def translate_batch(self, sentences, max_len=50, beam_width=3):
         self.eval()
-        src = SRC.process([sentence]).to(device)
-        context = self.encoder(src)
-        hidden = context
-        beams = [(0.0, [TRG.vocab.stoi[TRG.init_token]], hidden)]
-        done = False
-        log_smax = nn.LogSoftmax(dim=0).to(device)
-
-        while not done:
-            for i in range(len(beams)):
-                p, sent, hidden = beams.pop(0)
-                if len(sent) >= max_len or sent[-1] == TRG.vocab.stoi[TRG.eos_token]:
-                    beams += [(p, sent, hidden)]
-                    continue
-                trg = torch.ones(1, dtype=torch.int64).to(device) * sent[-1]
-                pred, hidden = self.decoder(trg, hidden, context)
-                ll = log_smax(pred[0])
-                top_ll, top_t = torch.topk(ll, k=beam_width)
-                beams += [(p + ll, sent + [t], hidden) for ll, t in zip(top_ll, top_t)]
-            beams = sorted(beams, reverse=True)[:beam_width]
-            done = all([b[1][-1] == TRG.vocab.stoi[TRG.eos_token] or len(b[1]) >= max_len for b in beams])
-
-        trgs = beams.pop(0)[1]
-        return [TRG.vocab.itos[i] for i in trgs]
+        src, src_len, _ = source_batch(SRC, sentences, device)
+        context = self.encoder(src, src_len)
+        trgs = beam_search(self.decoder, context, context, TRG, max_len, beam_width)
+        return [[TRG.vocab.itos[i] for i in t] for t in trgs]
 
 class EncoderAttn(nn.Module):
     def __init__(self, input_dim, emb_dim, enc_hid_dim, dec_hid_dim):
@@ -192,30 +185,20 @@ class EncoderAttn(nn.Module):
         self.rnn = nn.GRU(emb_dim, enc_hid_dim, bidirectional = True)
         self.fc = nn.Linear(enc_hid_dim*2, dec_hid_dim)
         
-    def forward(self, src):
+    def forward(self, src, src_len = None):
         embedded = self.embedding(src)
+        if src_len is not None:
+            # Packing skips the <pad> positions at the end of shorter sentences
+            embedded = nn.utils.rnn.pack_padded_sequence(embedded, src_len.cpu(), enforce_sorted = False)
         outputs, hidden = self.rnn(embedded)
+        if src_len is not None:
+            outputs, _ = nn.utils.rnn.pad_packed_sequence(outputs, total_length = src.shape[0])
         hidden = torch.tanh(self.fc(torch.cat((hidden[0,:,:], hidden[1,:,:]), dim = 1)))
         return outputs, hidden
 
-class Attention(nn.Module):
+class Attention(AdditiveAttention):
     def __init__(self, enc_hid_dim, dec_hid_dim):
-        super().__init__()
-        
-        self.attn = nn.Linear(2 * enc_hid_dim + dec_hid_dim, dec_hid_dim)
-        self.v = nn.Linear(dec_hid_dim, 1, bias = False)
-        
-    def forward(self, hidden, encoder_outputs):
-        batch_size = encoder_outputs.shape[1]
-        src_len = encoder_outputs.shape[0]
-        
-        hidden = hidden.unsqueeze(1).repeat(1, src_len, 1)
-        encoder_outputs = encoder_outputs.permute(1, 0, 2)
-        
-        energy = torch.tanh(self.attn(torch.cat((hidden, encoder_outputs), dim = 2))) 
-        attention = self.v(energy).squeeze(2)
-        
-        return F.softmax(attention, dim=1)
+        super().__init__(2 * enc_hid_dim, dec_hid_dim)
 
 class DecoderAttn(nn.Module):
     def __init__(self, output_dim, emb_dim, enc_hid_dim, dec_hid_dim, attention):
@@ -226,10 +209,10 @@ class DecoderAttn(nn.Module):
         self.rnn = nn.GRU((enc_hid_dim * 2) + emb_dim, dec_hid_dim)
         self.fc_out = nn.Linear((enc_hid_dim * 2) + dec_hid_dim + emb_dim, output_dim)
         
-    def forward(self, input, hidden, encoder_outputs):
+    def forward(self, input, hidden, encoder_outputs, keys = None, mask = None):
         input = input.unsqueeze(0)
         embedded = self.embedding(input)
-        a = self.attention(hidden, encoder_outputs)
+        a = self.attention(hidden, encoder_outputs, keys, mask)
         a = a.unsqueeze(1)
         encoder_outputs = encoder_outputs.permute(1, 0, 2)
         weighted = torch.bmm(a, encoder_outputs)
@@ -256,11 +239,13 @@ class Search(nn.Module):
         trg_vocab_size = self.decoder.output_dim
         
         outputs = torch.zeros(trg_len, batch_size, trg_vocab_size).to(self.device)
-        encoder_outputs, hidden = self.encoder(src)
+        mask = (src != SRC.vocab.stoi[SRC.pad_token]).permute(1, 0)
+        encoder_outputs, hidden = self.encoder(src, mask.sum(1))
+        keys = self.decoder.attention.project_keys(encoder_outputs)
         input = trg[0,:]
         
         for t in range(1, trg_len):
-            output, hidden = self.decoder(input, hidden, encoder_outputs)
+            output, hidden = self.decoder(input, hidden, encoder_outputs, keys, mask)
             outputs[t] = output
             top1 = output.argmax(1)
             input = top1
@@ -268,29 +253,16 @@ class Search(nn.Module):
         return outputs
     
     def translate(self, sentence, max_len=50, beam_width=3):
+        return self.translate_batch([sentence], max_len, beam_width)[0]
+
+    def translate_batch(self, sentences, max_len=50, beam_width=3):
         self.eval()
-        src = SRC.process([sentence]).to(device)
-        encoder_out, hidden = self.encoder(src)
-        beams = [(0.0, [TRG.vocab.stoi[TRG.init_token]], hidden)]
-        done = False
-        log_smax = nn.LogSoftmax(dim=0).to(device)
-
-        while not done:
-            for i in range(len(beams)):
-                p, sent, hidden = beams.pop(0)
-                if len(sent) >= max_len or sent[-1] == TRG.vocab.stoi[TRG.eos_token]:
-                    beams += [(p, sent, hidden)]
-                    continue
-                trg = torch.ones(1, dtype=torch.int64).to(device) * sent[-1]
-                pred, hidden = self.decoder(trg, hidden, encoder_out)
-                ll = log_smax(pred[0])
-                top_ll, top_t = torch.topk(ll, k=beam_width)
-                beams += [(p + ll, sent + [t], hidden) for ll, t in zip(top_ll, top_t)]
-            beams = sorted(beams, reverse=True)[:beam_width]
-            done = all([b[1][-1] == TRG.vocab.stoi[TRG.eos_token] or len(b[1]) >= max_len for b in beams])
-
-        trgs = beams.pop(0)[1]
-        return [TRG.vocab.itos[i] for i in trgs]
+        src, src_len, mask = source_batch(SRC, sentences, device)
+        encoder_out, hidden = self.encoder(src, src_len)
+        keys = self.decoder.attention.project_keys(encoder_out)
+        with self.decoder.attention.decoding():
+            trgs = beam_search(self.decoder, hidden, encoder_out, TRG, max_len, beam_width, keys, mask)
+        return [[TRG.vocab.itos[i] for i in t] for t in trgs]
 
 enc_ed = Encoder(INPUT_DIM, ENC_EMB_DIM, HID_DIM)
 dec_ed = Decoder(OUTPUT_DIM, DEC_EMB_DIM, HID_DIM)
@@ -302,30 +274,36 @@ dec_se = DecoderAttn(OUTPUT_DIM, DEC_EMB_DIM, HID_DIM, HID_DIM, att)
 search = Search(enc_se, dec_se, device).to(device)
 
 def evaluate_bleu(model, datasets):
-    overall_size = sum([len(d) for d in datasets])
-    total = 0.0
-    for i, example in enumerate(itertools.chain(*datasets)):
-        pred = model.translate(example.src)[1:-2]
-        total += sentence_bleu([example.trg], pred, smoothing_function=SmoothingFunction().method1)
-        if i % 200 == 199: print('.', end='')
-    print('')
-    return total / overall_size
+    examples = list(itertools.chain(*datasets))
+    preds = translate_sentences(model, [example.src for example in examples], hypotheses)
+    return bleu_tokens([pred[1:-2] for pred in preds],
+                       [example.trg for example in examples]).sentences.mean()
 
 EPOCHS = 10
 CONTROL_FOLDER = '/content/drive/My Drive/ml-mini-project/concat-control'
 ATTENTION_FOLDER = '/content/drive/My Drive/ml-mini-project/concat-attention'
 
-ctrl_valid_err = []
-attn_valid_err = []
+# The checkpoints are evaluated in parallel CPU processes, see sweep.py
+def use_cpu():
+    global device
+    device = torch.device('cpu')
+
+def make_enc_dec():
+    return EncoderDecoder(Encoder(INPUT_DIM, ENC_EMB_DIM, HID_DIM),
+                          Decoder(OUTPUT_DIM, DEC_EMB_DIM, HID_DIM), device)
 
-for epoch in range(EPOCHS + 1):
-    enc_dec.load_state_dict(torch.load(f'{CONTROL_FOLDER}/epoch-{epoch}.pt'))
-    search.load_state_dict(torch.load(f'{ATTENTION_FOLDER}/epoch-{epoch}.pt'))
+def make_search():
+    return Search(EncoderAttn(INPUT_DIM, ENC_EMB_DIM, HID_DIM, HID_DIM),
+                  DecoderAttn(OUTPUT_DIM, DEC_EMB_DIM, HID_DIM, HID_DIM, Attention(HID_DIM, HID_DIM)), device)
 
-    print('Control Evaluation')
-    ctrl_valid_err.append(evaluate_bleu(enc_dec, valid_data))
-    print('Attention Evaluation')
-    attn_valid_err.append(evaluate_bleu(search, valid_data))
+jobs = [Job(('control', epoch), make_enc_dec, f'{CONTROL_FOLDER}/epoch-{epoch}.pt', valid_data)
+        for epoch in range(EPOCHS + 1)]
+jobs += [Job(('attention', epoch), make_search, f'{ATTENTION_FOLDER}/epoch-{epoch}.pt', valid_data)
+         for epoch in range(EPOCHS + 1)]
+rows = sweep(jobs, lambda model, data: {'bleu': evaluate_bleu(model, data)}, init=use_cpu, caches=[hypotheses])
+print(format_table(rows))
+ctrl_valid_err = [row['bleu'] for row in rows[:EPOCHS + 1]]
+attn_valid_err = [row['bleu'] for row in rows[EPOCHS + 1:]]
 
 fig, ax = plt.subplots(figsize=(10,8))
 ax.set_axisbelow(True)
@@ -348,27 +326,11 @@ fig.tight_layout()
 plt.show()
 
 def bleu_summary(model, datasets):
-    overall_examples = sum([len(d) for d in datasets])
-    lengths = np.zeros(overall_examples, dtype=np.int32)
-    scores = np.zeros(overall_examples)
-
-    for i, example in enumerate(itertools.chain(*datasets)):
-        pred = model.translate(example.src)
-        scores[i] = sentence_bleu([example.trg], pred, smoothing_function=SmoothingFunction().method1)
-        lengths[i] = len(example.src)
-        if i % 900 == 899: print('.', end='')
-        
-    print('')
-    means, up, lo = {}, {}, {}
-    uniq_lengths, counts = np.unique(lengths, return_counts=True)
-    for l, c in zip(uniq_lengths, counts):
-        s = scores[lengths == l]
-        means[l] = s.mean()
-        up[l] = means[l] + (np.sqrt(s.var() / c) * 1.65)
-        lo[l] = means[l] - (np.sqrt(s.var() / c) * 1.65)
-
-    uniq_lengths = [l for l in sorted(uniq_lengths)]
-    return uniq_lengths, [means[l] for l in uniq_lengths], [up[l] for l in uniq_lengths], [lo[l] for l in uniq_lengths]
+    examples = list(itertools.chain(*datasets))
+    preds = translate_sentences(model, [example.src for example in examples], hypotheses)
+    # mean BLEU per source length with its 1.65 standard error band
+    return bleu_tokens(preds, [example.trg for example in examples],
+                       [len(example.src) for example in examples]).buckets
 
 enc_dec.load_state_dict(torch.load(f'{CONTROL_FOLDER}/epoch-{np.argmax(ctrl_valid_err)}.pt'))
 search.load_state_dict(torch.load(f'{ATTENTION_FOLDER}/epoch-{np.argmax(attn_valid_err)}.pt'))
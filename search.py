@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""search.py
+
+Batched beam search and sentence translation shared by the evaluation
+notebooks (comparison, hidden_experiment, replication_experiment). A model's
+translate_batch encodes a batch of tokenized sentences and hands the decoder
+to beam_search:
+
+    src, src_len, mask = source_batch(SRC, sentences, device)
+    encoder_out, hidden = self.encoder(src, src_len)
+    keys = self.decoder.attention.project_keys(encoder_out)
+    trgs = beam_search(self.decoder, hidden, encoder_out, TRG, max_len, beam_width, keys, mask)
+
+translate_sentences translates a whole evaluation set through translate_batch,
+skipping the sentences already in a HypothesisCache (see hypotheses.py).
+"""
+
+import itertools
+import torch
+import torch.nn.functional as F
+
+# Padded source ids [src len, batch] of tokenized sentences, with the length
+# of each sentence for packing and the mask of its non-pad positions
+# [batch, src len] for attention
+def source_batch(src_field, sentences, device):
+    src = src_field.process(sentences).to(device)
+    mask = (src != src_field.vocab.stoi[src_field.pad_token]).permute(1, 0)
+    return src, mask.sum(1), mask
+
+# All live hypotheses of all sentences are kept as a single [batch * beam, ...]
+# batch so the decoder runs once per time step, and each sentence picks its
+# next beam with one topk over its flattened [beam * vocab] scores. hidden is
+# the initial decoder state (batch dim second to last) and memory is whatever
+# the decoder attends to or conditions on ([*, batch, dim]). Attention
+# decoders also take the cached attention keys ([batch, src len, dim]) and the
+# source mask ([batch, src len]) of a padded batch. Sentences whose beams have
+# all finished are dropped from the batch. If vocab (sorted target ids) is
+# given only those rows of decoder.fc_out are evaluated, see Shortlist.
+# trg_field gives the <sos> and <eos> ids; results are lists of target ids
+@torch.no_grad()
+def beam_search(decoder, hidden, memory, trg_field, max_len=50, beam_width=3, keys=None, mask=None, vocab=None):
+    sos = trg_field.vocab.stoi[trg_field.init_token]
+    eos = trg_field.vocab.stoi[trg_field.eos_token]
+    batch_size = memory.shape[1]
+    dev = memory.device
+    out = {}
+    eos_col = eos
+    if vocab is not None:
+        weight, bias = decoder.fc_out.weight[vocab], decoder.fc_out.bias[vocab]
+        out['fc_out'] = lambda x: F.linear(x, weight, bias)
+        eos_col = (vocab == eos).nonzero().item()
+
+    hidden = hidden.repeat_interleave(beam_width, dim=hidden.dim() - 2)
+    memory = memory.repeat_interleave(beam_width, dim=1)
+    if keys is not None:
+        keys = keys.repeat_interleave(beam_width, dim=0)
+    if mask is not None:
+        mask = mask.repeat_interleave(beam_width, dim=0)
+    tokens = torch.full((batch_size * beam_width, 1), sos, dtype=torch.long, device=dev)
+    # only the first hypothesis of each sentence is live at the start
+    scores = torch.full((batch_size, beam_width), float('-inf'), device=dev)
+    scores[:, 0] = 0.0
+    scores = scores.view(-1)
+    finished = torch.zeros(batch_size * beam_width, dtype=torch.bool, device=dev)
+    alive = torch.arange(batch_size, device=dev)
+    results = [None] * batch_size
+
+    def collect(sentences):
+        best = scores.view(-1, beam_width).argmax(1)
+        best += torch.arange(best.shape[0], device=dev) * beam_width
+        for i in sentences.tolist():
+            trgs = tokens[best[i]].tolist()
+            results[alive[i]] = trgs[:trgs.index(eos) + 1] if eos in trgs else trgs
+
+    while tokens.shape[1] < max_len:
+        done = finished.view(-1, beam_width).all(1)
+        if done.any():
+            collect(done.nonzero().squeeze(1))
+            keep = (~done).nonzero().squeeze(1)
+            if keep.numel() == 0:
+                return results
+            rows = (keep.unsqueeze(1) * beam_width + torch.arange(beam_width, device=dev)).view(-1)
+            tokens, scores, finished = tokens[rows], scores[rows], finished[rows]
+            hidden = hidden.index_select(hidden.dim() - 2, rows)
+            memory = memory.index_select(1, rows)
+            if keys is not None:
+                keys = keys.index_select(0, rows)
+            if mask is not None:
+                mask = mask.index_select(0, rows)
+            alive = alive[keep]
+
+        if keys is None:
+            pred, hidden = decoder(tokens[:, -1], hidden, memory, **out)
+        else:
+            pred, hidden = decoder(tokens[:, -1], hidden, memory, keys, mask, **out)
+        vocab_size = pred.shape[1]
+        ll = F.log_softmax(pred, dim=1, dtype=torch.float)
+        # finished hypotheses may only be carried over unchanged
+        ll[finished] = float('-inf')
+        ll[finished, eos_col] = 0.0
+        ll = (scores.unsqueeze(1) + ll).view(alive.shape[0], -1)
+        scores, flat = torch.topk(ll, k=beam_width, dim=1)
+        offset = torch.arange(alive.shape[0], device=dev).unsqueeze(1) * beam_width
+        origin = (flat // vocab_size + offset).view(-1)
+        token = (flat % vocab_size).view(-1)
+        if vocab is not None:
+            token = vocab[token]
+        scores = scores.view(-1)
+        tokens = torch.cat((tokens[origin], token.unsqueeze(1)), dim=1)
+        hidden = hidden.index_select(hidden.dim() - 2, origin)
+        finished = finished[origin] | (token == eos)
+
+    collect(torch.arange(alive.shape[0], device=dev))
+    return results
+
+# Translates every sentence with model.translate_batch, batching sentences of
+# equal length together so that no source padding is needed
+def translate_batches(model, sentences, max_len=50, beam_width=3, batch_size=100):
+    preds = [None] * len(sentences)
+    order = sorted(range(len(sentences)), key=lambda i: len(sentences[i]))
+    for _, group in itertools.groupby(order, key=lambda i: len(sentences[i])):
+        group = list(group)
+        for k in range(0, len(group), batch_size):
+            idx = group[k:k + batch_size]
+            batch = model.translate_batch([sentences[i] for i in idx], max_len, beam_width)
+            for i, pred in zip(idx, batch):
+                preds[i] = pred
+            print('.', end='')
+    print('')
+    return preds
+
+# translate_batches, except that sentences found in the hypothesis cache are
+# not translated again
+def translate_sentences(model, sentences, cache, max_len=50, beam_width=3, batch_size=100):
+    keys = cache.keys(model, sentences, max_len, beam_width)
+    preds = cache.get(keys)
+    todo = [i for i, pred in enumerate(preds) if pred is None]
+    batches = translate_batches(model, [sentences[i] for i in todo], max_len, beam_width, batch_size)
+    for i, pred in zip(todo, batches):
+        preds[i] = pred
+    cache.put([keys[i] for i in todo], batches)
+    return preds
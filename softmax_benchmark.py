@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""softmax_benchmark.py
+
+Training throughput of the output layer with the full softmax against the
+sampled softmax used when a model is built with n_samples > 0. Times the
+forward and backward pass of the output layer and its loss for one batch and
+reports target tokens per second. The defaults match the maxout decoder of
+control_model_monodirectional.py (30k vocabulary, 400 maxout units).
+"""
+
+import time
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from loss import sample_vocab, output_loss
+
+BATCH_SIZE = 80
+TRG_LEN = 50
+FEATURE_DIM = 400
+VOCAB_SIZE = 30000
+N_SAMPLES = [0, 1000, 5000]
+PAD_IDX = 1
+REPEATS = 5
+
+def tokens_per_second(fc_out, features, trg, n_samples):
+    n_tokens = (trg != PAD_IDX).sum()
+    def step():
+        fc_out.zero_grad()
+        features.grad = None
+        candidates = sample_vocab(trg, VOCAB_SIZE, n_samples) if n_samples else None
+        loss = output_loss(fc_out, features, trg, PAD_IDX, candidates) / n_tokens
+        loss.backward()
+        return candidates
+    step()
+    start_time = time.time()
+    for _ in range(REPEATS):
+        candidates = step()
+    elapsed = (time.time() - start_time) / REPEATS
+    size = VOCAB_SIZE if candidates is None else candidates.numel()
+    return n_tokens.item() / elapsed, size
+
+fc_out = nn.Linear(FEATURE_DIM, VOCAB_SIZE)
+features = torch.randn(TRG_LEN, BATCH_SIZE, FEATURE_DIM, requires_grad=True)
+# Zipf distributed targets, so the batch vocabulary is as skewed as real text
+ranks = np.random.zipf(1.2, size=(TRG_LEN, BATCH_SIZE)) % (VOCAB_SIZE - 4) + 4
+trg = torch.from_numpy(ranks).long()
+
+print(f'batch {BATCH_SIZE}, trg len {TRG_LEN}, features {FEATURE_DIM}, vocab {VOCAB_SIZE}')
+for n_samples in N_SAMPLES:
+    rate, size = tokens_per_second(fc_out, features, trg, n_samples)
+    name = 'full softmax' if n_samples == 0 else f'sampled {n_samples}'
+    print(f'{name:>14}: {size:6d} output rows, {rate:10.0f} tokens/s')
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""sweep.py
+
+Evaluates the checkpoints of an experiment in parallel CPU processes instead
+of one after the other. A sweep is a list of jobs
+
+    Job(name, make_model, checkpoint, data)
+
+and an evaluate(model, data) function that returns a dict of results. Every
+worker builds the model with make_model(), loads the checkpoint on the CPU
+and calls evaluate; the results come back as one table with a row per job.
+
+Workers are forked from the notebook, so jobs, evaluate and init can be
+lambdas or notebook functions and the datasets are shared instead of copied.
+Every worker gets its share of the cores through torch.set_num_threads, so a
+sweep takes about (checkpoints / workers) evaluations of wall-clock time.
+Forked workers must not use CUDA; init runs first in each worker and is where
+a notebook points its device global at the CPU. Workers do not write to the
+HypothesisCaches passed as caches either: what they put is returned with
+their results and put by the notebook process after the sweep.
+"""
+
+import os
+import multiprocessing
+from collections import namedtuple
+import torch
+
+Job = namedtuple('Job', ['name', 'make_model', 'checkpoint', 'data'])
+
+# Jobs, evaluate function and hypothesis caches of a worker process
+worker_jobs, worker_evaluate, worker_caches = None, None, ()
+
+def init_worker(jobs, evaluate, caches, threads, init):
+    global worker_jobs, worker_evaluate, worker_caches
+    worker_jobs, worker_evaluate, worker_caches = jobs, evaluate, caches
+    torch.set_num_threads(threads)
+    if init is not None:
+        init()
+
+def run_job(k):
+    job = worker_jobs[k]
+    model = job.make_model()
+    model.load_state_dict(torch.load(job.checkpoint, map_location='cpu'))
+    results = worker_evaluate(model, job.data)
+    return k, results, [cache.take() for cache in worker_caches]
+
+def available_cores():
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count()
+
+# Runs the jobs on workers processes with threads torch threads each. By
+# default the cores are split between as many workers as there are jobs, at
+# least one thread each. Returns a row per job, in job order: its name and the
+# results of evaluate
+def sweep(jobs, evaluate, workers=None, threads=None, init=None, caches=()):
+    cores = available_cores()
+    if workers is None:
+        workers = max(1, min(len(jobs), cores // (threads or 1)))
+    if threads is None:
+        threads = max(1, cores // workers)
+    rows = [None] * len(jobs)
+    pending = [[] for cache in caches]
+    # no SQLite connection may be carried over into the workers
+    for cache in caches:
+        cache.close()
+    context = multiprocessing.get_context('fork')
+    with context.Pool(workers, init_worker, (jobs, evaluate, caches, threads, init)) as pool:
+        # one job at a time, so a slow checkpoint does not hold back others
+        for k, results, taken in pool.imap_unordered(run_job, range(len(jobs))):
+            rows[k] = dict(name=jobs[k].name, **results)
+            print(format_row(rows[k]))
+            for cache_pending, cache_taken in zip(pending, taken):
+                cache_pending.extend(cache_taken)
+    # written once no worker reads the caches any more
+    for cache, cache_pending in zip(caches, pending):
+        cache.merge(cache_pending)
+    return rows
+
+def format_row(row):
+    return '  '.join([str(row['name'])] +
+                     [f'{key} {value:.4f}' for key, value in row.items() if key != 'name'])
+
+# The rows of a sweep as a text table, a column per result
+def format_table(rows):
+    names = [str(row['name']) for row in rows]
+    keys = [key for key in rows[0] if key != 'name']
+    width = max(len(name) for name in names + ['name'])
+    lines = ['name'.ljust(width) + ''.join(f'{key:>12}' for key in keys)]
+    for name, row in zip(names, rows):
+        lines.append(name.ljust(width) + ''.join(f'{row[key]:12.4f}' for key in keys))
+    return '\n'.join(lines)
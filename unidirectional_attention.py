@@ -13,6 +13,10 @@ import torch.optim as optim
 import torch.nn.functional as F
 from torchtext.datasets import TranslationDataset, Multi30k, IWSLT
 from torchtext.data import Field, BucketIterator, Iterator
+from corpus import prepare_iwslt, MappedCorpus, MappedIterator, save_vocab
+from checkpoint import CheckpointWriter, TrainingState
+from attention import AdditiveAttention
+from loss import sample_vocab, output_loss
 import spacy
 import numpy as np
 import random
@@ -58,24 +62,23 @@ SRC = Field(init_token=sos_token,
             pad_token=pad_token, 
             unk_token=unk_token)
 
-# Commented out IPython magic to ensure Python compatibility.
-# %%capture
-# train_data, valid_data, test_data = IWSLT.splits(exts = ('.de', '.en'), 
-#                                                  fields = (SRC, TRG),
-#                                                  filter_pred=lambda x: len(x.__dict__['src']) <= 50)
+# The training set is tokenized once and kept on Drive as memory-mapped token
+# ids. The first run downloads and preprocesses it, see corpus.py
+prepare_iwslt("/content/drive/My Drive/data/iwslt-de-en.bin")
+train_data = MappedCorpus("/content/drive/My Drive/data/iwslt-de-en.bin", 'train', max_len = 50)
 
-SRC.build_vocab(train_data, max_size=10000)
-TRG.build_vocab(train_data, max_size=10000)
+train_data.build_vocab(SRC, 0, max_size=10000)
+train_data.build_vocab(TRG, 1, max_size=10000)
 
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
-BATCH_SIZE = 80
+MAX_TOKENS = 4000
 
-train_iterator, valid_iterator, test_iterator = BucketIterator.splits(
-    (train_data, valid_data, test_data), 
-    sort_key=lambda x: len(x.__dict__['src']),
-    batch_size = BATCH_SIZE, 
-    device = device)
+train_iterator = MappedIterator(
+    train_data, SRC, TRG,
+    batch_size = MAX_TOKENS, 
+    device = device,
+    num_workers = 2) # padded batches are built in background processes
 
 INPUT_DIM = len(SRC.vocab)
 OUTPUT_DIM = len(TRG.vocab)
@@ -98,11 +101,11 @@ def init_weights(m):
 TRG_PAD_IDX = TRG.vocab.stoi[TRG.pad_token]
 criterion = nn.CrossEntropyLoss(ignore_index = TRG_PAD_IDX)
 
-def train(model, iterator, optimizer, criterion, clip):
+def train(model, iterator, optimizer, criterion, clip, state = None):
     
     model.train()
     
-    epoch_loss = 0
+    epoch_loss = 0 if state is None else state.epoch_loss
     
     for i, batch in enumerate(iterator):
         src = batch.src
@@ -110,28 +113,18 @@ def train(model, iterator, optimizer, criterion, clip):
         
         optimizer.zero_grad()
         
-        output = model(src, trg)
-        
         #trg = [trg len, batch size]
-        #output = [trg len, batch size, output dim]
-        
-        output_dim = output.shape[-1]
-        
-        output = output[1:].view(-1, output_dim)
-        trg = trg[1:].view(-1)
-        
-        #trg = [(trg len - 1) * batch size]
-        #output = [(trg len - 1) * batch size, output dim]
-        
-        loss = criterion(output, trg)
         
-        loss.backward()
+        # backpropagates criterion over trg[1:] chunk by chunk, so the
+        # [trg len, batch size, output dim] logits are never held at once
+        loss = model.backward_loss(src, trg, criterion)
         
         torch.nn.utils.clip_grad_norm_(model.parameters(), clip)
         
         optimizer.step()
         
-        epoch_loss += loss.item()
+        epoch_loss += loss
+        if state is not None: state.step(epoch_loss)
         
     return epoch_loss / len(iterator)
 
@@ -147,29 +140,19 @@ class Encoder(nn.Module):
         self.embedding = nn.Embedding(input_dim, emb_dim)
         self.rnn = nn.GRU(emb_dim, enc_hid_dim)
 
-    def forward(self, src):
+    def forward(self, src, src_len = None):
         embedded = self.embedding(src)
+        if src_len is not None:
+            # Packing skips the <pad> positions at the end of shorter sentences
+            embedded = nn.utils.rnn.pack_padded_sequence(embedded, src_len.cpu(), enforce_sorted = False)
         outputs, hidden = self.rnn(embedded)
+        if src_len is not None:
+            outputs, _ = nn.utils.rnn.pad_packed_sequence(outputs, total_length = src.shape[0])
         return outputs, hidden.squeeze(0)
 
-class Attention(nn.Module):
+class Attention(AdditiveAttention):
     def __init__(self, enc_hid_dim, dec_hid_dim):
-        super().__init__()
-        
-        self.attn = nn.Linear(enc_hid_dim + dec_hid_dim, dec_hid_dim)
-        self.v = nn.Linear(dec_hid_dim, 1, bias = False)
-        
-    def forward(self, hidden, encoder_outputs):
-        batch_size = encoder_outputs.shape[1]
-        src_len = encoder_outputs.shape[0]
-        
-        hidden = hidden.unsqueeze(1).repeat(1, src_len, 1)
-        encoder_outputs = encoder_outputs.permute(1, 0, 2)
-        
-        energy = torch.tanh(self.attn(torch.cat((hidden, encoder_outputs), dim = 2))) 
-        attention = self.v(energy).squeeze(2)
-        
-        return F.softmax(attention, dim=1)
+        super().__init__(enc_hid_dim, dec_hid_dim)
 
 class Decoder(nn.Module):
     def __init__(self, output_dim, emb_dim, enc_hid_dim, dec_hid_dim, attention):
@@ -180,10 +163,16 @@ class Decoder(nn.Module):
         self.rnn = nn.GRU(enc_hid_dim + emb_dim, dec_hid_dim)
         self.fc_out = nn.Linear(enc_hid_dim + dec_hid_dim + emb_dim, output_dim)
         
-    def forward(self, input, hidden, encoder_outputs):
+    def forward(self, input, hidden, encoder_outputs, keys = None, mask = None):
+        features, hidden = self.features(input, hidden, encoder_outputs, keys, mask)
+        prediction = self.fc_out(features)
+        return prediction, hidden
+
+    # One decoder step up to, but not including, fc_out
+    def features(self, input, hidden, encoder_outputs, keys = None, mask = None):
         input = input.unsqueeze(0)
         embedded = self.embedding(input)
-        a = self.attention(hidden, encoder_outputs)
+        a = self.attention(hidden, encoder_outputs, keys, mask)
         a = a.unsqueeze(1)
         encoder_outputs = encoder_outputs.permute(1, 0, 2)
         weighted = torch.bmm(a, encoder_outputs)
@@ -194,15 +183,16 @@ class Decoder(nn.Module):
         output = output.squeeze(0)
         weighted = weighted.squeeze(0)
         
-        prediction = self.fc_out(torch.cat((output, weighted, embedded), dim = 1))
-        return prediction, hidden.squeeze(0)
+        return torch.cat((output, weighted, embedded), dim = 1), hidden.squeeze(0)
 
 class Search(nn.Module):
-    def __init__(self, encoder, decoder, device):
+    def __init__(self, encoder, decoder, device, n_samples = 0):
         super().__init__()
         self.encoder = encoder
         self.decoder = decoder
         self.device = device
+        # words sampled per batch for the sampled softmax, 0 for the full softmax
+        self.n_samples = n_samples
         
     def forward(self, src, trg, teacher_forcing_ratio = 0.5):
         batch_size = src.shape[1]
@@ -210,11 +200,13 @@ class Search(nn.Module):
         trg_vocab_size = self.decoder.output_dim
         
         outputs = torch.zeros(trg_len, batch_size, trg_vocab_size).to(self.device)
-        encoder_outputs, hidden = self.encoder(src)
+        mask = (src != SRC.vocab.stoi[SRC.pad_token]).permute(1, 0)
+        encoder_outputs, hidden = self.encoder(src, mask.sum(1))
+        keys = self.decoder.attention.project_keys(encoder_outputs)
         input = trg[0,:]
         
         for t in range(1, trg_len):
-            output, hidden = self.decoder(input, hidden, encoder_outputs)
+            output, hidden = self.decoder(input, hidden, encoder_outputs, keys, mask)
             outputs[t] = output
             teacher_force = random.random() < teacher_forcing_ratio
             top1 = output.argmax(1)
@@ -222,6 +214,47 @@ class Search(nn.Module):
 
         return outputs
 
+    # Computes criterion(self(src, trg)[1:], trg[1:]) and backpropagates it
+    # without holding the [trg len, batch size, output dim] logits. The inputs
+    # to fc_out are collected for every step, fc_out and the loss are evaluated
+    # chunk_size steps at a time with each chunk backpropagated on its own, and
+    # the accumulated gradient is then pushed back through the decoder. With
+    # n_samples set, the loss is the sampled softmax loss instead.
+    def backward_loss(self, src, trg, criterion, teacher_forcing_ratio = 0.5, chunk_size = 8):
+        trg_len = trg.shape[0]
+        
+        mask = (src != SRC.vocab.stoi[SRC.pad_token]).permute(1, 0)
+        encoder_outputs, hidden = self.encoder(src, mask.sum(1))
+        keys = self.decoder.attention.project_keys(encoder_outputs)
+        input = trg[0,:]
+        features = []
+        
+        for t in range(1, trg_len):
+            feature, hidden = self.decoder.features(input, hidden, encoder_outputs, keys, mask)
+            features.append(feature)
+            teacher_force = random.random() < teacher_forcing_ratio
+            if teacher_force:
+                input = trg[t]
+            else:
+                with torch.no_grad():
+                    input = self.decoder.fc_out(feature).argmax(1)
+
+        features = torch.stack(features)
+        detached = features.detach().requires_grad_()
+        trg = trg[1:]
+        n_tokens = (trg != criterion.ignore_index).sum()
+        candidates = sample_vocab(trg, self.decoder.output_dim, self.n_samples) if self.n_samples else None
+        total = 0.0
+        
+        for t in range(0, trg_len - 1, chunk_size):
+            loss = output_loss(self.decoder.fc_out, detached[t:t + chunk_size], trg[t:t + chunk_size],
+                               criterion.ignore_index, candidates) / n_tokens
+            loss.backward()
+            total += loss.item()
+        
+        features.backward(detached.grad)
+        return total
+
 att = Attention(HID_DIM, HID_DIM)
 enc = Encoder(INPUT_DIM, ENC_EMB_DIM, HID_DIM, HID_DIM)
 dec = Decoder(OUTPUT_DIM, DEC_EMB_DIM, HID_DIM, HID_DIM, att)
@@ -233,19 +266,29 @@ su_optimizer = optim.Adam(search_uni.parameters())
 N_EPOCHS = 10
 CLIP = 1
 
-search_uni.load_state_dict(torch.load(f'/content/drive/My Drive/ml-mini-project/unidirectional-attention/epoch-9.pt'))
+save_vocab('/content/drive/My Drive/ml-mini-project/unidirectional-attention/vocab.json', src=SRC, trg=TRG)
+
+# Epoch checkpoints are written to Drive in the background, see checkpoint.py
+checkpoints = CheckpointWriter()
 
-for epoch in range(9, N_EPOCHS):
-    # torch.save(search_uni.state_dict(), f'/content/drive/My Drive/ml-mini-project/unidirectional-attention/epoch-{epoch}.pt')
-    # search_uni.load_state_dict(torch.load(f'/content/drive/My Drive/ml-mini-project/unidirectional-attention/epoch-{epoch}.pt'))
+# Full training state (optimizer, random generators, place in the epoch),
+# saved every CHECKPOINT_STEPS batches and after every epoch, so that a run
+# that was stopped continues where it was, see checkpoint.py
+CHECKPOINT_STEPS = 1000
+state = TrainingState('/content/drive/My Drive/ml-mini-project/unidirectional-attention/training-state.pt',
+                      search_uni, su_optimizer, train_iterator,
+                      every = CHECKPOINT_STEPS, writer = checkpoints)
 
+for epoch in range(state.resume(), N_EPOCHS):
     start_time = time.time()
-    train_loss = train(search_uni, train_iterator, su_optimizer, criterion, CLIP)    
+    train_loss = train(search_uni, train_iterator, su_optimizer, criterion, CLIP, state = state)    
     end_time = time.time()
 
     epoch_mins, epoch_secs = epoch_time(start_time, end_time)
 
     print(f'Epoch: {epoch+1:02} | Time: {epoch_mins}m {epoch_secs}s')
     print(f'\tTrain Loss: {train_loss:.3f}')
+    state.end_epoch()
+    checkpoints.save(search_uni.state_dict(), f'/content/drive/My Drive/ml-mini-project/unidirectional-attention/epoch-{epoch + 1}.pt')
 
-torch.save(search_uni.state_dict(), f'/content/drive/My Drive/ml-mini-project/unidirectional-attention/epoch-{epoch}.pt')
\ No newline at end of file
+checkpoints.wait()
\ No newline at end of file